@@ -1,18 +1,40 @@
 import os
 import logging
-from flask import Flask, request, render_template, jsonify, flash, redirect, url_for
+import time
+import startup
+from flask import Flask, request, render_template, jsonify, flash, redirect, url_for, g, Response
 from werkzeug.utils import secure_filename
 from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge
 from excel_processor import ExcelProcessor
+from browser_pool import BrowserPool
+from screenshot_cache import ScreenshotCache
+from sheet_scanner import parse_cell_range
+from parse_pool import ParsePool
+from image_optimizer import ImageOptimizer
 from email_sender import EmailSender
+from job_queue import JobQueue, QueueFullError
+from upload_stream import StreamingRequest, StreamedUpload
+from memory_files import MemoryFile, MemoryUploads, is_memory_key
+from workbook_store import WorkbookStore, WorkbookStoreFull
+from change_history import ChangeHistory
+import metrics
+from metrics import track
 import tempfile
 import uuid
+import csv
+import io
+import json
+import re
+
+startup.mark('imports')
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
+app.request_class = StreamingRequest
 app.secret_key = os.environ.get("SESSION_SECRET", "dev-secret-key")
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 
@@ -20,18 +42,56 @@ app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 UPLOAD_FOLDER = 'uploads'
 SCREENSHOT_FOLDER = 'screenshots'
 ALLOWED_EXTENSIONS = {'xlsx', 'xls'}
-MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
+MAX_UPLOAD_MB = float(os.getenv('MAX_UPLOAD_MB', '16'))
+# Per-endpoint upload limits, defaulting to MAX_UPLOAD_MB
+UPLOAD_LIMITS = {
+    'upload_file': int(float(os.getenv('UPLOAD_MAX_MB', MAX_UPLOAD_MB)) * 1024 * 1024),
+    'api_upload': int(float(os.getenv('API_UPLOAD_MAX_MB', MAX_UPLOAD_MB)) * 1024 * 1024),
+    'api_upload_batch': int(float(os.getenv('BATCH_UPLOAD_MAX_MB', MAX_UPLOAD_MB)) * 1024 * 1024),
+    'store_workbook': int(float(os.getenv('WORKBOOK_UPLOAD_MAX_MB', MAX_UPLOAD_MB)) * 1024 * 1024),
+}
+# Hard ceiling for any request body; multipart overhead on top of the largest file limit
+MAX_CONTENT_LENGTH = max(UPLOAD_LIMITS.values()) + 1024 * 1024
+BATCH_MAX_RECIPIENTS = int(os.getenv('BATCH_MAX_RECIPIENTS', '1000'))
+MAX_SHEETS = int(os.getenv('MAX_SHEETS', '20'))
+# How sheets are put in the email: 'image' (screenshots), 'html' (inline tables,
+# no browser) or 'auto' (inline tables for sheets small enough, see EMAIL_HTML_MAX_CELLS)
+EMAIL_FORMATS = ('image', 'html', 'auto')
+EMAIL_FORMAT = os.getenv('EMAIL_FORMAT', 'image').lower()
+EMAIL_PATTERN = re.compile(r'^[^@\s,;<>]+@[^@\s,;<>]+\.[^@\s,;<>]+$')
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['SCREENSHOT_FOLDER'] = SCREENSHOT_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
+StreamingRequest.upload_folder = UPLOAD_FOLDER
+StreamingRequest.upload_limits = UPLOAD_LIMITS
+
+# Uploads up to MEMORY_PIPELINE_MAX_MB are kept in memory from the request body
+# to the SMTP socket, larger ones use the upload and screenshot folders; 0 disables it
+MEMORY_PIPELINE_MAX_BYTES = int(float(os.getenv('MEMORY_PIPELINE_MAX_MB', '0')) * 1024 * 1024)
+memory_uploads = MemoryUploads() if MEMORY_PIPELINE_MAX_BYTES > 0 else None
+StreamingRequest.memory_uploads = memory_uploads
+StreamingRequest.memory_max_size = MEMORY_PIPELINE_MAX_BYTES
 
 # Create directories if they don't exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(SCREENSHOT_FOLDER, exist_ok=True)
 
 # Initialize processors
-excel_processor = ExcelProcessor()
+# Warm Chromium pool (started lazily on first render); BROWSER_POOL_SIZE=0 disables it
+browser_pool = BrowserPool() if int(os.getenv('BROWSER_POOL_SIZE', '2')) > 0 else None
+# Content-addressed screenshot cache; SCREENSHOT_CACHE_MAX_MB=0 disables it
+screenshot_cache = ScreenshotCache() if float(os.getenv('SCREENSHOT_CACHE_MAX_MB', '256')) > 0 else None
+# Worker processes for workbook parsing and HTML generation; PARSE_WORKERS=0 parses in-process
+parse_pool = ParsePool() if int(os.getenv('PARSE_WORKERS', '2')) > 0 else None
+# Cell hashes of the last version of each recurring report, for highlight_changes
+change_history = ChangeHistory()
+excel_processor = ExcelProcessor(browser_pool=browser_pool, screenshot_cache=screenshot_cache,
+                                 parse_pool=parse_pool, change_history=change_history)
+# Shrinks screenshots before they are embedded in emails
+image_optimizer = ImageOptimizer()
+# Workbooks uploaded once and sent again by handle
+workbook_store = WorkbookStore()
 try:
     email_sender = EmailSender()
     logger.info("Email sender initialized successfully")
@@ -44,14 +104,509 @@ def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def cleanup_files(paths):
+    """Remove an upload and its screenshots once a job is done with them"""
+    for path in paths:
+        if is_memory_key(path):
+            # Without a memory store (a requeued job) there is nothing to drop
+            if memory_uploads:
+                memory_uploads.remove(path)
+        elif path and not isinstance(path, MemoryFile):
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.warning(f"Failed to cleanup files: {e}")
+
+def resolve_upload(filepath):
+    """The file a job payload refers to: its path, or the MemoryFile behind a memory key"""
+    if not is_memory_key(filepath):
+        return filepath
+    memory_file = memory_uploads.get(filepath) if memory_uploads else None
+    if memory_file is None:
+        raise RuntimeError('The upload held in memory is no longer available')
+    return memory_file
+
+def job_workbook(payload):
+    """
+    The workbook a job renders: the stored workbook of a send by handle,
+    which outlives the job, or the upload (see resolve_upload)
+    """
+    if payload.get('handle'):
+        path = workbook_store.path(payload['handle'])
+        if path is None:
+            raise RuntimeError('The stored workbook has expired or was deleted')
+        workbook_store.record_send(payload['handle'])
+        return path
+    return resolve_upload(payload['filepath'])
+
+def report_series(filename, recipients):
+    """
+    Identity of a recurring report, whose versions are compared for
+    highlight_changes: the workbook's file name and who receives it
+    """
+    return f"{filename}\n{','.join(sorted(recipients))}"
+
+def render_upload(filepath, selection=None, view=None, series=None):
+    """
+    Render a saved upload: the first sheet (tiled when large) by default, or
+    one image per sheet/named range of the selection. view narrows the
+    rendered cells (see parse_view_options), series identifies the report
+    for highlight_changes (see report_series).
+    Returns (screenshot_paths, captions), captions is None for the first sheet
+    """
+    if not selection:
+        return excel_processor.process_excel_and_screenshots(filepath, view=view, series=series), None
+
+    sheets = excel_processor.process_excel_sheets(filepath, selection, view)
+    if not sheets:
+        return None, None
+    return [path for _, path in sheets], [name for name, _ in sheets]
+
+def render_tables(filepath, selection=None, view=None):
+    """
+    Inline HTML tables for uploads whose email format is 'html', or 'auto'
+    when the sheets are small enough (see parse_view_options).
+    Returns (tables, captions) with tables a list of (html, text), or
+    (None, None) when the upload is to be sent as screenshots
+    """
+    email_format = (view or {}).get('format', EMAIL_FORMAT)
+    if email_format not in ('html', 'auto'):
+        return None, None
+
+    tables = excel_processor.inline_tables(filepath, selection, view, auto=email_format == 'auto')
+    if not tables:
+        return None, None
+    size = sum(len(table_html) + len(text) for _, table_html, text in tables)
+    if size > email_sender.max_email_bytes:
+        logger.warning(f"Inline tables are {size} bytes, over the email size limit, sending images")
+        return None, None
+
+    captions = [name for name, _, _ in tables] if selection else None
+    return [(table_html, text) for _, table_html, text in tables], captions
+
+class JobSteps:
+    """
+    The blocking work of the upload and batch jobs, for worker threads.
+    asgi.AsyncJobSteps overrides the steps for the event loop, and both
+    run the same flow (upload_job_flow, batch_job_flow). The steps are
+    coroutines so the flow can await either kind; these never suspend,
+    which lets run_steps drive the flow without an event loop.
+    """
+
+    async def workbook(self, payload):
+        return job_workbook(payload)
+
+    async def tables(self, source, selection, view):
+        return render_tables(source, selection, view)
+
+    async def render(self, source, selection, view, series):
+        return render_upload(source, selection, view, series)
+
+    async def optimize(self, screenshot_paths):
+        return image_optimizer.optimize(screenshot_paths)
+
+    async def send_tables(self, recipient, tables, filename, captions):
+        return email_sender.send_email_with_tables(recipient, tables, filename, captions)
+
+    async def send_screenshots(self, recipient, screenshot_paths, filename, captions):
+        return email_sender.send_email_with_screenshot(recipient, screenshot_paths, filename, captions)
+
+    async def send_table_batch(self, recipients, tables, filename, captions):
+        return email_sender.send_table_batch(recipients, tables, filename, captions)
+
+    async def send_batch(self, recipients, screenshot_paths, filename, captions):
+        return email_sender.send_batch(recipients, screenshot_paths, filename, captions)
+
+    async def cleanup(self, paths):
+        cleanup_files(paths)
+
+def run_steps(flow):
+    """Run a job flow over JobSteps, whose steps complete without suspending"""
+    try:
+        flow.send(None)
+    except StopIteration as done:
+        return done.value
+    flow.close()
+    raise RuntimeError('A job step suspended outside of an event loop')
+
+async def render_job(payload, steps, series):
+    """
+    Render a job's workbook: inline tables when its format allows, else
+    optimized screenshots. Returns (tables, screenshot_paths, captions)
+    with one of tables and screenshot_paths None; the caller removes the
+    screenshots.
+    """
+    source = await steps.workbook(payload)
+    tables, captions = await steps.tables(source, payload.get('selection'), payload.get('view'))
+    if tables:
+        # Inline HTML tables, no rendering at all
+        return tables, None, captions
+
+    # Process Excel file and take screenshot(s), large sheets are tiled
+    screenshot_paths, captions = await steps.render(source, payload.get('selection'), payload.get('view'), series)
+    if not screenshot_paths:
+        raise RuntimeError('Failed to process Excel file or take screenshot')
+
+    logger.info(f"Screenshot saved: {', '.join(map(str, screenshot_paths))}")
+    return None, screenshot_paths, captions
+
+async def upload_job_flow(payload, steps):
+    """
+    Process a saved upload, email the screenshot and clean up.
+    Raises on failure so the job is recorded as failed.
+    """
+    filepath = payload.get('filepath')  # None for stored workbooks
+    filename = payload['filename']
+    recipient_email = payload['recipient']
+    screenshot_paths = None
+
+    try:
+        tables, screenshot_paths, captions = await render_job(
+            payload, steps, report_series(filename, [recipient_email])
+        )
+
+        if tables:
+            success = await steps.send_tables(recipient_email, tables, filename, captions)
+        else:
+            screenshot_paths = await steps.optimize(screenshot_paths)
+            # Send email with embedded screenshot
+            success = await steps.send_screenshots(recipient_email, screenshot_paths, filename, captions)
+
+        if not success:
+            raise RuntimeError('Failed to send email. Please check email configuration.')
+
+        return {
+            'message': 'Excel file processed and email sent successfully!',
+            'filename': filename,
+            'recipient': recipient_email
+        }
+
+    finally:
+        await steps.cleanup([filepath] + (screenshot_paths or []))
+
+async def batch_job_flow(payload, steps):
+    """
+    Render a saved upload once and email it to every recipient.
+    Returns per-recipient results.
+    """
+    filepath = payload.get('filepath')  # None for stored workbooks
+    filename = payload['filename']
+    recipients = payload['recipients']
+    screenshot_paths = None
+
+    try:
+        tables, screenshot_paths, captions = await render_job(
+            payload, steps, report_series(filename, recipients)
+        )
+
+        if tables:
+            results = await steps.send_table_batch(recipients, tables, filename, captions)
+        else:
+            screenshot_paths = await steps.optimize(screenshot_paths)
+            results = await steps.send_batch(recipients, screenshot_paths, filename, captions)
+        sent = sum(1 for r in results if r['status'] == 'sent')
+
+        return {
+            'message': f'Email sent to {sent} of {len(recipients)} recipients',
+            'filename': filename,
+            'sent': sent,
+            'failed': len(results) - sent,
+            'results': results
+        }
+
+    finally:
+        await steps.cleanup([filepath] + (screenshot_paths or []))
+
+def process_upload_job(payload):
+    """Job handler: upload_job_flow on a worker thread"""
+    return run_steps(upload_job_flow(payload, JobSteps()))
+
+def process_batch_job(payload):
+    """Job handler: batch_job_flow on a worker thread"""
+    return run_steps(batch_job_flow(payload, JobSteps()))
+
+def parse_recipients(form, files):
+    """
+    Collect batch recipients from a 'recipients' form field (JSON list or
+    comma/newline separated) and/or a 'recipients_file' CSV upload with an
+    'email' column (the first column is used if there is no such header).
+    Returns (recipients, invalid) with duplicates removed in order.
+    """
+    raw = []
+
+    field = form.get('recipients', '').strip()
+    if field:
+        if field.startswith('['):
+            try:
+                raw.extend(str(r) for r in json.loads(field))
+            except ValueError:
+                raise ValueError('recipients is not a valid JSON list')
+        else:
+            raw.extend(re.split(r'[,;\n]', field))
+
+    csv_file = files.get('recipients_file')
+    if csv_file and csv_file.filename:
+        rows = list(csv.reader(io.StringIO(csv_file.read().decode('utf-8-sig'))))
+        if rows:
+            header = [h.strip().lower() for h in rows[0]]
+            if 'email' in header:
+                column = header.index('email')
+                rows = rows[1:]
+            else:
+                column = 0
+            raw.extend(row[column] for row in rows if len(row) > column)
+
+    recipients = []
+    invalid = []
+    seen = set()
+    for recipient in (r.strip() for r in raw):
+        if not recipient or recipient.lower() in seen:
+            continue
+        seen.add(recipient.lower())
+        if EMAIL_PATTERN.match(recipient):
+            recipients.append(recipient)
+        else:
+            invalid.append(recipient)
+
+    return recipients, invalid
+
+def parse_sheet_selection(form):
+    """
+    Read the optional sheet selection of an upload: 'sheets' is 'all' or a
+    JSON list / comma separated list of sheet names, 'ranges' a JSON list /
+    comma separated list of named ranges.
+    Returns None when neither is given (render the first sheet only)
+    """
+    def parse_list(name):
+        field = form.get(name, '').strip()
+        if field.startswith('['):
+            try:
+                return [str(item).strip() for item in json.loads(field) if str(item).strip()]
+            except ValueError:
+                raise ValueError(f'{name} is not a valid JSON list')
+        return [item.strip() for item in field.split(',') if item.strip()]
+
+    sheets = 'all' if form.get('sheets', '').strip().lower() == 'all' else parse_list('sheets')
+    ranges = parse_list('ranges')
+    if not sheets and not ranges:
+        return None
+
+    if sheets != 'all' and len(sheets) + len(ranges) > MAX_SHEETS:
+        raise ValueError(f'Too many sheets and ranges. Maximum is {MAX_SHEETS}.')
+    return {'sheets': sheets, 'ranges': ranges}
+
+def parse_view_options(form, selection=None):
+    """
+    Read the optional view options of an upload, which narrow what is parsed
+    and rendered: 'cell_range' is an A1-style range ('B2:F40', 'A:D' or
+    'Summary!A1:H20', first row as the header), 'max_rows'/'max_cols' cap
+    the table and 'top' keeps the first N data rows plus the last (totals)
+    row. 'style' is 'excel' (cell formats, fills, fonts, widths and merges)
+    or 'plain'. 'format' is how the sheets go in the email, one of
+    EMAIL_FORMATS. 'highlight_changes' marks the cells changed since the
+    previous version sent to the same recipients. Only the caps, style and
+    format can be combined with a sheet selection.
+    Returns None when none is given
+    """
+    view = {}
+
+    email_format = form.get('format', '').strip().lower()
+    if email_format:
+        if email_format not in EMAIL_FORMATS:
+            raise ValueError(f"format must be one of {', '.join(EMAIL_FORMATS)}")
+        view['format'] = email_format
+
+    style = form.get('style', '').strip().lower()
+    if style:
+        if style not in ('excel', 'plain'):
+            raise ValueError("style must be 'excel' or 'plain'")
+        view['style'] = style
+
+    if form.get('highlight_changes', '').strip().lower() in ('1', 'true', 'yes'):
+        view['highlight'] = True
+
+    cell_range = form.get('cell_range', '').strip()
+    if cell_range:
+        parse_cell_range(cell_range)
+        view['cell_range'] = cell_range
+
+    for name in ('max_rows', 'max_cols', 'top'):
+        field = form.get(name, '').strip()
+        if not field:
+            continue
+        try:
+            value = int(field)
+        except ValueError:
+            value = 0
+        if value < 1:
+            raise ValueError(f'{name} must be a positive whole number')
+        view[name] = value
+
+    if selection and ('cell_range' in view or 'top' in view):
+        raise ValueError('cell_range and top cannot be combined with sheets or ranges')
+    if selection and 'highlight' in view:
+        raise ValueError('highlight_changes cannot be combined with sheets or ranges')
+    return view or None
+
+def save_upload(file):
+    """
+    Keep an uploaded file under a unique name, returns (filename, filepath)
+    Workbooks streamed to disk during parsing are validated and kept in place.
+    """
+    with track('upload_save'):
+        if isinstance(file.stream, StreamedUpload):
+            return file.stream.filename, file.stream.claim()
+
+        filename = secure_filename(file.filename)
+        unique_filename = f"{uuid.uuid4()}_{filename}"
+        filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
+        file.save(filepath)
+        return filename, filepath
+
+def enqueue_upload(kind, payload):
+    """
+    Queue a saved upload for processing, removing the file if the queue is full.
+    Uploads held in memory can only be processed by this process.
+    """
+    try:
+        return job_queue.submit(kind, payload, pinned=is_memory_key(payload['filepath']))
+    except QueueFullError:
+        cleanup_files([payload['filepath']])
+        raise
+
+def replay_dead_letters_job(payload):
+    """Job handler: send spooled dead letters again, returns per-letter results"""
+    letter_ids = payload.get('letter_ids') or [meta['id'] for meta in email_sender.dead_letters.list()]
+    results = [email_sender.replay_dead_letter(letter_id) for letter_id in letter_ids]
+    results = [r for r in results if r is not None]
+    sent = sum(1 for r in results if r['status'] == 'sent')
+    return {
+        'message': f'Replayed {sent} of {len(results)} dead letters',
+        'sent': sent,
+        'failed': len(results) - sent,
+        'results': results
+    }
+
+# Background job queue; uploads are processed off the request thread
+job_queue = JobQueue()
+job_queue.register('upload', process_upload_job)
+job_queue.register('batch', process_batch_job)
+job_queue.register('replay', replay_dead_letters_job)
+
+def start_job_workers():
+    """Start this process's job worker threads, unless they run on an ASGI loop"""
+    if os.getenv('JOB_RUNNER', 'threads') != 'asyncio':
+        job_queue.start()
+
+# JOB_RUNNER=asyncio leaves the workers to the ASGI server loop (see asgi.py), and
+# JOB_RUNNER=post_fork to each gunicorn worker once forked (see gunicorn.conf.py)
+if os.getenv('JOB_RUNNER', 'threads') == 'threads':
+    job_queue.start()
+
+def collect_pool_metrics():
+    """Pool, cache and queue stats for /metrics, read at scrape time"""
+    families = []
+
+    smtp_pools = email_sender.pool_stats().items()
+    families.append(('smtp_connections', 'gauge', 'SMTP connections by state', [
+        ({'pool': pool, 'state': state}, stats[state])
+        for pool, stats in smtp_pools for state in ('idle', 'in_use')
+    ]))
+    families.append(('smtp_connections_opened_total', 'counter', 'SMTP connections opened', [
+        ({'pool': pool}, stats['opened_total']) for pool, stats in smtp_pools
+    ]))
+
+    if browser_pool:
+        stats = browser_pool.stats()
+        if stats['started']:
+            families.append(('browser_pool_slots', 'gauge', 'Browser pool slots by state', [
+                ({'state': 'idle'}, stats['idle']),
+                ({'state': 'busy'}, stats['size'] - stats['idle']),
+                ({'state': 'healthy'}, stats['healthy']),
+            ]))
+
+    if screenshot_cache:
+        stats = screenshot_cache.stats()
+        families.extend([
+            ('screenshot_cache_requests_total', 'counter', 'Screenshot cache lookups by result', [
+                ({'result': 'hit'}, stats['hits']),
+                ({'result': 'miss'}, stats['misses']),
+            ]),
+            ('screenshot_cache_hit_ratio', 'gauge', 'Screenshot cache hit rate', [({}, stats['hit_rate'])]),
+            ('screenshot_cache_evictions_total', 'counter', 'Screenshot cache evictions', [({}, stats['evictions'])]),
+            ('screenshot_cache_bytes', 'gauge', 'Screenshot cache size on disk', [({}, stats['bytes'])]),
+        ])
+
+    if memory_uploads:
+        stats = memory_uploads.stats()
+        families.append(('memory_uploads_bytes', 'gauge', 'Bytes of uploads held in memory',
+                         [({}, stats['bytes'])]))
+
+    stats = workbook_store.stats()
+    families.extend([
+        ('workbook_store_workbooks', 'gauge', 'Workbooks stored for sending by handle', [({}, stats['workbooks'])]),
+        ('workbook_store_bytes', 'gauge', 'Size of the stored workbooks', [({}, stats['bytes'])]),
+    ])
+
+    if parse_pool:
+        stats = parse_pool.stats()
+        families.append(('parse_pool_tasks_total', 'counter', 'Parse pool tasks by outcome', [
+            ({'outcome': 'submitted'}, stats['tasks']),
+            ({'outcome': 'timeout'}, stats['timeouts']),
+            ({'outcome': 'crash'}, stats['crashes']),
+        ]))
+
+    stats = email_sender.delivery_stats()
+    families.extend([
+        ('email_deliveries_total', 'counter', 'Email deliveries by outcome', [
+            ({'outcome': outcome}, count) for outcome, count in stats['counts'].items()
+        ]),
+        ('email_rate_limit_wait_seconds_total', 'counter', 'Time sends waited for the rate limiter',
+         [({}, stats['rate_limits']['waited_seconds'])]),
+        ('email_dead_letters', 'gauge', 'Undelivered emails in the dead letter spool', [({}, stats['dead_letters'])]),
+    ])
+
+    families.append(('startup_seconds', 'gauge', 'Seconds from the start of the app import to each phase', [
+        ({'phase': phase}, seconds) for phase, seconds in startup.report()['phases'].items()
+    ]))
+
+    families.append(('jobs', 'gauge', 'Jobs by status', [
+        ({'status': status}, count) for status, count in job_queue.stats().items()
+    ]))
+    return families
+
+metrics.register_collector(collect_pool_metrics)
+
+@app.before_request
+def start_request_timer():
+    """Count the request as in flight and start its latency timer"""
+    g.request_start = time.perf_counter()
+    metrics.HTTP_IN_FLIGHT.inc()
+
+@app.after_request
+def record_request_time(response):
+    """Record request latency by endpoint and status"""
+    if 'request_start' in g:
+        metrics.HTTP_SECONDS.observe(
+            time.perf_counter() - g.request_start,
+            endpoint=request.endpoint or 'unknown',
+            status=response.status_code
+        )
+    return response
+
+@app.teardown_request
+def finish_request(exc):
+    if g.pop('request_start', None) is not None:
+        metrics.HTTP_IN_FLIGHT.dec()
+
 @app.route('/')
 def index():
     """Main page with file upload form"""
-    return render_template('index.html')
+    return render_template('index.html', max_upload_mb=f"{UPLOAD_LIMITS['upload_file'] / (1024 * 1024):g}")
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
-    """Handle file upload and processing"""
+    """Handle file upload and queue it for processing"""
     try:
         # Check if file was uploaded
         if 'file' not in request.files:
@@ -74,46 +629,32 @@ def upload_file():
             flash('Invalid file type. Only .xlsx and .xls files are allowed.', 'error')
             return redirect(url_for('index'))
         
-        # Save uploaded file
-        filename = secure_filename(file.filename)
-        unique_filename = f"{uuid.uuid4()}_{filename}"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-        file.save(filepath)
-        
-        logger.info(f"File uploaded: {filepath}")
-        
-        # Process Excel file and take screenshot
-        screenshot_path = excel_processor.process_excel_and_screenshot(filepath)
-        
-        if not screenshot_path:
-            flash('Failed to process Excel file or take screenshot', 'error')
+        try:
+            selection = parse_sheet_selection(request.form)
+            view = parse_view_options(request.form, selection)
+        except ValueError as e:
+            flash(str(e), 'error')
             return redirect(url_for('index'))
         
-        logger.info(f"Screenshot saved: {screenshot_path}")
-        
-        # Send email with embedded screenshot
-        if email_sender:
-            success = email_sender.send_email_with_screenshot(
-                recipient_email, 
-                screenshot_path, 
-                filename
-            )
-        else:
-            logger.error("Email sender not initialized - check email configuration")
-            success = False
+        # Save uploaded file
+        filename, filepath = save_upload(file)
         
-        # Cleanup files
-        try:
-            os.remove(filepath)
-            os.remove(screenshot_path)
-        except OSError as e:
-            logger.warning(f"Failed to cleanup files: {e}")
+        logger.info(f"File uploaded: {filepath}")
         
-        if success:
-            flash('Excel file processed and email sent successfully!', 'success')
-        else:
-            flash('Failed to send email. Please check the email configuration.', 'error')
+        # Queue for processing
+        job_id = enqueue_upload('upload', {
+            'filepath': filepath,
+            'filename': filename,
+            'recipient': recipient_email,
+            'selection': selection,
+            'view': view
+        })
+        flash(f'Excel file received. The screenshot will be emailed shortly (job {job_id}).', 'success')
             
+    except QueueFullError:
+        flash('The server is busy. Please try again in a moment.', 'error')
+    except HTTPException as e:
+        flash(e.description, 'error')
     except Exception as e:
         logger.error(f"Error processing file: {str(e)}")
         flash(f'An error occurred while processing the file: {str(e)}', 'error')
@@ -122,7 +663,7 @@ def upload_file():
 
 @app.route('/api/upload', methods=['POST'])
 def api_upload():
-    """API endpoint for file upload"""
+    """API endpoint for file upload, returns 202 with a job id"""
     try:
         # Check if file was uploaded
         if 'file' not in request.files:
@@ -141,53 +682,294 @@ def api_upload():
         if not allowed_file(file.filename):
             return jsonify({'error': 'Invalid file type. Only .xlsx and .xls files are allowed.'}), 400
         
+        try:
+            selection = parse_sheet_selection(request.form)
+            view = parse_view_options(request.form, selection)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
         # Save uploaded file
-        filename = secure_filename(file.filename)
-        unique_filename = f"{uuid.uuid4()}_{filename}"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-        file.save(filepath)
+        filename, filepath = save_upload(file)
         
         logger.info(f"File uploaded via API: {filepath}")
         
-        # Process Excel file and take screenshot
-        screenshot_path = excel_processor.process_excel_and_screenshot(filepath)
+        # Queue for processing
+        job_id = enqueue_upload('upload', {
+            'filepath': filepath,
+            'filename': filename,
+            'recipient': recipient_email,
+            'selection': selection,
+            'view': view
+        })
+        
+        return jsonify({
+            'message': 'Excel file queued for processing',
+            'job_id': job_id,
+            'status': 'queued',
+            'status_url': url_for('job_status', job_id=job_id),
+            'filename': filename,
+            'recipient': recipient_email
+        }), 202
+            
+    except QueueFullError:
+        return jsonify({'error': 'Too many pending jobs. Please retry later.'}), 429
+    except HTTPException as e:
+        return jsonify({'error': e.description}), e.code
+    except Exception as e:
+        logger.error(f"API error processing file: {str(e)}")
+        return jsonify({'error': f'An error occurred: {str(e)}'}), 500
+
+@app.route('/api/upload/batch', methods=['POST'])
+def api_upload_batch():
+    """API endpoint sending one workbook to many recipients, returns 202 with a job id"""
+    try:
+        # Check if file was uploaded
+        if 'file' not in request.files:
+            return jsonify({'error': 'No file uploaded'}), 400
         
-        if not screenshot_path:
-            return jsonify({'error': 'Failed to process Excel file or take screenshot'}), 500
+        file = request.files['file']
         
-        logger.info(f"Screenshot saved via API: {screenshot_path}")
+        # Validate inputs
+        if file.filename == '':
+            return jsonify({'error': 'No file selected'}), 400
         
-        # Send email with embedded screenshot
-        if email_sender:
-            success = email_sender.send_email_with_screenshot(
-                recipient_email, 
-                screenshot_path, 
-                filename
-            )
-        else:
-            logger.error("Email sender not initialized - check email configuration")
-            success = False
+        if not allowed_file(file.filename):
+            return jsonify({'error': 'Invalid file type. Only .xlsx and .xls files are allowed.'}), 400
         
-        # Cleanup files
         try:
-            os.remove(filepath)
-            os.remove(screenshot_path)
-        except OSError as e:
-            logger.warning(f"Failed to cleanup files: {e}")
-        
-        if success:
-            return jsonify({
-                'message': 'Excel file processed and email sent successfully!',
-                'filename': filename,
-                'recipient': recipient_email
-            }), 200
-        else:
-            return jsonify({'error': 'Failed to send email. Please check email configuration.'}), 500
+            recipients, invalid = parse_recipients(request.form, request.files)
+            selection = parse_sheet_selection(request.form)
+            view = parse_view_options(request.form, selection)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        if invalid:
+            return jsonify({'error': 'Invalid email addresses', 'invalid': invalid}), 400
+        
+        if not recipients:
+            return jsonify({'error': 'At least one recipient is required'}), 400
+        
+        if len(recipients) > BATCH_MAX_RECIPIENTS:
+            return jsonify({'error': f'Too many recipients. Maximum is {BATCH_MAX_RECIPIENTS}.'}), 400
+        
+        # Save uploaded file
+        filename, filepath = save_upload(file)
+        
+        logger.info(f"File uploaded via batch API for {len(recipients)} recipients: {filepath}")
+        
+        # Queue for processing
+        job_id = enqueue_upload('batch', {
+            'filepath': filepath,
+            'filename': filename,
+            'recipients': recipients,
+            'selection': selection,
+            'view': view
+        })
+        
+        return jsonify({
+            'message': 'Excel file queued for batch processing',
+            'job_id': job_id,
+            'status': 'queued',
+            'status_url': url_for('job_status', job_id=job_id),
+            'filename': filename,
+            'recipients': len(recipients)
+        }), 202
             
+    except QueueFullError:
+        return jsonify({'error': 'Too many pending jobs. Please retry later.'}), 429
+    except HTTPException as e:
+        return jsonify({'error': e.description}), e.code
     except Exception as e:
-        logger.error(f"API error processing file: {str(e)}")
+        logger.error(f"Batch API error processing file: {str(e)}")
+        return jsonify({'error': f'An error occurred: {str(e)}'}), 500
+
+@app.route('/api/workbooks', methods=['POST'])
+def store_workbook():
+    """
+    Store a workbook under a content-hash handle so it can be sent later
+    without uploading it again. Returns 201, or 200 if the same content was
+    already stored (its expiry is renewed).
+    """
+    try:
+        if 'file' not in request.files:
+            return jsonify({'error': 'No file uploaded'}), 400
+
+        file = request.files['file']
+        if file.filename == '':
+            return jsonify({'error': 'No file selected'}), 400
+
+        if not allowed_file(file.filename):
+            return jsonify({'error': 'Invalid file type. Only .xlsx and .xls files are allowed.'}), 400
+
+        filename, filepath = save_upload(file)
+        # Streamed uploads were hashed as they arrived
+        sha256 = file.stream.sha256 if isinstance(file.stream, StreamedUpload) else None
+        source = resolve_upload(filepath)
+        try:
+            meta, created = workbook_store.put(source, filename, sha256)
+        except WorkbookStoreFull as e:
+            cleanup_files([filepath])
+            return jsonify({'error': str(e)}), 507
+        if is_memory_key(filepath):
+            cleanup_files([filepath])
+
+        logger.info(f"Workbook {filename} stored as {meta['handle']}")
+        return jsonify(dict(meta, send_url=url_for('send_workbook', handle=meta['handle']))), 201 if created else 200
+
+    except HTTPException as e:
+        return jsonify({'error': e.description}), e.code
+    except Exception as e:
+        logger.error(f"API error storing workbook: {str(e)}")
+        return jsonify({'error': f'An error occurred: {str(e)}'}), 500
+
+@app.route('/api/workbooks/<handle>', methods=['GET', 'DELETE'])
+def stored_workbook(handle):
+    """Show or delete a stored workbook"""
+    if not workbook_store.is_handle(handle):
+        return jsonify({'error': 'Invalid workbook handle'}), 400
+    meta = workbook_store.get(handle)
+    if meta is None:
+        return jsonify({'error': 'Workbook not found or expired'}), 404
+    if request.method == 'DELETE':
+        workbook_store.remove(handle)
+        return jsonify({'message': 'Workbook deleted', 'handle': handle})
+    return jsonify(meta)
+
+@app.route('/api/workbooks/<handle>/send', methods=['POST'])
+def send_workbook(handle):
+    """
+    Email a stored workbook to recipients (see parse_recipients) with the
+    same sheet and view options as an upload, returns 202 with a job id.
+    Earlier sends have usually left its scan and screenshots cached.
+    """
+    try:
+        if not workbook_store.is_handle(handle):
+            return jsonify({'error': 'Invalid workbook handle'}), 400
+        meta = workbook_store.get(handle)
+        if meta is None:
+            return jsonify({'error': 'Workbook not found or expired'}), 404
+
+        try:
+            recipients, invalid = parse_recipients(request.form, request.files)
+            selection = parse_sheet_selection(request.form)
+            view = parse_view_options(request.form, selection)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        if invalid:
+            return jsonify({'error': 'Invalid email addresses', 'invalid': invalid}), 400
+
+        if not recipients:
+            return jsonify({'error': 'At least one recipient is required'}), 400
+
+        if len(recipients) > BATCH_MAX_RECIPIENTS:
+            return jsonify({'error': f'Too many recipients. Maximum is {BATCH_MAX_RECIPIENTS}.'}), 400
+
+        job_id = job_queue.submit('batch', {
+            'handle': handle,
+            'filename': meta['filename'],
+            'recipients': recipients,
+            'selection': selection,
+            'view': view
+        })
+
+        return jsonify({
+            'message': 'Stored workbook queued for sending',
+            'job_id': job_id,
+            'status': 'queued',
+            'status_url': url_for('job_status', job_id=job_id),
+            'handle': handle,
+            'filename': meta['filename'],
+            'recipients': len(recipients)
+        }), 202
+
+    except QueueFullError:
+        return jsonify({'error': 'Too many pending jobs. Please retry later.'}), 429
+    except Exception as e:
+        logger.error(f"API error sending stored workbook: {str(e)}")
         return jsonify({'error': f'An error occurred: {str(e)}'}), 500
 
+@app.route('/api/jobs/<job_id>')
+def job_status(job_id):
+    """Status of a queued upload job"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@app.route('/api/cache')
+def cache_stats():
+    """Screenshot cache hit/miss counters"""
+    if not screenshot_cache:
+        return jsonify({'enabled': False})
+    return jsonify(dict(screenshot_cache.stats(), enabled=True))
+
+@app.route('/api/deliveries')
+def delivery_status():
+    """Delivery counters, rate limits and dead letter count for this process"""
+    return jsonify(email_sender.delivery_stats())
+
+@app.route('/api/deliveries/dead-letters')
+def list_dead_letters():
+    """Undelivered emails waiting in the dead letter spool"""
+    letters = email_sender.dead_letters.list()
+    return jsonify({'count': len(letters), 'dead_letters': letters})
+
+@app.route('/api/deliveries/dead-letters/<letter_id>', methods=['GET', 'DELETE'])
+def dead_letter(letter_id):
+    """Show or discard one dead letter"""
+    try:
+        meta = email_sender.dead_letters.get(letter_id)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if meta is None:
+        return jsonify({'error': 'Dead letter not found'}), 404
+    if request.method == 'DELETE':
+        email_sender.dead_letters.remove(letter_id)
+        return jsonify({'message': 'Dead letter discarded', 'id': letter_id})
+    return jsonify(meta)
+
+@app.route('/api/deliveries/dead-letters/replay', methods=['POST'])
+@app.route('/api/deliveries/dead-letters/<letter_id>/replay', methods=['POST'])
+def replay_dead_letters(letter_id=None):
+    """Queue dead letters to be sent again: one, the ids posted, or all of them"""
+    if letter_id is not None:
+        letter_ids = [letter_id]
+    else:
+        body = request.get_json(silent=True) or {}
+        letter_ids = body.get('ids') or request.form.getlist('ids')
+        if not isinstance(letter_ids, list) or not all(isinstance(i, str) for i in letter_ids):
+            return jsonify({'error': 'ids must be a list of dead letter ids'}), 400
+
+    try:
+        if any(email_sender.dead_letters.get(i) is None for i in letter_ids):
+            return jsonify({'error': 'Dead letter not found'}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        job_id = job_queue.submit('replay', {'letter_ids': letter_ids})
+    except QueueFullError:
+        return jsonify({'error': 'Too many pending jobs. Please retry later.'}), 429
+
+    return jsonify({
+        'message': 'Dead letters queued for replay',
+        'job_id': job_id,
+        'status': 'queued',
+        'status_url': url_for('job_status', job_id=job_id),
+        'count': len(letter_ids) or email_sender.dead_letters.count()
+    }), 202
+
+@app.route('/api/startup')
+def startup_report():
+    """Startup phase timings and which heavy modules this worker has loaded"""
+    return jsonify(startup.report())
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus metrics for this process"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/api/health')
 def health_check():
     """Health check endpoint"""
@@ -197,11 +979,40 @@ def health_check():
         'version': '1.0.0'
     })
 
+@app.before_request
+def check_upload_size():
+    """Reject uploads whose declared size is over the endpoint limit before reading the body"""
+    limit = request.upload_limit()
+    if limit and request.content_length and request.content_length > limit + 1024 * 1024:
+        raise RequestEntityTooLarge(f'File too large. Maximum size is {limit / (1024 * 1024):g}MB.')
+
 @app.errorhandler(413)
 def too_large(e):
     """Handle file too large error"""
-    flash('File too large. Maximum size is 16MB.', 'error')
+    limit = request.upload_limit() or MAX_CONTENT_LENGTH
+    message = f'File too large. Maximum size is {limit / (1024 * 1024):g}MB.'
+    if request.path.startswith('/api/'):
+        return jsonify({'error': message}), 413
+    flash(message, 'error')
     return redirect(url_for('index'))
 
+def create_app(preload=None):
+    """
+    Application factory for WSGI servers, e.g. gunicorn 'app:create_app()'.
+    preload (PRELOAD_MODULES) imports the parsing and rendering modules
+    now instead of on first use; in a gunicorn --preload master they are
+    then shared copy-on-write by every forked worker.
+    """
+    if preload is None:
+        preload = os.getenv('PRELOAD_MODULES', 'false').lower() in ('1', 'true', 'yes')
+    if preload and 'preloaded' not in startup.report()['phases']:
+        modules = startup.preload_modules()
+        startup.mark('preloaded')
+        logger.info(f"Preloaded {', '.join(modules)} in {sum(modules.values()):.2f}s")
+    return app
+
+startup.mark('app_ready')
+logger.info(f"App ready in {startup.report()['phases']['app_ready']:.2f}s")
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
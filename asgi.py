@@ -0,0 +1,169 @@
+"""
+ASGI entry point, serving the app on one long-lived event loop:
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+
+Requests are still handled by the Flask views through asgiref's WSGI
+adapter; request bodies are received on the loop, so slow uploads do not
+hold a thread. Queued uploads are processed by job queue tasks on the same
+loop: Playwright renders on the browser pool started on that loop and
+emails go out over aiosmtplib, while parsing, image optimization and other
+blocking work run in the default thread pool.
+"""
+import os
+import json
+import asyncio
+import logging
+
+# Job workers run as tasks on the server loop instead of threads
+os.environ.setdefault('JOB_RUNNER', 'asyncio')
+
+from asgiref.wsgi import WsgiToAsgi
+from app import (app as flask_app, job_queue, browser_pool, parse_pool, excel_processor,
+                 image_optimizer, email_sender, cleanup_files, job_workbook, render_tables,
+                 JobSteps, upload_job_flow, batch_job_flow, MAX_CONTENT_LENGTH)
+
+logger = logging.getLogger(__name__)
+
+# Tasks are cheap, so more uploads can be in flight than with worker threads
+ASYNC_JOB_WORKERS = int(os.getenv('ASYNC_JOB_WORKERS', '16'))
+
+
+async def render_upload_async(filepath, selection=None, view=None, series=None):
+    """Async render_upload: returns (screenshot_paths, captions)"""
+    if not selection:
+        return await excel_processor.process_excel_and_screenshots_async(filepath, view=view, series=series), None
+
+    sheets = await excel_processor.process_excel_sheets_async(filepath, selection, view)
+    if not sheets:
+        return None, None
+    return [path for _, path in sheets], [name for name, _ in sheets]
+
+
+class AsyncJobSteps(JobSteps):
+    """
+    JobSteps for job tasks on the server loop: browser work and email are
+    awaited on the loop, blocking work runs in the default thread pool.
+    """
+
+    async def workbook(self, payload):
+        return await asyncio.to_thread(job_workbook, payload)
+
+    async def tables(self, source, selection, view):
+        return await asyncio.to_thread(render_tables, source, selection, view)
+
+    async def render(self, source, selection, view, series):
+        return await render_upload_async(source, selection, view, series)
+
+    async def optimize(self, screenshot_paths):
+        return await asyncio.to_thread(image_optimizer.optimize, screenshot_paths)
+
+    async def send_tables(self, recipient, tables, filename, captions):
+        return await email_sender.send_email_with_tables_async(recipient, tables, filename, captions)
+
+    async def send_screenshots(self, recipient, screenshot_paths, filename, captions):
+        return await email_sender.send_email_with_screenshot_async(recipient, screenshot_paths, filename, captions)
+
+    async def send_table_batch(self, recipients, tables, filename, captions):
+        return await email_sender.send_table_batch_async(recipients, tables, filename, captions)
+
+    async def send_batch(self, recipients, screenshot_paths, filename, captions):
+        return await email_sender.send_batch_async(recipients, screenshot_paths, filename, captions)
+
+    async def cleanup(self, paths):
+        await asyncio.to_thread(cleanup_files, paths)
+
+
+async def process_upload_job_async(payload):
+    """Async job handler: upload_job_flow on the server loop"""
+    return await upload_job_flow(payload, AsyncJobSteps())
+
+
+async def process_batch_job_async(payload):
+    """Async job handler: batch_job_flow on the server loop"""
+    return await batch_job_flow(payload, AsyncJobSteps())
+
+
+job_queue.register_async('upload', process_upload_job_async)
+job_queue.register_async('batch', process_batch_job_async)
+
+
+class AsgiApp:
+    """
+    Wraps the Flask app for an ASGI server and owns the loop-bound resources
+    through the lifespan protocol: the browser pool and job workers start on
+    the server loop at startup and are shut down with it.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi = WsgiToAsgi(wsgi_app)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+
+        if scope['type'] == 'http' and self._declared_length(scope) > MAX_CONTENT_LENGTH:
+            # The adapter spools the whole body before Flask sees it, reject early
+            await self.reject_too_large(send)
+            return
+
+        await self.wsgi(scope, receive, send)
+
+    @staticmethod
+    def _declared_length(scope):
+        for name, value in scope.get('headers', ()):
+            if name == b'content-length':
+                try:
+                    return int(value)
+                except ValueError:
+                    return 0
+        return 0
+
+    async def reject_too_large(self, send):
+        body = json.dumps({
+            'error': f'File too large. Maximum size is {MAX_CONTENT_LENGTH / (1024 * 1024):g}MB.'
+        }).encode()
+        await send({
+            'type': 'http.response.start',
+            'status': 413,
+            'headers': [(b'content-type', b'application/json'),
+                        (b'content-length', str(len(body)).encode())],
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def startup(self):
+        if browser_pool:
+            try:
+                await browser_pool.start_async()
+            except Exception as e:
+                # The pool is started again on the first render
+                logger.error(f"Failed to start browser pool: {e}")
+        await job_queue.start_async(ASYNC_JOB_WORKERS)
+
+    async def shutdown(self):
+        await job_queue.stop_async(timeout=30)
+        if browser_pool:
+            await browser_pool.close_async()
+        if parse_pool:
+            await asyncio.to_thread(parse_pool.close)
+        await email_sender.close_async()
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.startup()
+                except Exception as e:
+                    logger.error(f"ASGI startup failed: {e}")
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+app = AsgiApp(flask_app)
@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+"""
+Benchmark harness for the Excel-to-email pipeline
+
+Generates synthetic workbooks, times each pipeline stage on its own and the
+whole pipeline end to end against a local SMTP sink, and writes latency
+percentiles, throughput and peak RSS to JSON for comparison across commits:
+
+    python benchmark.py --sizes 10,1000,100000 --output before.json
+    python benchmark.py --sizes 10,1000,100000 --output after.json --compare before.json
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import socket
+import argparse
+import datetime
+import platform
+import resource
+import subprocess
+import socketserver
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+SHAPES = {
+    # name: (columns, merged header blocks)
+    'narrow': (8, False),
+    'wide': (150, False),
+    'merged': (8, True),
+}
+STAGES = ('scan', 'render', 'optimize', 'email', 'end_to_end')
+XLS_MAX_ROWS = 65535
+
+
+def generate_workbook(path, shape, rows, seed=1234):
+    """
+    Write a workbook with a header row and rows of mixed ints, floats, text
+    and dates. Identical arguments always produce identical cell values.
+    """
+    columns, merged = SHAPES[shape]
+    rng = random.Random(seed)
+    start = datetime.datetime(2024, 1, 1)
+
+    def cell(row, col):
+        kind = col % 4
+        if kind == 0:
+            return row
+        if kind == 1:
+            return round(rng.uniform(0, 10000), 2)
+        if kind == 2:
+            return f"item-{rng.randrange(10 ** 6):06d}"
+        return start + datetime.timedelta(hours=row)
+
+    header = [f"Column {col + 1}" for col in range(columns)]
+
+    if path.endswith('.xls'):
+        import xlwt
+
+        book = xlwt.Workbook()
+        sheet = book.add_sheet('Sheet1')
+        date_style = xlwt.easyxf(num_format_str='yyyy-mm-dd hh:mm')
+        for col, title in enumerate(header):
+            sheet.write(0, col, title)
+        for row in range(1, rows + 1):
+            for col in range(columns):
+                value = cell(row, col)
+                if isinstance(value, datetime.datetime):
+                    sheet.write(row, col, value, date_style)
+                else:
+                    sheet.write(row, col, value)
+        if merged:
+            for row in range(1, rows + 1, 50):
+                sheet.merge(row, row, 0, 2)
+        book.save(path)
+        return
+
+    import openpyxl
+
+    if merged:
+        # Merged ranges need a regular (in-memory) workbook
+        book = openpyxl.Workbook()
+        sheet = book.active
+        sheet.append(header)
+        for row in range(1, rows + 1):
+            sheet.append([cell(row, col) for col in range(columns)])
+        for row in range(2, rows + 2, 50):
+            sheet.merge_cells(start_row=row, start_column=1, end_row=row, end_column=3)
+    else:
+        book = openpyxl.Workbook(write_only=True)
+        sheet = book.create_sheet()
+        sheet.append(header)
+        for row in range(1, rows + 1):
+            sheet.append([cell(row, col) for col in range(columns)])
+    book.save(path)
+
+
+class _SinkHandler(socketserver.StreamRequestHandler):
+    """Accepts every message and throws it away"""
+
+    def handle(self):
+        self.wfile.write(b'220 benchmark sink\r\n')
+        in_data = False
+        for line in self.rfile:
+            if in_data:
+                if line in (b'.\r\n', b'.\n'):
+                    in_data = False
+                    self.server.messages += 1
+                    self.wfile.write(b'250 OK\r\n')
+                continue
+
+            command = line[:4].upper()
+            if command == b'EHLO':
+                self.wfile.write(b'250-benchmark sink\r\n250 8BITMIME\r\n')
+            elif command == b'DATA':
+                in_data = True
+                self.wfile.write(b'354 End data with <CR><LF>.<CR><LF>\r\n')
+            elif command == b'QUIT':
+                self.wfile.write(b'221 Bye\r\n')
+                return
+            else:
+                self.wfile.write(b'250 OK\r\n')
+
+
+def start_smtp_sink():
+    """Start the SMTP sink on a free local port, returns the server"""
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), _SinkHandler)
+    server.daemon_threads = True
+    server.messages = 0
+    threading.Thread(target=server.serve_forever, name='smtp-sink', daemon=True).start()
+    return server
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def summarize(samples):
+    return {
+        'p50': round(percentile(samples, 50) * 1000, 3),
+        'p95': round(percentile(samples, 95) * 1000, 3),
+        'p99': round(percentile(samples, 99) * 1000, 3),
+        'mean': round(sum(samples) / len(samples) * 1000, 3),
+        'min': round(min(samples) * 1000, 3),
+        'max': round(max(samples) * 1000, 3),
+    }
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def run_case(workbook, stage, iterations, warmup, workdir):
+    """
+    Time one stage on one workbook, returns the result dict.
+    Run in a fresh process per case so peak RSS belongs to that case alone.
+    """
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+
+    from sheet_scanner import scan_sheet
+    from excel_processor import ExcelProcessor
+    from image_optimizer import ImageOptimizer
+    from email_sender import EmailSender
+
+    processor = ExcelProcessor()
+    optimizer = ImageOptimizer()
+    sender = EmailSender()
+
+    def render(scan, prefix):
+        tiles = processor.plan_tiles(scan)
+        paths = [os.path.join(workdir, f"{prefix}_{i}.png") for i in range(len(tiles))]
+        if not processor.select_renderer(scan).render(scan, tiles, paths, processor.footer_note(scan)):
+            raise RuntimeError('render failed')
+        return paths
+
+    def cleanup(paths):
+        for path in paths or []:
+            if os.path.exists(path):
+                os.remove(path)
+
+    # Inputs for the stages that start from an earlier stage's output
+    scan = None
+    rendered = None
+    if stage in ('render', 'optimize', 'email'):
+        scan = scan_sheet(workbook, processor.max_rows, processor.max_cols)
+    if stage in ('optimize', 'email'):
+        rendered = render(scan, 'input')
+        if stage == 'email':
+            rendered = optimizer.optimize(rendered)
+
+    def run_once(index):
+        if stage == 'scan':
+            scan_sheet(workbook, processor.max_rows, processor.max_cols)
+        elif stage == 'render':
+            cleanup(render(scan, f"render_{index}"))
+        elif stage == 'optimize':
+            copies = []
+            for i, path in enumerate(rendered):
+                copies.append(os.path.join(workdir, f"optimize_{index}_{i}.png"))
+                shutil.copyfile(path, copies[-1])
+            cleanup(optimizer.optimize(copies))
+        elif stage == 'email':
+            if not sender.send_email_with_screenshot('bench@localhost', rendered, os.path.basename(workbook)):
+                raise RuntimeError('send failed')
+        else:
+            copy = os.path.join(workdir, f"upload_{index}_{os.path.basename(workbook)}")
+            shutil.copyfile(workbook, copy)
+            paths = None
+            try:
+                paths = processor.process_excel_and_screenshots(copy)
+                if not paths:
+                    raise RuntimeError('render failed')
+                paths = optimizer.optimize(paths)
+                if not sender.send_email_with_screenshot('bench@localhost', paths, os.path.basename(workbook)):
+                    raise RuntimeError('send failed')
+            finally:
+                cleanup([copy] + (paths or []))
+
+    samples = []
+    errors = 0
+    last_error = None
+    for index in range(warmup + iterations):
+        start = time.perf_counter()
+        try:
+            run_once(index)
+        except Exception as e:
+            errors += 1
+            last_error = str(e)
+            continue
+        if index >= warmup:
+            samples.append(time.perf_counter() - start)
+
+    cleanup(rendered)
+
+    result = {
+        'stage': stage,
+        'iterations': len(samples),
+        'errors': errors,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    if last_error:
+        result['error'] = last_error
+    if samples:
+        total = sum(samples)
+        result['latency_ms'] = summarize(samples)
+        result['throughput_per_s'] = round(len(samples) / total, 3)
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    """Print the p50 change of every case also present in the baseline"""
+    with open(baseline_path) as f:
+        baseline = {(r['workbook'], r['stage']): r for r in json.load(f)['results']}
+
+    print(f"\nChange in p50 latency against {baseline_path}:")
+    for result in results:
+        before = baseline.get((result['workbook'], result['stage']))
+        if not before or 'latency_ms' not in before or 'latency_ms' not in result:
+            continue
+        old, new = before['latency_ms']['p50'], result['latency_ms']['p50']
+        change = (new - old) / old * 100 if old else 0.0
+        print(f"  {result['workbook']:<24} {result['stage']:<11} {old:>10.1f} -> {new:>10.1f} ms ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='10,1000,10000',
+                        help='comma separated data row counts, e.g. 10,1000,100000,1000000')
+    parser.add_argument('--shapes', default=','.join(SHAPES), help='comma separated workbook shapes')
+    parser.add_argument('--formats', default='xlsx,xls', help='xlsx and/or xls (xls needs xlwt)')
+    parser.add_argument('--stages', default=','.join(STAGES), help='comma separated stages to time')
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--renderer', default=None, help='override RENDERER (auto, pillow, playwright)')
+    parser.add_argument('--data-dir', default='benchmark_data', help='where generated workbooks are kept')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', default=None, help='earlier results JSON to compare against')
+    parser.add_argument('--no-isolate', action='store_true',
+                        help='run every case in this process (faster, but peak RSS accumulates)')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    shapes = args.shapes.split(',')
+    formats = args.formats.split(',')
+    stages = args.stages.split(',')
+
+    if 'xls' in formats:
+        try:
+            import xlwt  # noqa: F401
+        except ImportError:
+            print("xlwt is not installed, skipping .xls workbooks (pip install xlwt)")
+            formats = [fmt for fmt in formats if fmt != 'xls']
+
+    data_dir = os.path.abspath(args.data_dir)
+    os.makedirs(data_dir, exist_ok=True)
+    work_root = os.path.join(data_dir, 'work')
+
+    # Emails go to a local sink, never to a real server. Rate limits and
+    # retries are off so the email stages measure delivery, not throttling
+    sink = start_smtp_sink()
+    os.environ.update({
+        'SMTP_SERVER': '127.0.0.1',
+        'SMTP_PORT': str(sink.server_address[1]),
+        'SMTP_USE_TLS': 'false',
+        'SENDER_EMAIL': 'benchmark@localhost',
+        'SENDER_PASSWORD': '',
+        'SMTP_RATE_PER_SECOND': '0',
+        'SMTP_DOMAIN_RATE_PER_SECOND': '0',
+        'SMTP_MAX_ATTEMPTS': '1',
+        'DEAD_LETTER_DIR': os.path.join(work_root, 'dead_letters'),
+    })
+    if args.renderer:
+        os.environ['RENDERER'] = args.renderer
+
+    results = []
+    for fmt in formats:
+        for shape in shapes:
+            for rows in sizes:
+                if fmt == 'xls' and rows > XLS_MAX_ROWS:
+                    print(f"Skipping {shape} {rows} rows as .xls (limit is {XLS_MAX_ROWS} rows)")
+                    continue
+
+                name = f"{shape}_{rows}.{fmt}"
+                workbook = os.path.join(data_dir, name)
+                if not os.path.exists(workbook):
+                    print(f"Generating {name}...")
+                    start = time.perf_counter()
+                    generate_workbook(workbook, shape, rows)
+                    print(f"  done in {time.perf_counter() - start:.1f}s")
+
+                for stage in stages:
+                    workdir = os.path.join(work_root, f"{name}_{stage}")
+                    case = (workbook, stage, args.iterations, args.warmup, workdir)
+                    if args.no_isolate:
+                        cwd = os.getcwd()
+                        try:
+                            result = run_case(*case)
+                        finally:
+                            os.chdir(cwd)
+                    else:
+                        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                            result = executor.submit(run_case, *case).result()
+
+                    result = dict({
+                        'workbook': name,
+                        'shape': shape,
+                        'rows': rows,
+                        'format': fmt,
+                        'file_bytes': os.path.getsize(workbook),
+                    }, **result)
+                    results.append(result)
+
+                    latency = result.get('latency_ms')
+                    summary = (f"p50 {latency['p50']:.1f}ms p95 {latency['p95']:.1f}ms "
+                               f"p99 {latency['p99']:.1f}ms {result['throughput_per_s']}/s"
+                               if latency else f"failed: {result.get('error')}")
+                    print(f"{name:<24} {stage:<11} {summary} rss {result['peak_rss_mb']}MB")
+
+    shutil.rmtree(work_root, ignore_errors=True)
+    sink.shutdown()
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'hostname': socket.gethostname(),
+            'renderer': os.getenv('RENDERER', 'auto'),
+            'iterations': args.iterations,
+            'warmup': args.warmup,
+            'isolated': not args.no_isolate,
+            'emails_received': sink.messages,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+import os
+import atexit
+import asyncio
+import logging
+import threading
+import concurrent.futures
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class _BrowserSlot:
+    """One warm Chromium instance with a reusable context and page"""
+
+    def __init__(self, index):
+        self.index = index
+        self.browser = None
+        self.context = None
+        self.page = None
+        self.renders = 0
+
+    def is_healthy(self):
+        return (self.browser is not None
+                and self.browser.is_connected()
+                and self.page is not None
+                and not self.page.is_closed())
+
+    async def close(self):
+        browser = self.browser
+        self.browser = None
+        self.context = None
+        self.page = None
+        self.renders = 0
+        if browser is not None:
+            try:
+                await browser.close()
+            except Exception as e:
+                logger.warning(f"Error closing browser slot {self.index}: {e}")
+
+
+class BrowserPool:
+    """
+    Pool of long-lived headless Chromium browsers for screenshot rendering.
+
+    Playwright objects are bound to the event loop that created them, so the
+    pool owns a dedicated event loop running on a daemon thread. Callers submit
+    coroutines with run() and borrow a page inside them with page().
+    The pool is started lazily on first use so it is safe to create before
+    gunicorn forks its workers.
+
+    Under an ASGI server the pool can instead be started on the server's own
+    loop with start_async(), so renders run alongside request handling with
+    no extra thread.
+    """
+
+    def __init__(self, size=None, max_renders=None, viewport=None):
+        self.size = size or int(os.getenv('BROWSER_POOL_SIZE', '2'))
+        self.max_renders = max_renders or int(os.getenv('BROWSER_MAX_RENDERS', '100'))
+        self.viewport = viewport or {"width": 1200, "height": 800}
+
+        self._loop = None
+        self._thread = None
+        self._playwright = None
+        self._slots = None
+        self._all_slots = []
+        self._start_lock = threading.Lock()
+        self._starting = None
+
+    def start(self):
+        """Start the event loop thread and launch the warm browsers"""
+        with self._start_lock:
+            if self._loop is not None:
+                return
+
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name='browser-pool', daemon=True)
+            thread.start()
+
+            try:
+                asyncio.run_coroutine_threadsafe(self._start_async(), loop).result()
+            except Exception:
+                loop.call_soon_threadsafe(loop.stop)
+                thread.join()
+                loop.close()
+                raise
+
+            self._loop = loop
+            self._thread = thread
+            atexit.register(self.close)
+            logger.info(f"Browser pool started with {self.size} browser(s)")
+
+    async def start_async(self):
+        """Start the pool on the running event loop instead of a thread of its own"""
+        with self._start_lock:
+            if self._loop is not None:
+                return
+            starting = self._starting
+            if starting is None:
+                starting = self._starting = concurrent.futures.Future()
+                launching = True
+            else:
+                launching = False
+
+        if not launching:
+            # Another caller is launching the browsers, wait until the slots exist
+            await asyncio.wrap_future(starting)
+            return
+
+        try:
+            await self._start_async()
+        except BaseException as e:
+            with self._start_lock:
+                self._starting = None
+            starting.set_exception(e)
+            raise
+
+        # Published only once the slots exist, run_async() borrows pages as soon as it is set
+        with self._start_lock:
+            self._loop = asyncio.get_running_loop()
+            self._starting = None
+        starting.set_result(None)
+        logger.info(f"Browser pool started with {self.size} browser(s) on the running loop")
+
+    async def _start_async(self):
+        # Imported on first start, it is not needed until something is rendered
+        from playwright.async_api import async_playwright
+        self._playwright = await async_playwright().start()
+        self._slots = asyncio.Queue()
+        self._all_slots = [_BrowserSlot(i) for i in range(self.size)]
+
+        for slot in self._all_slots:
+            try:
+                await self._ensure_healthy(slot)
+            except Exception as e:
+                # A slot that fails to warm up is retried when it is borrowed
+                logger.error(f"Failed to launch browser slot {slot.index}: {e}")
+            self._slots.put_nowait(slot)
+
+    async def _ensure_healthy(self, slot):
+        """Health-check a slot, relaunching its browser if it crashed or was recycled"""
+        if slot.is_healthy():
+            return
+
+        if slot.browser is not None:
+            logger.warning(f"Browser slot {slot.index} is unhealthy, relaunching")
+            await slot.close()
+
+        slot.browser = await self._playwright.chromium.launch(headless=True)
+        slot.context = await slot.browser.new_context(viewport=self.viewport)
+        slot.page = await slot.context.new_page()
+        slot.renders = 0
+        logger.debug(f"Browser slot {slot.index} launched")
+
+    @asynccontextmanager
+    async def page(self):
+        """
+        Borrow a warm page from the pool.
+        Must be used from a coroutine running on the pool loop (see run()
+        and run_async()).
+        """
+        slot = await self._slots.get()
+        try:
+            await self._ensure_healthy(slot)
+            yield slot.page
+        except BaseException:
+            # The page may be left in an unknown state, start it fresh next time
+            await slot.close()
+            raise
+        else:
+            slot.renders += 1
+            if slot.renders >= self.max_renders:
+                logger.info(f"Recycling browser slot {slot.index} after {slot.renders} renders")
+                await slot.close()
+        finally:
+            self._slots.put_nowait(slot)
+
+    def run(self, coro, timeout=None):
+        """Run a coroutine on the pool loop and wait for its result"""
+        self.start()
+        if self._thread is None:
+            raise RuntimeError("Browser pool runs on an async server loop, use run_async()")
+        future = asyncio.run_coroutine_threadsafe(coro, self._loop)
+        return future.result(timeout)
+
+    async def run_async(self, coro):
+        """
+        Await a coroutine on the pool loop from a coroutine on any loop.
+        Runs it directly when the caller is already on the pool loop.
+        """
+        if self._loop is None:
+            await self.start_async()
+        if self._loop is asyncio.get_running_loop():
+            return await coro
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self._loop))
+
+    def stats(self):
+        """Return a snapshot of pool usage"""
+        if self._loop is None:
+            return {'started': False, 'size': self.size}
+
+        return {
+            'started': True,
+            'size': self.size,
+            'idle': self._slots.qsize(),
+            'healthy': sum(1 for slot in self._all_slots if slot.is_healthy()),
+            'renders': [slot.renders for slot in self._all_slots],
+        }
+
+    async def _close_async(self):
+        for slot in self._all_slots:
+            await slot.close()
+        if self._playwright is not None:
+            await self._playwright.stop()
+            self._playwright = None
+
+    async def close_async(self):
+        """Close all browsers of a pool started with start_async()"""
+        with self._start_lock:
+            if self._loop is None:
+                return
+            self._loop = None
+
+        try:
+            await self._close_async()
+        except Exception as e:
+            logger.warning(f"Error shutting down browser pool: {e}")
+        logger.info("Browser pool closed")
+
+    def close(self):
+        """Close all browsers and stop the pool loop"""
+        with self._start_lock:
+            if self._loop is None:
+                return
+            if self._thread is None:
+                logger.warning("Browser pool runs on an async server loop, use close_async()")
+                return
+            loop = self._loop
+            self._loop = None
+
+        try:
+            asyncio.run_coroutine_threadsafe(self._close_async(), loop).result(timeout=30)
+        except Exception as e:
+            logger.warning(f"Error shutting down browser pool: {e}")
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            self._thread.join(timeout=5)
+            self._thread = None
+            logger.info("Browser pool closed")
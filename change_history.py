@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import zlib
+import hashlib
+import logging
+import threading
+from sheet_scanner import pad_row
+
+logger = logging.getLogger(__name__)
+
+# Rows per block of column hashes
+BLOCK_ROWS = 32
+
+
+def _encoded_rows(scan, num_cols, start=0, end=None):
+    """The cells of scan rows as bytes, padded to num_cols"""
+    for row in scan.rows[start:end]:
+        yield [repr(value).encode() + b'\0' for value in pad_row(row, num_cols)]
+
+
+def _column_hashes(cell_rows, num_cols):
+    columns = [0] * num_cols
+    for cells in cell_rows:
+        for col, cell in enumerate(cells):
+            columns[col] = zlib.crc32(cell, columns[col])
+    return columns
+
+
+class ChangeHistory:
+    """
+    Hashes of the last version of a recurring report, per series (a file
+    name and its recipients), so the next version can highlight the cells
+    that changed. Each row has a hash, and so does each column within every
+    block of BLOCK_ROWS rows; a changed cell is in a changed row and in a
+    column that changed within its block. That is exact unless a block has
+    edits in several rows and columns, which also marks the cells where
+    they cross. Each series is one JSON file named by the hash of its
+    identity, growing with the rows rather than the cells. The version
+    before the last is kept too, so sending the same version again
+    highlights the same cells. Series not rendered for ttl seconds are
+    dropped.
+    """
+
+    def __init__(self, directory=None, ttl=None):
+        self.directory = directory or os.getenv('CHANGE_HISTORY_DIR', 'change_history')
+        self.ttl = ttl or int(os.getenv('CHANGE_HISTORY_TTL', str(30 * 86400)))
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, series):
+        return os.path.join(self.directory, f"{hashlib.sha256(series.encode()).hexdigest()}.json")
+
+    @staticmethod
+    def hashes(scan):
+        """CRC32 of every row of a scan and of every column within each block of rows"""
+        num_cols = max(scan.last_col, 1)
+        rows = [zlib.crc32(b''.join(cells)) for cells in _encoded_rows(scan, num_cols)]
+        blocks = [_column_hashes(_encoded_rows(scan, num_cols, start, start + BLOCK_ROWS), num_cols)
+                  for start in range(0, len(scan.rows), BLOCK_ROWS)]
+        return rows, blocks
+
+    def _load(self, series):
+        try:
+            with open(self._path(series)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _save(self, series, record):
+        path = self._path(series)
+        with open(f"{path}.{os.getpid()}.tmp", 'w') as f:
+            json.dump(record, f)
+        os.replace(f"{path}.{os.getpid()}.tmp", path)
+
+    def _prune(self):
+        """Drop series that have not been rendered within the ttl"""
+        cutoff = time.time() - self.ttl
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def changed_cells(self, series, scan):
+        """
+        Cells of the scan that differ from the previous version rendered for
+        the series, as a set of (row, col) with row 0 the header; empty for
+        the first version. Records the scan as the series' latest version.
+        """
+        rows, blocks = self.hashes(scan)
+        version = hashlib.sha256(json.dumps([rows, blocks]).encode()).hexdigest()
+
+        with self._lock:
+            record = self._load(series)
+            if record is not None and record['version'] == version:
+                previous = record.get('previous')
+                os.utime(self._path(series))
+            else:
+                previous = None
+                if record is not None and 'blocks' in record:
+                    previous = {name: record[name] for name in ('version', 'rows', 'blocks')}
+                self._save(series, {'version': version, 'rows': rows, 'blocks': blocks, 'previous': previous})
+                self._prune()
+
+        if not previous:
+            return set()
+
+        old_rows, old_blocks = previous['rows'], previous['blocks']
+        num_cols = max(scan.last_col, 1)
+        block_columns = {}
+
+        def changed_columns(block):
+            """Columns that changed within a block, all of them if none did (a hash collision)"""
+            if block not in block_columns:
+                start = block * BLOCK_ROWS
+                new = blocks[block]
+                if len(rows) > len(old_rows) and start < len(old_rows) < start + BLOCK_ROWS:
+                    # The old last block was partial, compare it over the rows it had
+                    new = _column_hashes(_encoded_rows(scan, num_cols, start, len(old_rows)), num_cols)
+                old = old_blocks[block] if block < len(old_blocks) else []
+                block_columns[block] = [col for col, value in enumerate(new)
+                                        if col >= len(old) or old[col] != value] or range(num_cols)
+            return block_columns[block]
+
+        changed = set()
+        for row, value in enumerate(rows):
+            if row >= len(old_rows):
+                # A new row is new in every column
+                changed.update((row, col) for col in range(num_cols))
+            elif old_rows[row] != value:
+                changed.update((row, col) for col in changed_columns(row // BLOCK_ROWS))
+        logger.info(f"{len(changed)} cells changed since the previous version")
+        return changed
@@ -0,0 +1,245 @@
+import os
+import re
+import json
+import time
+import uuid
+import random
+import smtplib
+import logging
+import threading
+from smtp_pool import SMTPPoolTimeout, message_bytes
+
+logger = logging.getLogger(__name__)
+
+TRANSIENT = 'transient'
+PERMANENT = 'permanent'
+
+_LETTER_ID = re.compile(r'^[0-9a-f]{32}$')
+
+
+def smtp_code(error):
+    """The SMTP reply code behind an smtplib or aiosmtplib error, or None"""
+    code = getattr(error, 'smtp_code', None) or getattr(error, 'code', None)
+    if isinstance(code, int):
+        return code
+
+    # Every recipient refused: smtplib keeps {address: (code, message)},
+    # aiosmtplib a list of per-recipient errors
+    recipients = getattr(error, 'recipients', None)
+    if isinstance(recipients, dict):
+        codes = [reply[0] for reply in recipients.values()]
+    elif isinstance(recipients, list):
+        codes = [getattr(r, 'code', None) for r in recipients]
+    else:
+        return None
+    codes = [c for c in codes if isinstance(c, int)]
+    # One hard bounce is enough for the send to be permanent
+    return max(codes) if codes else None
+
+
+def classify_error(error):
+    """
+    TRANSIENT for errors worth retrying: 4xx replies, dropped connections,
+    timeouts and an exhausted connection pool. PERMANENT for 5xx replies
+    and anything else, which would fail again the same way.
+    """
+    code = smtp_code(error)
+    if code is not None:
+        return TRANSIENT if 400 <= code < 500 else PERMANENT
+    if isinstance(error, (smtplib.SMTPServerDisconnected, SMTPPoolTimeout)):
+        return TRANSIENT
+    # smtplib's errors are all OSErrors, only network ones are worth retrying
+    if isinstance(error, smtplib.SMTPException):
+        return PERMANENT
+    # aiosmtplib's disconnect and timeout errors are ConnectionError/TimeoutError too
+    if isinstance(error, OSError):
+        return TRANSIENT
+    return PERMANENT
+
+
+class TokenBucket:
+    """
+    Allows rate sends per second on average with bursts of up to burst.
+    reserve() takes a token and returns how long the caller must wait
+    before using it, so threads and coroutines can share one bucket.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def is_full(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return self.tokens >= self.burst
+
+
+class RateLimiter:
+    """
+    Token buckets per sending SMTP account and per recipient domain, so a
+    large batch stays under the provider's sending rate and does not flood
+    a single receiving domain. A rate of 0 disables that limit.
+    """
+
+    def __init__(self, account_rate=None, account_burst=None, domain_rate=None, domain_burst=None):
+        self.account_rate = float(account_rate if account_rate is not None
+                                  else os.getenv('SMTP_RATE_PER_SECOND', '5'))
+        self.account_burst = float(account_burst or os.getenv('SMTP_RATE_BURST', '10'))
+        self.domain_rate = float(domain_rate if domain_rate is not None
+                                 else os.getenv('SMTP_DOMAIN_RATE_PER_SECOND', '2'))
+        self.domain_burst = float(domain_burst or os.getenv('SMTP_DOMAIN_RATE_BURST', '5'))
+
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self.waited_seconds = 0.0
+        self.throttled = 0
+
+    def _bucket(self, key, rate, burst):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= 10000:
+                    # Full buckets carry no state, drop them rather than grow forever
+                    self._buckets = {k: b for k, b in self._buckets.items() if not b.is_full()}
+                bucket = self._buckets[key] = TokenBucket(rate, burst)
+            return bucket
+
+    def reserve(self, account, recipient):
+        """Take a token for one message, returns the seconds to wait before sending it"""
+        wait = 0.0
+        if self.account_rate > 0:
+            wait = self._bucket(('account', account), self.account_rate, self.account_burst).reserve()
+        if self.domain_rate > 0:
+            domain = recipient.rpartition('@')[2].lower()
+            wait = max(wait, self._bucket(('domain', domain), self.domain_rate, self.domain_burst).reserve())
+        if wait > 0:
+            with self._lock:
+                self.throttled += 1
+                self.waited_seconds += wait
+        return wait
+
+    def stats(self):
+        with self._lock:
+            return {
+                'account_rate': self.account_rate,
+                'domain_rate': self.domain_rate,
+                'throttled': self.throttled,
+                'waited_seconds': round(self.waited_seconds, 3),
+            }
+
+
+class RetryPolicy:
+    """Exponential backoff with jitter for transient delivery failures"""
+
+    def __init__(self, max_attempts=None, base_delay=None, max_delay=None):
+        self.max_attempts = max_attempts or int(os.getenv('SMTP_MAX_ATTEMPTS', '4'))
+        self.base_delay = base_delay or float(os.getenv('SMTP_RETRY_BASE_SECONDS', '1'))
+        self.max_delay = max_delay or float(os.getenv('SMTP_RETRY_MAX_SECONDS', '30'))
+
+    def delay(self, attempt):
+        """Seconds to wait after the given failed attempt (1-based)"""
+        # Jitter spreads out retries of a batch that failed together
+        return min(self.max_delay, self.base_delay * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+
+
+class DeadLetterSpool:
+    """
+    Messages that could not be delivered, kept on disk so they can be
+    replayed once the cause is fixed. Each letter is the serialized message
+    (<id>.eml) plus its envelope and last error (<id>.json); the JSON is
+    written last, so a letter is only listed once both files are complete.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory or os.getenv('DEAD_LETTER_DIR', 'dead_letters')
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, letter_id, extension):
+        if not _LETTER_ID.match(letter_id):
+            raise ValueError(f"Invalid dead letter id: {letter_id}")
+        return os.path.join(self.directory, f"{letter_id}.{extension}")
+
+    def _write_meta(self, meta):
+        path = self._path(meta['id'], 'json')
+        with open(f"{path}.tmp", 'w') as f:
+            json.dump(meta, f)
+        os.replace(f"{path}.tmp", path)
+
+    def add(self, sender, recipient, message, error, kind, attempts):
+        """Spool a message, returns its id"""
+        letter_id = uuid.uuid4().hex
+        message = message_bytes(message)
+        with open(self._path(letter_id, 'eml'), 'wb') as f:
+            f.write(message.encode('utf-8') if isinstance(message, str) else message)
+        self._write_meta({
+            'id': letter_id,
+            'sender': sender,
+            'recipient': recipient,
+            'error': str(error),
+            'kind': kind,
+            'attempts': attempts,
+            'replays': 0,
+            'failed_at': time.time(),
+        })
+        logger.warning(f"Spooled undeliverable email to {recipient} as dead letter {letter_id}")
+        return letter_id
+
+    def get(self, letter_id):
+        """Envelope and error of a letter, or None if it does not exist"""
+        try:
+            with open(self._path(letter_id, 'json')) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def message(self, letter_id):
+        """The serialized message as bytes"""
+        with open(self._path(letter_id, 'eml'), 'rb') as f:
+            return f.read()
+
+    def list(self):
+        """All letters, oldest first"""
+        letters = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                meta = self.get(name[:-len('.json')])
+                if meta is not None:
+                    letters.append(meta)
+        return sorted(letters, key=lambda meta: meta['failed_at'])
+
+    def count(self):
+        return sum(1 for name in os.listdir(self.directory) if name.endswith('.json'))
+
+    def record_failure(self, letter_id, error, kind, attempts):
+        """Update a letter after a failed replay"""
+        meta = self.get(letter_id)
+        if meta is None:
+            return
+        meta.update(error=str(error), kind=kind, attempts=meta['attempts'] + attempts,
+                    replays=meta.get('replays', 0) + 1, failed_at=time.time())
+        self._write_meta(meta)
+
+    def remove(self, letter_id):
+        """Delete a letter, returns False if it did not exist"""
+        try:
+            os.remove(self._path(letter_id, 'json'))
+        except FileNotFoundError:
+            return False
+        try:
+            os.remove(self._path(letter_id, 'eml'))
+        except FileNotFoundError:
+            pass
+        return True
@@ -5,9 +5,21 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.image import MIMEImage
 import base64
+import html
+import time
+import asyncio
+import threading
+import email.policy
+from concurrent.futures import ThreadPoolExecutor
+from smtp_pool import SMTPConnectionPool, AsyncSMTPConnectionPool
+from delivery import RateLimiter, RetryPolicy, DeadLetterSpool, classify_error, TRANSIENT, PERMANENT
+from metrics import track
+from memory_files import read_file, file_name
 
 logger = logging.getLogger(__name__)
 
+IMAGE_SUBTYPES = {'.png': 'png', '.jpg': 'jpeg', '.jpeg': 'jpeg', '.webp': 'webp'}
+
 
 class EmailSender:
 
@@ -26,59 +38,384 @@ class EmailSender:
             )
             # Don't raise error to allow app to start, just log warning
 
+        # Limits for embedded screenshots (tiled sheets produce several)
+        self.max_images = int(os.getenv('EMAIL_MAX_IMAGES', '20'))
+        self.max_email_bytes = int(float(os.getenv('EMAIL_MAX_MB', '20')) * 1024 * 1024)
+
+        # Persistent connections shared by all sends from this sender
+        self.smtp_pool = SMTPConnectionPool(
+            self.smtp_server,
+            self.smtp_port,
+            self.sender_email,
+            self.sender_password
+        )
+        # aiosmtplib pool for the ASGI server, created on first async send
+        self._async_smtp_pool = None
+
+        # Every send is rate limited and retried; what still fails is spooled for replay
+        self.rate_limiter = RateLimiter()
+        self.retry_policy = RetryPolicy()
+        self.dead_letters = DeadLetterSpool()
+        self._counts_lock = threading.Lock()
+        self.delivery_counts = {'sent': 0, 'retried': 0, 'failed': 0, 'dead_lettered': 0, 'replayed': 0}
+
+    def build_screenshot_message(self, screenshot_paths, original_filename, captions=None):
+        """
+        Build the MIME message with the screenshot(s) embedded in the body.
+        Accepts a single path or a list of tile paths; tiles are embedded in
+        order until max_images or the max_email_bytes budget is reached.
+        captions optionally gives a heading per image (e.g. the sheet name).
+        The To header is left for the caller so one message can be reused.
+        """
+        with track('email_build'):
+            return self._build_screenshot_message(screenshot_paths, original_filename, captions)
+
+    def _build_screenshot_message(self, screenshot_paths, original_filename, captions=None):
+        if not isinstance(screenshot_paths, (list, tuple)):
+            screenshot_paths = [screenshot_paths]
+
+        # Create message
+        msg = MIMEMultipart('related')
+        msg['From'] = f"{self.sender_name} <{self.sender_email}>"
+        msg['Subject'] = f"Excel Screenshot: {original_filename}"
+
+        # Read screenshots, base64 grows each image by a third
+        images = []
+        total_bytes = 0
+        for index, path in enumerate(screenshot_paths[:self.max_images]):
+            img_data = read_file(path)
+            encoded_size = len(img_data) * 4 // 3
+            if images and total_bytes + encoded_size > self.max_email_bytes:
+                break
+            total_bytes += encoded_size
+            content_id = 'screenshot' if index == 0 else f'screenshot-{index}'
+            images.append((content_id, img_data, IMAGE_SUBTYPES.get(os.path.splitext(file_name(path))[1].lower(), 'png')))
+
+        omitted = len(screenshot_paths) - len(images)
+        if omitted:
+            logger.warning(f"Omitting {omitted} screenshot(s) to stay within the email size limit")
+
+        img_tags = "\n".join(
+            (f'<h3>{html.escape(str(captions[index]))}</h3>' if captions else '')
+            + f'<img src="cid:{content_id}" alt="Excel Screenshot" style="max-width: 100%; height: auto; border: 1px solid #ddd;"><br>'
+            for index, (content_id, _, _) in enumerate(images)
+        )
+        omitted_note = (
+            f"<p><em>{omitted} more part(s) of this sheet were not included to keep the email within size limits.</em></p>"
+            if omitted else ""
+        )
+
+        # Create HTML body with embedded image
+        html_body = f"""
+        <html>
+        <head></head>
+        <body>
+            <h2>Excel File Screenshot</h2>
+            <p>Hello,</p>
+            <p>Please find below the screenshot of the Excel file content for: <strong>{original_filename}</strong></p>
+            <br>
+            {img_tags}
+            {omitted_note}
+            <br><br>
+            
+        </body>
+        </html>
+        """
+
+        # Attach HTML body
+        msg.attach(MIMEText(html_body, 'html'))
+
+        # Attach screenshots
+        for content_id, img_data, subtype in images:
+            img = MIMEImage(img_data, subtype)
+            img.add_header('Content-ID', f'<{content_id}>')
+            msg.attach(img)
+
+        return msg
+
+    def build_table_message(self, tables, original_filename, captions=None):
+        """
+        Build a multipart/alternative message with the sheet(s) as HTML
+        tables in the body (CSS already inlined, see inline_table_html) and
+        a plain-text version. tables is a list of (html, text) pairs,
+        captions optionally gives a heading per table. No images involved.
+        """
+        with track('email_build'):
+            msg = MIMEMultipart('alternative')
+            msg['From'] = f"{self.sender_name} <{self.sender_email}>"
+            msg['Subject'] = f"Excel Sheet: {original_filename}"
+
+            text_parts = [f"Hello,\n\nPlease find below the content of the Excel file: {original_filename}\n"]
+            html_parts = []
+            for index, (table_html, table_text) in enumerate(tables):
+                if captions:
+                    text_parts.append(f"{captions[index]}\n")
+                    html_parts.append(f'<h3>{html.escape(str(captions[index]))}</h3>')
+                text_parts.append(table_text)
+                html_parts.append(table_html)
+
+            html_body = f"""
+        <html>
+        <head></head>
+        <body>
+            <h2>Excel File Content</h2>
+            <p>Hello,</p>
+            <p>Please find below the content of the Excel file: <strong>{html.escape(original_filename)}</strong></p>
+            {'<br>'.join(html_parts)}
+        </body>
+        </html>
+        """
+
+            # Clients show the last alternative they support, so HTML goes last
+            msg.attach(MIMEText('\n'.join(text_parts), 'plain', 'utf-8'))
+            msg.attach(MIMEText(html_body, 'html', 'utf-8'))
+            return msg
+
+    def _count(self, outcome):
+        with self._counts_lock:
+            self.delivery_counts[outcome] += 1
+
+    def _delivered(self, recipient, attempts):
+        self._count('sent')
+        return {'recipient': recipient, 'status': 'sent', 'attempts': attempts}
+
+    def _undelivered(self, recipient, message, error, kind, attempts, dead_letter):
+        """Count a failed delivery and spool it, returns its result dict"""
+        self._count('failed')
+        logger.error(f"Error sending email to {recipient} ({kind}, {attempts} attempt(s)): {error}")
+        result = {'recipient': recipient, 'status': 'failed', 'error': str(error),
+                  'permanent': kind == PERMANENT, 'attempts': attempts}
+        if dead_letter:
+            try:
+                result['dead_letter_id'] = self.dead_letters.add(
+                    self.sender_email, recipient, message, error, kind, attempts)
+                self._count('dead_lettered')
+            except OSError as e:
+                logger.error(f"Could not spool dead letter for {recipient}: {e}")
+        return result
+
+    def deliver(self, recipient, message, dead_letter=True):
+        """
+        Send one message (an email Message, or serialized as a str, bytes or
+        list of bytes chunks), waiting for the rate limiter first.
+        Transient failures (4xx, disconnects) are retried with exponential
+        backoff; permanent ones (5xx) are not. A message that could not be
+        delivered is spooled as a dead letter. Returns a result dict.
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            time.sleep(self.rate_limiter.reserve(self.sender_email, recipient))
+            try:
+                self.smtp_pool.sendmail(self.sender_email, recipient, message)
+                return self._delivered(recipient, attempt)
+            except Exception as e:
+                kind = classify_error(e)
+                if kind != TRANSIENT or attempt >= self.retry_policy.max_attempts:
+                    return self._undelivered(recipient, message, e, kind, attempt, dead_letter)
+                delay = self.retry_policy.delay(attempt)
+                logger.warning(f"Transient error sending email to {recipient}, retry {attempt} in {delay:.1f}s: {e}")
+                self._count('retried')
+                time.sleep(delay)
+
+    async def deliver_async(self, recipient, message, dead_letter=True):
+        """Async version of deliver over the aiosmtplib pool"""
+        attempt = 0
+        while True:
+            attempt += 1
+            await asyncio.sleep(self.rate_limiter.reserve(self.sender_email, recipient))
+            try:
+                await self.async_smtp_pool.sendmail(self.sender_email, recipient, message)
+                return self._delivered(recipient, attempt)
+            except Exception as e:
+                kind = classify_error(e)
+                if kind != TRANSIENT or attempt >= self.retry_policy.max_attempts:
+                    # Spooling writes two small files, not worth a thread hop
+                    return self._undelivered(recipient, message, e, kind, attempt, dead_letter)
+                delay = self.retry_policy.delay(attempt)
+                logger.warning(f"Transient error sending email to {recipient}, retry {attempt} in {delay:.1f}s: {e}")
+                self._count('retried')
+                await asyncio.sleep(delay)
+
+    def replay_dead_letter(self, letter_id):
+        """
+        Send a spooled message again. It is removed from the spool once
+        delivered and kept with the new error otherwise. Returns the result
+        dict, or None if there is no such letter.
+        """
+        meta = self.dead_letters.get(letter_id)
+        if meta is None:
+            return None
+
+        result = self.deliver(meta['recipient'], self.dead_letters.message(letter_id), dead_letter=False)
+        if result['status'] == 'sent':
+            self.dead_letters.remove(letter_id)
+            self._count('replayed')
+            logger.info(f"Dead letter {letter_id} delivered to {meta['recipient']}")
+        else:
+            self.dead_letters.record_failure(letter_id, result['error'],
+                                             PERMANENT if result['permanent'] else TRANSIENT,
+                                             result['attempts'])
+        return dict(result, dead_letter_id=letter_id)
+
+    def delivery_stats(self):
+        """Delivery counters, rate limiter state and the dead letter count"""
+        with self._counts_lock:
+            counts = dict(self.delivery_counts)
+        return {
+            'counts': counts,
+            'rate_limits': self.rate_limiter.stats(),
+            'max_attempts': self.retry_policy.max_attempts,
+            'dead_letters': self.dead_letters.count(),
+        }
+
     def send_email_with_screenshot(self, recipient_email, screenshot_path,
-                                   original_filename):
+                                   original_filename, captions=None):
         """
         Send email with screenshot embedded in the body
+        screenshot_path may also be a list of tile or sheet paths
         """
         try:
-            # Create message
-            msg = MIMEMultipart('related')
-            msg['From'] = f"{self.sender_name} <{self.sender_email}>"
-            msg['To'] = recipient_email
-            msg['Subject'] = f"Excel Screenshot: {original_filename}"
+            msg = self.build_screenshot_message(screenshot_path, original_filename, captions)
+        except Exception as e:
+            logger.error(f"Error building email: {e}")
+            return False
+        return self.send_message(recipient_email, msg)
 
-            # Create HTML body with embedded image
-            html_body = f"""
-            <html>
-            <head></head>
-            <body>
-                <h2>Excel File Screenshot</h2>
-                <p>Hello,</p>
-                <p>Please find below the screenshot of the Excel file content for: <strong>{original_filename}</strong></p>
-                <br>
-                <img src="cid:screenshot" alt="Excel Screenshot" style="max-width: 100%; height: auto; border: 1px solid #ddd;">
-                <br><br>
-                
-            </body>
-            </html>
-            """
-
-            # Attach HTML body
-            msg.attach(MIMEText(html_body, 'html'))
-
-            # Read and attach screenshot
-            with open(screenshot_path, 'rb') as f:
-                img_data = f.read()
-                img = MIMEImage(img_data)
-                img.add_header('Content-ID', '<screenshot>')
-                msg.attach(img)
-
-            # Send email with better error handling
-            with smtplib.SMTP(self.smtp_server, self.smtp_port) as server:
-                server.starttls()
-                server.login(self.sender_email, self.sender_password)
+    def send_email_with_tables(self, recipient_email, tables, original_filename, captions=None):
+        """Send the sheet(s) as inline HTML tables, see build_table_message"""
+        try:
+            msg = self.build_table_message(tables, original_filename, captions)
+        except Exception as e:
+            logger.error(f"Error building email: {e}")
+            return False
+        return self.send_message(recipient_email, msg)
 
-                text = msg.as_string()
-                server.sendmail(self.sender_email, recipient_email, text)
+    def send_message(self, recipient_email, msg):
+        """Send a built message to one recipient, returns True once delivered"""
+        msg['To'] = recipient_email
 
-            logger.info(f"Email sent successfully to {recipient_email}")
-            return True
+        # Streamed over a pooled connection, retrying transient failures
+        if self.deliver(recipient_email, msg)['status'] != 'sent':
+            return False
+
+        logger.info(f"Email sent successfully to {recipient_email}")
+        return True
+
+    def send_batch(self, recipients, screenshot_paths, original_filename, captions=None):
+        """
+        Send the same screenshot email to many recipients.
+        Returns a list of per-recipient result dicts.
+        """
+        msg = self.build_screenshot_message(screenshot_paths, original_filename, captions)
+        return self.send_message_batch(recipients, msg)
+
+    def send_table_batch(self, recipients, tables, original_filename, captions=None):
+        """Send the same inline table email to many recipients, see send_batch"""
+        msg = self.build_table_message(tables, original_filename, captions)
+        return self.send_message_batch(recipients, msg)
+
+    def send_message_batch(self, recipients, msg):
+        """
+        Send a built message to many recipients. It is serialized once;
+        sends run concurrently over the SMTP pool through deliver().
+        Returns a list of per-recipient result dicts.
+        """
+        body = msg.as_bytes(policy=email.policy.SMTP)
+
+        def send_one(recipient):
+            # Send the only per-recipient header ahead of the shared serialized message
+            return self.deliver(recipient, [f"To: {recipient}\r\n".encode(), body])
+
+        with ThreadPoolExecutor(max_workers=self.smtp_pool.max_size) as executor:
+            results = list(executor.map(send_one, recipients))
+
+        sent = sum(1 for r in results if r['status'] == 'sent')
+        logger.info(f"Batch email sent to {sent}/{len(recipients)} recipients")
+        return results
+
+    @property
+    def async_smtp_pool(self):
+        if self._async_smtp_pool is None:
+            self._async_smtp_pool = AsyncSMTPConnectionPool(
+                self.smtp_server,
+                self.smtp_port,
+                self.sender_email,
+                self.sender_password
+            )
+        return self._async_smtp_pool
 
+    async def send_email_with_screenshot_async(self, recipient_email, screenshot_path,
+                                               original_filename, captions=None):
+        """
+        Async version of send_email_with_screenshot for the ASGI server.
+        Building the message reads the screenshots, so it runs in a thread.
+        """
+        try:
+            msg = await asyncio.to_thread(self.build_screenshot_message, screenshot_path,
+                                          original_filename, captions)
+        except Exception as e:
+            logger.error(f"Error building email: {e}")
+            return False
+        return await self.send_message_async(recipient_email, msg)
+
+    async def send_email_with_tables_async(self, recipient_email, tables, original_filename, captions=None):
+        """Async version of send_email_with_tables, the message is built on the loop"""
+        try:
+            msg = self.build_table_message(tables, original_filename, captions)
         except Exception as e:
-            logger.error(f"Error sending email: {e}")
+            logger.error(f"Error building email: {e}")
+            return False
+        return await self.send_message_async(recipient_email, msg)
+
+    async def send_message_async(self, recipient_email, msg):
+        """Async version of send_message"""
+        msg['To'] = recipient_email
+
+        if (await self.deliver_async(recipient_email, msg))['status'] != 'sent':
             return False
 
+        logger.info(f"Email sent successfully to {recipient_email}")
+        return True
+
+    async def send_batch_async(self, recipients, screenshot_paths, original_filename, captions=None):
+        """Async version of send_batch"""
+        msg = await asyncio.to_thread(self.build_screenshot_message, screenshot_paths,
+                                      original_filename, captions)
+        return await self.send_message_batch_async(recipients, msg)
+
+    async def send_table_batch_async(self, recipients, tables, original_filename, captions=None):
+        """Async version of send_table_batch"""
+        msg = self.build_table_message(tables, original_filename, captions)
+        return await self.send_message_batch_async(recipients, msg)
+
+    async def send_message_batch_async(self, recipients, msg):
+        """
+        Async version of send_message_batch, sends concurrently over the
+        async pool (which bounds the number of open connections)
+        """
+        body = msg.as_bytes(policy=email.policy.SMTP)
+
+        results = await asyncio.gather(*(
+            self.deliver_async(recipient, [f"To: {recipient}\r\n".encode(), body]) for recipient in recipients
+        ))
+
+        sent = sum(1 for r in results if r['status'] == 'sent')
+        logger.info(f"Batch email sent to {sent}/{len(recipients)} recipients")
+        return list(results)
+
+    def pool_stats(self):
+        """SMTP pool usage keyed by pool, the async pool only once it exists"""
+        stats = {'sync': self.smtp_pool.stats()}
+        if self._async_smtp_pool is not None:
+            stats['async'] = self._async_smtp_pool.stats()
+        return stats
+
+    async def close_async(self):
+        """Close idle connections of the async pool, if it was ever used"""
+        if self._async_smtp_pool is not None:
+            await self._async_smtp_pool.close_all()
+
     def test_email_configuration(self):
         """
         Test email configuration
@@ -1,118 +1,473 @@
 import os
+import copy
+import html
+import json
+import hashlib
 import logging
-import tempfile
 import asyncio
-from playwright.async_api import async_playwright
-import openpyxl
-from openpyxl.utils import get_column_letter
-import pandas as pd
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from sheet_scanner import ScanCache, format_value, scan_selection, CHANGED_CELL_COLOR
+from memory_files import (MemoryFile, open_output, file_name, file_exists,
+                          remove_file, with_extension)
+from renderers import TableRenderer, PillowTableRenderer
+from screenshot_cache import CACHE_VERSION
+from metrics import track, observe_screenshots
 
 logger = logging.getLogger(__name__)
 
+HTML_HEAD = """<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <style>
+        body {
+            font-family: Arial, sans-serif;
+            margin: 20px;
+            background-color: white;
+        }
+        table {
+            border-collapse: collapse;
+            width: 100%;
+            background-color: white;
+        }
+        th, td {
+            border: 1px solid #ddd;
+            padding: 8px;
+            text-align: left;
+            white-space: nowrap;
+        }
+        th {
+            background-color: #f2f2f2;
+            font-weight: bold;
+        }
+        tr:nth-child(even) {
+            background-color: #f9f9f9;
+        }
+    </style>
+</head>
+<body>
+"""
+
+HTML_TAIL = """
+</body>
+</html>
+"""
+
+# HTML_HEAD's rules, inlined on each element for emails
+INLINE_TABLE_CSS = 'border-collapse: collapse; background-color: white; font-family: Arial, sans-serif'
+INLINE_CELL_CSS = 'border: 1px solid #ddd; padding: 8px; text-align: left; white-space: nowrap'
+INLINE_HEADER_CSS = INLINE_CELL_CSS + '; background-color: #f2f2f2; font-weight: bold'
+INLINE_EVEN_ROW_CSS = INLINE_CELL_CSS + '; background-color: #f9f9f9'
+INLINE_FOOTER_CSS = 'font-style: italic; color: #666; padding-top: 6px'
+
+# Widest column of the plain-text alternative, longer values are cut
+TEXT_MAX_COL_WIDTH = 40
+
+
+def _format_cell(value):
+    """Format a raw cell value as escaped HTML text"""
+    return html.escape(format_value(value))
+
+def write_table_html(scan, output_path, tile=None, footer_note=None):
+    """
+    Write a SheetScan (or one tile of it) to an HTML table file, first row as
+    the header. footer_note is shown under the last tile. Module level so it
+    can also run in a parse pool worker. Scans read with Excel formatting
+    are written as styled tables instead.
+    """
+    if scan.styles is not None:
+        from excel_styles import write_styled_html
+        return write_styled_html(scan, output_path, tile, footer_note)
+
+    header, body, is_last_tile = scan.tile_view(tile)
+    # Changed cells, (row, col) of the tile with row 0 the header
+    highlights = scan.tile_highlights(tile)
+    changed = f' style="background-color: {CHANGED_CELL_COLOR}"'
+
+    with track('html'), open_output(output_path, text=True) as out:
+        out.write(HTML_HEAD)
+        out.write('<table border="1" class="dataframe" id="excel-table">\n')
+
+        out.write('<thead><tr>')
+        for col, value in enumerate(header):
+            out.write(f'<th{changed if (0, col) in highlights else ""}>{_format_cell(value)}</th>')
+        out.write('</tr></thead>\n<tbody>\n')
+
+        for row_index, row in enumerate(body, start=1):
+            out.write('<tr>')
+            for col, value in enumerate(row):
+                out.write(f'<td{changed if (row_index, col) in highlights else ""}>{_format_cell(value)}</td>')
+            out.write('</tr>\n')
+
+        out.write('</tbody>\n')
+        if footer_note and is_last_tile:
+            out.write(f'<tfoot><tr><td colspan="{len(header)}">{footer_note}</td></tr></tfoot>\n')
+        out.write('</table>\n')
+        out.write(HTML_TAIL)
+
+    logger.info(f"Wrote {len(body)} rows x {len(header)} columns to {output_path}")
+
+
+def inline_table_html(scan, footer_note=None):
+    """
+    A SheetScan as an HTML table for an email body, with the CSS of
+    HTML_HEAD inlined on every cell since mail clients drop <style> blocks.
+    Scans read with Excel formatting keep it.
+    """
+    if scan.styles is not None:
+        from excel_styles import inline_styled_html
+        return inline_styled_html(scan, footer_note)
+
+    header, body, _ = scan.tile_view()
+    parts = [f'<table cellspacing="0" cellpadding="0" style="{INLINE_TABLE_CSS}">\n<tr>']
+    for value in header:
+        parts.append(f'<th style="{INLINE_HEADER_CSS}">{_format_cell(value)}</th>')
+    parts.append('</tr>\n')
+
+    for index, row in enumerate(body):
+        # tr:nth-child(even) of HTML_HEAD, counted within the body rows
+        css = INLINE_EVEN_ROW_CSS if index % 2 else INLINE_CELL_CSS
+        parts.append('<tr>')
+        for value in row:
+            parts.append(f'<td style="{css}">{_format_cell(value)}</td>')
+        parts.append('</tr>\n')
+
+    if footer_note:
+        parts.append(f'<tr><td colspan="{len(header)}" style="{INLINE_FOOTER_CSS}">{footer_note}</td></tr>\n')
+    parts.append('</table>\n')
+    return ''.join(parts)
+
+
+def table_text(scan, footer_note=None):
+    """A SheetScan as a fixed-width text table, for the plain-text part of an email"""
+    if scan.styles is not None:
+        from excel_styles import styled_text_rows
+        rows = styled_text_rows(scan)
+    else:
+        header, body, _ = scan.tile_view()
+        rows = [[format_value(value) for value in row] for row in [header] + body]
+
+    rows = [[' '.join(text.split()) for text in row] for row in rows]
+    widths = [min(max(len(row[col]) for row in rows), TEXT_MAX_COL_WIDTH) for col in range(len(rows[0]))]
+
+    def line(row):
+        cells = (text if len(text) <= width else text[:width - 3] + '...' for text, width in zip(row, widths))
+        return ' | '.join(text.ljust(width) for text, width in zip(cells, widths)).rstrip()
+
+    lines = [line(rows[0]), '-+-'.join('-' * width for width in widths)]
+    lines.extend(line(row) for row in rows[1:])
+    if footer_note:
+        lines.extend(['', footer_note])
+    return '\n'.join(lines) + '\n'
+
+
+class PlaywrightTableRenderer(TableRenderer):
+    """
+    Renders tables as HTML and screenshots them in Chromium.
+    Handles any sheet, so it is the fallback for every other backend.
+    """
+
+    name = 'playwright'
+
+    def __init__(self, processor):
+        self.processor = processor
+
+    def can_render(self, scan):
+        return True
+
+    def _write_tiles(self, jobs):
+        """
+        Write HTML for each tile of each job to a temporary file next to its
+        screenshot, in the parse pool when there is one. Screenshots taken
+        into memory get their HTML in memory too.
+        """
+        processor = self.processor
+        html_jobs = []
+        output_paths = []
+        for scan, tiles, tile_paths, _ in jobs:
+            for tile, output_path in zip(tiles, tile_paths):
+                html_path = with_extension(output_path, '.html')
+                html_jobs.append((scan, tile, html_path, processor.footer_note(scan)))
+                output_paths.append(output_path)
+
+        if processor.parse_pool:
+            # Stage timings taken in the worker stay in its process, time the call from here
+            with track('html'):
+                html_data = processor.parse_pool.write_html(html_jobs)
+            # The worker returns in-memory HTML, its copies of the MemoryFiles are not ours
+            for (_, _, html_path, _), data in zip(html_jobs, html_data):
+                if isinstance(html_path, MemoryFile):
+                    html_path.data = data
+        else:
+            for scan, tile, html_path, footer_note in html_jobs:
+                write_table_html(scan, html_path, tile, footer_note)
+        return [html_path for _, _, html_path, _ in html_jobs], output_paths
+
+    def _remove_tiles(self, jobs):
+        for _, _, tile_paths, _ in jobs:
+            for path in tile_paths:
+                if isinstance(path, MemoryFile):
+                    continue
+                html_path = os.path.splitext(path)[0] + '.html'
+                if os.path.exists(html_path):
+                    os.remove(html_path)
+
+    def render(self, scan, tiles, output_paths, footer_note=None):
+        return self.render_many([(scan, tiles, output_paths, footer_note)])
+
+    async def render_async(self, scan, tiles, output_paths, footer_note=None):
+        return await self.render_many_async([(scan, tiles, output_paths, footer_note)])
+
+    def render_many(self, jobs):
+        # Every tile of every job is screenshotted in one concurrent batch
+        processor = self.processor
+        try:
+            with track('render_playwright'):
+                html_paths, output_paths = self._write_tiles(jobs)
+
+                # Take screenshots
+                screenshots = processor.take_screenshots_async(html_paths, output_paths)
+                if processor.browser_pool:
+                    return processor.browser_pool.run(screenshots)
+                return asyncio.run(screenshots)
+        finally:
+            self._remove_tiles(jobs)
+
+    async def render_many_async(self, jobs):
+        # Screenshots are awaited on the caller's loop, only file writes use a thread
+        processor = self.processor
+        try:
+            with track('render_playwright'):
+                html_paths, output_paths = await asyncio.to_thread(self._write_tiles, jobs)
+
+                screenshots = processor.take_screenshots_async(html_paths, output_paths)
+                if processor.browser_pool:
+                    return await processor.browser_pool.run_async(screenshots)
+                return await screenshots
+        finally:
+            await asyncio.to_thread(self._remove_tiles, jobs)
+
+
 class ExcelProcessor:
-    def __init__(self):
+    def __init__(self, browser_pool=None, screenshot_cache=None, parse_pool=None, change_history=None):
         self.screenshot_folder = 'screenshots'
         os.makedirs(self.screenshot_folder, exist_ok=True)
+
+        # Optional BrowserPool; without one a browser is launched per screenshot
+        self.browser_pool = browser_pool
+
+        # Optional ScreenshotCache; a hit skips parsing and rendering entirely
+        self.screenshot_cache = screenshot_cache
+
+        # Optional ParsePool; without one workbooks are parsed in this process
+        self.parse_pool = parse_pool
+
+        # Optional ChangeHistory; highlights cells changed since a report's previous version
+        self.change_history = change_history
+        # Cache tiles one by one too, so a new version only renders the tiles that changed
+        self.incremental = os.getenv('INCREMENTAL_RENDER', 'true').lower() not in ('0', 'false', 'no')
+        self.viewport = {"width": 1200, "height": 800}
+
+        # Caps for the streamed HTML table
+        self.max_rows = int(os.getenv('RENDER_MAX_ROWS', '5000'))
+        self.max_cols = int(os.getenv('RENDER_MAX_COLS', '100'))
+
+        # Tiled rendering for large sheets
+        self.tile_rows = int(os.getenv('TILE_ROWS', '200'))
+        self.tile_cols = int(os.getenv('TILE_COLS', '20'))
+        self.max_tiles = int(os.getenv('MAX_TILES', '20'))
+
+        # Parsed sheets per upload, shared by every stage that needs them
+        self.scan_cache = ScanCache()
+
+        # Sheets sent as inline HTML in 'auto' email format must fit both limits
+        self.inline_max_cells = int(os.getenv('EMAIL_HTML_MAX_CELLS', '2000'))
+        # Gmail clips message bodies over 102KB
+        self.inline_max_bytes = int(float(os.getenv('EMAIL_HTML_MAX_KB', '100')) * 1024)
+
+        # Rendering backends: 'auto' uses Pillow for simple sheets, Playwright otherwise
+        self.renderer_mode = os.getenv('RENDERER', 'auto')
+        # 'excel' renders cell formats, fills, fonts, widths and merges; 'plain' a simple grid
+        self.table_style = os.getenv('TABLE_STYLE', 'plain')
+        self.playwright_renderer = PlaywrightTableRenderer(self)
+        self.pillow_renderer = PillowTableRenderer(
+            min_width=self.viewport['width'] - 40
+        )
+
+    def select_renderer(self, scan):
+        """Pick the rendering backend for a scan"""
+        if self.renderer_mode == 'playwright':
+            return self.playwright_renderer
+        if self.renderer_mode in ('auto', 'pillow') and self.pillow_renderer.can_render(scan):
+            return self.pillow_renderer
+        if self.renderer_mode == 'pillow':
+            logger.info("Sheet is not simple enough for the Pillow renderer, using Playwright")
+        return self.playwright_renderer
+
+    def render_options(self):
+        """
+        Options that affect the rendered image, part of the screenshot cache key
+        """
+        return {
+            'viewport': self.viewport,
+            'max_rows': self.max_rows,
+            'max_cols': self.max_cols,
+            'tile_rows': self.tile_rows,
+            'tile_cols': self.tile_cols,
+            'max_tiles': self.max_tiles,
+            'renderer': self.renderer_mode,
+            'table_style': self.table_style,
+        }
     
+    def view_caps(self, view=None):
+        """
+        Row and column caps for a request's view options, which can only
+        tighten the configured ones. 'top' caps the rows like max_rows.
+        """
+        view = view or {}
+        max_rows = min(n for n in (self.max_rows, view.get('max_rows'), view.get('top')) if n)
+        max_cols = min(n for n in (self.max_cols, view.get('max_cols')) if n)
+        return max_rows, max_cols
+
+    def styled(self, view=None):
+        """Whether a request renders with Excel formatting, view['style'] overrides TABLE_STYLE"""
+        return ((view or {}).get('style') or self.table_style) == 'excel'
+
+    def scan_workbook(self, filepath, view=None):
+        """
+        Parse the first sheet once, returning a SheetScan with the content
+        bounds, values (within the render caps) and column types.
+        view optionally narrows the scan: {'cell_range': 'A1:F20' (may name
+        a sheet), 'max_rows': n, 'max_cols': n, 'top': n}, where top keeps the
+        first n data rows plus the sheet's last (totals) row, and picks the
+        table 'style'.
+        Scans are cached per upload so later stages do not re-parse the file.
+        """
+        view = view or {}
+        max_rows, max_cols = self.view_caps(view)
+        scanner = self.parse_pool.scan_sheet if self.parse_pool else None
+        with track('scan'):
+            return self.scan_cache.get_or_scan(filepath, max_rows, max_cols, scanner,
+                                               view.get('cell_range'), bool(view.get('top')), self.styled(view))
+
     def get_content_range(self, filepath):
         """
         Determine the actual content range in the Excel file
         Returns tuple (last_row, last_col) or None if error
         """
         try:
-            # Try with openpyxl first
-            workbook = openpyxl.load_workbook(filepath, read_only=True)
-            worksheet = workbook.active
-            
-            # Find the last row and column with data
-            last_row = 0
-            last_col = 0
-            
-            for row in worksheet.iter_rows():
-                row_num = row[0].row
-                for cell in row:
-                    if cell.value is not None:
-                        last_row = max(last_row, row_num)
-                        last_col = max(last_col, cell.column)
-            
-            workbook.close()
+            from openpyxl.utils import get_column_letter
+            scan = self.scan_workbook(filepath)
             
-            logger.info(f"Content range detected: A1:{get_column_letter(last_col)}{last_row}")
-            return last_row, last_col
+            logger.info(f"Content range detected: A1:{get_column_letter(max(scan.last_col, 1))}{scan.last_row}")
+            return scan.last_row, scan.last_col
             
         except Exception as e:
-            logger.error(f"Error determining content range with openpyxl: {e}")
-            
-            # Fallback to pandas
-            try:
-                df = pd.read_excel(filepath, sheet_name=0)
-                last_row = len(df) + 1  # +1 for header
-                last_col = len(df.columns)
-                
-                logger.info(f"Content range detected with pandas: A1:{get_column_letter(last_col)}{last_row}")
-                return last_row, last_col
-                
-            except Exception as e2:
-                logger.error(f"Error determining content range with pandas: {e2}")
-                return None, None
+            logger.error(f"Error determining content range: {e}")
+            return None, None
     
-    def create_html_from_excel(self, filepath):
+    def write_html_from_excel(self, filepath, output_path):
         """
-        Convert Excel content to HTML for screenshot
+        Write Excel content to an HTML file for screenshot.
+        The sheet is parsed once by scan_workbook (capped at max_rows x max_cols)
+        and the table is written out row by row.
+        Returns True on success
         """
         try:
-            # Read Excel file
-            df = pd.read_excel(filepath, sheet_name=0)
-            
-            # Convert to HTML with styling
-            html_content = f"""
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <meta charset="UTF-8">
-                <style>
-                    body {{
-                        font-family: Arial, sans-serif;
-                        margin: 20px;
-                        background-color: white;
-                    }}
-                    table {{
-                        border-collapse: collapse;
-                        width: 100%;
-                        background-color: white;
-                    }}
-                    th, td {{
-                        border: 1px solid #ddd;
-                        padding: 8px;
-                        text-align: left;
-                        white-space: nowrap;
-                    }}
-                    th {{
-                        background-color: #f2f2f2;
-                        font-weight: bold;
-                    }}
-                    tr:nth-child(even) {{
-                        background-color: #f9f9f9;
-                    }}
-                </style>
-            </head>
-            <body>
-                {df.to_html(index=False, escape=False, table_id='excel-table')}
-            </body>
-            </html>
-            """
-            
-            return html_content
-            
+            scan = self.scan_workbook(filepath)
+            self.write_html_from_scan(scan, output_path)
+            return True
+
         except Exception as e:
-            logger.error(f"Error creating HTML from Excel: {e}")
+            logger.error(f"Error writing HTML from Excel: {e}")
+            return False
+
+    def footer_note(self, scan):
+        """Note shown under the last tile when the sheet was cut at the render caps"""
+        num_cols = max(scan.last_col, 1)
+        # A view can cap the columns below max_cols, the scan keeps the cap it was read with
+        max_cols = scan.max_cols or self.max_cols
+        if scan.totals_row:
+            if scan.truncated:
+                return f"Showing the first {len(scan.rows) - 2} rows and the last row"
             return None
+        if scan.truncated or num_cols >= max_cols:
+            return f"Showing the first {len(scan.rows) - 1} rows and {num_cols} columns"
+        return None
+
+    def write_html_from_scan(self, scan, output_path, tile=None):
+        """
+        Write a SheetScan to an HTML table file, first row as the header.
+        tile is an optional (row_start, row_end, col_start, col_end) range of
+        data rows/columns; the header row is repeated on every tile.
+        """
+        write_table_html(scan, output_path, tile, self.footer_note(scan))
+
+    def plan_tiles(self, scan):
+        """
+        Split the data rows of a scan into tiles of tile_rows x tile_cols,
+        row-major, capped at max_tiles.
+        Returns a list of (row_start, row_end, col_start, col_end)
+        """
+        num_rows = max(len(scan.rows) - 1, 0)
+        num_cols = max(scan.last_col, 1)
+
+        tiles = [
+            (row, min(row + self.tile_rows, num_rows), col, min(col + self.tile_cols, num_cols))
+            for row in range(0, max(num_rows, 1), self.tile_rows)
+            for col in range(0, num_cols, self.tile_cols)
+        ]
+
+        if len(tiles) > self.max_tiles:
+            logger.warning(f"Sheet needs {len(tiles)} tiles, rendering the first {self.max_tiles}")
+            tiles = tiles[:self.max_tiles]
+        return tiles
     
-    async def take_screenshot_async(self, html_content, output_path):
+    async def _render_table(self, page, html_content, output_path, html_path=None):
+        """
+        Render HTML content on a page and screenshot the table element
+        Loads html_path via file:// when given instead of passing the markup over the wire
+        html_path and output_path may be MemoryFiles, the image is then kept as bytes
+        """
+        with track('screenshot'):
+            # Set content
+            if isinstance(html_path, MemoryFile):
+                await page.set_content(html_path.data.decode('utf-8'))
+            elif html_path:
+                await page.goto(Path(html_path).resolve().as_uri())
+            else:
+                await page.set_content(html_content)
+
+            # Wait for content to load
+            await page.wait_for_selector('#excel-table', timeout=10000)
+
+            # Get the table element
+            table_element = await page.query_selector('#excel-table')
+
+            if table_element:
+                # Take screenshot of just the table
+                if isinstance(output_path, MemoryFile):
+                    output_path.data = await table_element.screenshot(type='png')
+                else:
+                    await table_element.screenshot(path=output_path)
+                logger.info(f"Screenshot saved to: {output_path}")
+                return True
+            else:
+                logger.error("Could not find table element for screenshot")
+                return False
+
+    async def take_screenshot_async(self, html_content, output_path, html_path=None):
         """
-        Take screenshot of HTML content using Playwright
+        Take screenshot of HTML content (or an HTML file) using Playwright
+        Borrows a warm page from the browser pool when one is configured
         """
         try:
+            if self.browser_pool:
+                async with self.browser_pool.page() as page:
+                    return await self._render_table(page, html_content, output_path, html_path)
+
+            from playwright.async_api import async_playwright
             async with async_playwright() as p:
                 # Launch browser (let Playwright find the installed browser)
                 browser = await p.chromium.launch(
@@ -120,61 +475,437 @@ class ExcelProcessor:
                     # No executable_path - let Playwright use installed browser
                 )
                 page = await browser.new_page()
-                
+
                 # Set viewport for better rendering
-                await page.set_viewport_size({"width": 1200, "height": 800})
-                
-                # Set content
-                await page.set_content(html_content)
-                
-                # Wait for content to load
-                await page.wait_for_selector('#excel-table', timeout=10000)
-                
-                # Get the table element
-                table_element = await page.query_selector('#excel-table')
-                
-                if table_element:
-                    # Take screenshot of just the table
-                    await table_element.screenshot(path=output_path)
-                    logger.info(f"Screenshot saved to: {output_path}")
-                    await browser.close()
-                    return True
-                else:
-                    logger.error("Could not find table element for screenshot")
+                await page.set_viewport_size(self.viewport)
+
+                try:
+                    return await self._render_table(page, html_content, output_path, html_path)
+                finally:
                     await browser.close()
-                    return False
-                    
+
         except Exception as e:
             logger.error(f"Error taking screenshot: {e}")
             return False
     
-    def process_excel_and_screenshot(self, filepath):
+    async def take_screenshots_async(self, html_paths, output_paths):
         """
-        Main method to process Excel file and take screenshot
-        Returns path to screenshot file or None if error
+        Screenshot several HTML files concurrently.
+        Uses pooled pages when a browser pool is configured, otherwise one
+        browser with a page per file. Returns True if every screenshot succeeded
         """
+        if self.browser_pool or len(html_paths) == 1:
+            results = await asyncio.gather(*(
+                self.take_screenshot_async(None, output_path, html_path=html_path)
+                for html_path, output_path in zip(html_paths, output_paths)
+            ))
+            return all(results)
+
         try:
-            # Generate unique filename for screenshot
-            base_filename = os.path.splitext(os.path.basename(filepath))[0]
-            screenshot_filename = f"{base_filename}_{os.urandom(4).hex()}.png"
-            screenshot_path = os.path.join(self.screenshot_folder, screenshot_filename)
-            
-            # Create HTML from Excel
-            html_content = self.create_html_from_excel(filepath)
-            
-            if not html_content:
-                logger.error("Failed to create HTML from Excel")
+            from playwright.async_api import async_playwright
+            async with async_playwright() as p:
+                browser = await p.chromium.launch(headless=True)
+                try:
+                    async def render(html_path, output_path):
+                        page = await browser.new_page(viewport=self.viewport)
+                        try:
+                            return await self._render_table(page, None, output_path, html_path)
+                        finally:
+                            await page.close()
+
+                    results = await asyncio.gather(*(
+                        render(html_path, output_path)
+                        for html_path, output_path in zip(html_paths, output_paths)
+                    ))
+                    return all(results)
+                finally:
+                    await browser.close()
+
+        except Exception as e:
+            logger.error(f"Error taking screenshots: {e}")
+            return False
+
+    def _screenshot_path_factory(self, filepath):
+        """
+        Unique screenshot paths for an upload, the first tile keeps the plain
+        name. Uploads held in memory get MemoryFiles instead of paths.
+        """
+        base_filename = os.path.splitext(file_name(filepath))[0]
+        base_path = os.path.join(self.screenshot_folder, f"{base_filename}_{os.urandom(4).hex()}")
+
+        def screenshot_path_for(index):
+            path = f"{base_path}.png" if index == 0 else f"{base_path}_{index}.png"
+            return MemoryFile(os.path.basename(path)) if isinstance(filepath, MemoryFile) else path
+        return screenshot_path_for
+
+    def _cached_screenshots(self, filepath, options, screenshot_path_for):
+        """
+        Look up a previous render of identical workbook content; options are
+        the request-specific render options on top of render_options().
+        Returns (cache_key, cached_paths); both are None without a cache.
+        """
+        if not self.screenshot_cache:
+            return None, None
+
+        with track('cache_lookup'):
+            cache_key = self.screenshot_cache.key_for(filepath, dict(self.render_options(), **options))
+            cached_paths = self.screenshot_cache.get(cache_key, screenshot_path_for)
+        if cached_paths:
+            logger.info(f"Screenshot cache hit: {cache_key}")
+        return cache_key, cached_paths
+
+    def _highlighting(self, view, series):
+        """Whether a render highlights the cells changed since the series' previous version"""
+        return bool(self.change_history and series and (view or {}).get('highlight'))
+
+    def _with_changes(self, scan, series):
+        """A copy of a (cached, shared) scan with the cells changed since the series' previous version highlighted"""
+        with track('diff'):
+            changed = self.change_history.changed_cells(series, scan)
+        scan = copy.copy(scan)
+        scan.highlights = changed
+        return scan
+
+    def _plan_render(self, filepath, tiled, screenshot_path_for, view=None, series=None):
+        """
+        Scan the workbook and plan its tiles, returns (scan, tiles, screenshot_paths)
+        series highlights the changes since its previous version (see _with_changes)
+        """
+        scan = self.scan_workbook(filepath, view)
+        if series:
+            scan = self._with_changes(scan, series)
+        tiles = self.plan_tiles(scan) if tiled else [None]
+        screenshot_paths = [screenshot_path_for(index) for index in range(len(tiles))]
+        return scan, tiles, screenshot_paths
+
+    def _finish_render(self, filepath, success, cache_key, screenshot_paths, labels=None):
+        """Cache a successful render, or clean up after a failed one"""
+        if success and all(file_exists(path) for path in screenshot_paths):
+            observe_screenshots(screenshot_paths, 'rendered')
+            if cache_key:
+                self.screenshot_cache.put(cache_key, screenshot_paths, labels)
+            if len(screenshot_paths) > 1:
+                logger.info(f"Rendered {len(screenshot_paths)} tiles for {filepath}")
+            return screenshot_paths
+        else:
+            logger.error("Screenshot was not created successfully")
+            for path in screenshot_paths:
+                remove_file(path)
+            return None
+
+    def _tile_key(self, scan, tile, renderer, footer_note):
+        """Screenshot cache key of one tile: its cells, layout and highlights plus the render options"""
+        row_start, row_end, col_start, col_end = tile
+        header, rows, is_last_tile = scan.tile_view(tile)
+        digest = hashlib.sha256()
+        digest.update(json.dumps({
+            'version': CACHE_VERSION,
+            'options': self.render_options(),
+            'renderer': renderer.name,
+            'columns': [col_start, col_end],
+            'footer_note': footer_note if is_last_tile else None,
+            'highlights': sorted(scan.tile_highlights(tile)),
+        }, sort_keys=True).encode())
+        digest.update(repr((header, rows)).encode())
+
+        if scan.styles is not None:
+            styles = scan.styles
+            row_indexes = [0] + list(range(row_start + 1, row_end + 1))
+            digest.update(repr((
+                [[(text, styles.classes[class_id]) for text, class_id in styles.cells[row][col_start:col_end]]
+                 for row in row_indexes if row < len(styles.cells)],
+                styles.base_css,
+                styles.col_widths[col_start:col_end],
+                [styles.row_heights.get(row) for row in row_indexes],
+                styles.merges,
+            )).encode())
+        return digest.hexdigest()
+
+    def _cached_tiles(self, scan, tiles, screenshot_paths, renderer):
+        """
+        Copy the tiles of a tiled render that were rendered before out of
+        the screenshot cache, so only changed tiles are rendered again.
+        Returns (tile_keys, missing) with missing the indexes of the tiles
+        still to render; tile_keys is None when tiles are not cached.
+        """
+        if not (self.incremental and self.screenshot_cache and tiles[0] is not None
+                and (len(tiles) > 1 or scan.highlights is not None)):
+            return None, list(range(len(tiles)))
+
+        footer_note = self.footer_note(scan)
+        with track('cache_lookup'):
+            tile_keys = [self._tile_key(scan, tile, renderer, footer_note) for tile in tiles]
+            missing = [index for index, key in enumerate(tile_keys)
+                       if not self.screenshot_cache.get(key, lambda _, path=screenshot_paths[index]: path,
+                                                        count=False)]
+        if len(missing) < len(tiles):
+            logger.info(f"Reusing {len(tiles) - len(missing)} of {len(tiles)} tiles from the screenshot cache")
+        return tile_keys, missing
+
+    def _cache_tiles(self, tile_keys, rendered, screenshot_paths):
+        for index in rendered:
+            self.screenshot_cache.put(tile_keys[index], [screenshot_paths[index]])
+
+    def _render_tiles(self, scan, tiles, screenshot_paths):
+        """
+        Render the tiles of a scan with the cheapest backend that handles
+        it, copying unchanged tiles from the screenshot cache instead.
+        Returns True if every tile was written
+        """
+        renderer = self.select_renderer(scan)
+        tile_keys, missing = self._cached_tiles(scan, tiles, screenshot_paths, renderer)
+        if not missing:
+            return True
+        render_tiles = [tiles[index] for index in missing]
+        render_paths = [screenshot_paths[index] for index in missing]
+
+        if renderer.render(scan, render_tiles, render_paths, self.footer_note(scan)):
+            if tile_keys:
+                self._cache_tiles(tile_keys, missing, screenshot_paths)
+            return True
+
+        if renderer is self.playwright_renderer:
+            return False
+        logger.warning(f"{renderer.name} renderer failed, falling back to Playwright")
+        return self.playwright_renderer.render(scan, render_tiles, render_paths, self.footer_note(scan))
+
+    async def _render_tiles_async(self, scan, tiles, screenshot_paths):
+        """_render_tiles for callers on an event loop"""
+        renderer = self.select_renderer(scan)
+        tile_keys, missing = await asyncio.to_thread(self._cached_tiles, scan, tiles, screenshot_paths, renderer)
+        if not missing:
+            return True
+        render_tiles = [tiles[index] for index in missing]
+        render_paths = [screenshot_paths[index] for index in missing]
+
+        if await renderer.render_async(scan, render_tiles, render_paths, self.footer_note(scan)):
+            if tile_keys:
+                await asyncio.to_thread(self._cache_tiles, tile_keys, missing, screenshot_paths)
+            return True
+
+        if renderer is self.playwright_renderer:
+            return False
+        logger.warning(f"{renderer.name} renderer failed, falling back to Playwright")
+        return await self.playwright_renderer.render_async(scan, render_tiles, render_paths, self.footer_note(scan))
+
+    @staticmethod
+    def _cache_options(view, **options):
+        """Screenshot cache options of a request, the view only when given"""
+        # The email format does not change the images, highlighted renders are not cached whole
+        view = {name: value for name, value in (view or {}).items() if name not in ('format', 'highlight')}
+        if view:
+            options['view'] = view
+        return options
+
+    def process_excel_and_screenshots(self, filepath, tiled=True, view=None, series=None):
+        """
+        Process Excel file and take one screenshot per tile.
+        Sheets larger than tile_rows x tile_cols are split into tiles with the
+        header repeated on each, so no single image gets too large. Tiles
+        unchanged since an earlier render are reused from the cache.
+        view optionally narrows what is rendered (see scan_workbook); with
+        view['highlight'], cells changed since the previous version of the
+        series (e.g. the file name and recipients) are highlighted.
+        Returns list of screenshot paths or None if error
+        """
+        try:
+            screenshot_path_for = self._screenshot_path_factory(filepath)
+            highlight = self._highlighting(view, series)
+
+            # Reuse a previous render of identical workbook content; highlights
+            # depend on the previous version too, so those are built from tiles
+            cache_key = None
+            if not highlight:
+                cache_key, cached_paths = self._cached_screenshots(
+                    filepath, self._cache_options(view, tiled=tiled), screenshot_path_for
+                )
+                if cached_paths:
+                    return cached_paths
+
+            scan, tiles, screenshot_paths = self._plan_render(filepath, tiled, screenshot_path_for, view,
+                                                              series if highlight else None)
+            success = self._render_tiles(scan, tiles, screenshot_paths)
+            return self._finish_render(filepath, success, cache_key, screenshot_paths)
+
+        except Exception as e:
+            logger.error(f"Error in process_excel_and_screenshots: {e}")
+            return None
+
+    async def process_excel_and_screenshots_async(self, filepath, tiled=True, view=None, series=None):
+        """
+        process_excel_and_screenshots for callers on an event loop (the ASGI
+        server). Browser work is awaited on the running loop; parsing, cache
+        and file I/O run in worker threads so the loop keeps serving.
+        """
+        try:
+            screenshot_path_for = self._screenshot_path_factory(filepath)
+            highlight = self._highlighting(view, series)
+
+            cache_key = None
+            if not highlight:
+                cache_key, cached_paths = await asyncio.to_thread(
+                    self._cached_screenshots, filepath, self._cache_options(view, tiled=tiled), screenshot_path_for
+                )
+                if cached_paths:
+                    return cached_paths
+
+            scan, tiles, screenshot_paths = await asyncio.to_thread(
+                self._plan_render, filepath, tiled, screenshot_path_for, view, series if highlight else None
+            )
+            success = await self._render_tiles_async(scan, tiles, screenshot_paths)
+
+            return await asyncio.to_thread(self._finish_render, filepath, success, cache_key, screenshot_paths)
+
+        except Exception as e:
+            logger.error(f"Error in process_excel_and_screenshots_async: {e}")
+            return None
+
+    def scan_selection(self, filepath, selection, view=None):
+        """
+        Scan the sheets and named ranges of a selection from one workbook load.
+        selection is {'sheets': 'all' or [names], 'ranges': [names]}; only the
+        max_rows/max_cols caps and the style of a view apply to selections.
+        """
+        max_rows, max_cols = self.view_caps(view)
+        scanner = self.parse_pool.scan_selection if self.parse_pool else scan_selection
+        with track('scan'):
+            return scanner(filepath, selection.get('sheets'), selection.get('ranges'), max_rows, max_cols,
+                           self.styled(view))
+
+    def _sheet_jobs(self, scans, output_paths):
+        """One untiled render job per scan, grouped by the backend that draws it"""
+        groups = {}
+        for scan, output_path in zip(scans, output_paths):
+            renderer = self.select_renderer(scan)
+            groups.setdefault(renderer, []).append((scan, [None], [output_path], self.footer_note(scan)))
+        return groups
+
+    def _prepare_sheets(self, filepath, selection, screenshot_path_for, view=None):
+        """
+        Cache lookup, then scan. Returns (cache_key, cached, scans, output_paths)
+        where cached is the list of (name, path) on a hit and the rest are None
+        """
+        cache_key, cached_paths = self._cached_screenshots(
+            filepath, self._cache_options(view, selection=selection), screenshot_path_for
+        )
+        if cached_paths:
+            labels = self.screenshot_cache.labels(cache_key)
+            if labels and len(labels) == len(cached_paths):
+                return cache_key, list(zip(labels, cached_paths)), None, None
+            for path in cached_paths:
+                remove_file(path)
+
+        scans = self.scan_selection(filepath, selection, view)
+        if not scans:
+            raise ValueError('The selection does not include any sheet or range')
+        output_paths = [screenshot_path_for(index) for index in range(len(scans))]
+        return cache_key, None, scans, output_paths
+
+    def _finish_sheets(self, filepath, success, cache_key, scans, output_paths):
+        labels = [scan.sheet_name for scan in scans]
+        screenshot_paths = self._finish_render(filepath, success, cache_key, output_paths, labels)
+        return list(zip(labels, screenshot_paths)) if screenshot_paths else None
+
+    def process_excel_sheets(self, filepath, selection, view=None):
+        """
+        Render several sheets and/or named ranges of one workbook, one image
+        each, from a single parse. Backends render concurrently: the Playwright
+        sheets as one batch of pooled pages, the Pillow ones alongside.
+        Returns a list of (sheet or range name, screenshot path) or None if error
+        """
+        try:
+            screenshot_path_for = self._screenshot_path_factory(filepath)
+            cache_key, cached, scans, output_paths = self._prepare_sheets(
+                filepath, selection, screenshot_path_for, view
+            )
+            if cached:
+                return cached
+
+            groups = self._sheet_jobs(scans, output_paths)
+            with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+                futures = {renderer: executor.submit(renderer.render_many, jobs) for renderer, jobs in groups.items()}
+            success = True
+            for renderer, future in futures.items():
+                if future.result():
+                    continue
+                if renderer is self.playwright_renderer:
+                    success = False
+                    continue
+                logger.warning(f"{renderer.name} renderer failed, falling back to Playwright")
+                success = self.playwright_renderer.render_many(groups[renderer]) and success
+
+            return self._finish_sheets(filepath, success, cache_key, scans, output_paths)
+
+        except Exception as e:
+            logger.error(f"Error in process_excel_sheets: {e}")
+            return None
+
+    async def process_excel_sheets_async(self, filepath, selection, view=None):
+        """process_excel_sheets for callers on an event loop (the ASGI server)"""
+        try:
+            screenshot_path_for = self._screenshot_path_factory(filepath)
+            cache_key, cached, scans, output_paths = await asyncio.to_thread(
+                self._prepare_sheets, filepath, selection, screenshot_path_for, view
+            )
+            if cached:
+                return cached
+
+            groups = self._sheet_jobs(scans, output_paths)
+            results = await asyncio.gather(*(renderer.render_many_async(jobs) for renderer, jobs in groups.items()))
+            success = True
+            for (renderer, jobs), result in zip(groups.items(), results):
+                if result:
+                    continue
+                if renderer is self.playwright_renderer:
+                    success = False
+                    continue
+                logger.warning(f"{renderer.name} renderer failed, falling back to Playwright")
+                success = await self.playwright_renderer.render_many_async(jobs) and success
+
+            return await asyncio.to_thread(self._finish_sheets, filepath, success, cache_key, scans, output_paths)
+
+        except Exception as e:
+            logger.error(f"Error in process_excel_sheets_async: {e}")
+            return None
+
+    def inline_tables(self, filepath, selection=None, view=None, auto=False):
+        """
+        The first sheet, or each sheet and named range of a selection, as
+        (name, html, text) for an email body, without a browser (see
+        inline_table_html and table_text). With auto, returns None when the
+        sheets exceed inline_max_cells or inline_max_bytes so the caller can
+        send screenshots instead. Returns None if error
+        """
+        try:
+            scans = self.scan_selection(filepath, selection, view) if selection else [self.scan_workbook(filepath, view)]
+            if not scans:
+                raise ValueError('The selection does not include any sheet or range')
+
+            cells = sum(len(scan.rows) * max(scan.last_col, 1) for scan in scans)
+            if auto and cells > self.inline_max_cells:
+                logger.info(f"{cells} cells are over the {self.inline_max_cells} cell inline limit, sending images")
                 return None
-            
-            # Take screenshot
-            success = asyncio.run(self.take_screenshot_async(html_content, screenshot_path))
-            
-            if success and os.path.exists(screenshot_path):
-                return screenshot_path
-            else:
-                logger.error("Screenshot was not created successfully")
+
+            with track('inline_html'):
+                tables = [(scan.sheet_name, inline_table_html(scan, self.footer_note(scan)),
+                           table_text(scan, self.footer_note(scan))) for scan in scans]
+
+            size = sum(len(table_html.encode('utf-8')) for _, table_html, _ in tables)
+            if auto and size > self.inline_max_bytes:
+                logger.info(f"Inline tables are {size} bytes, over the {self.inline_max_bytes} byte limit, sending images")
                 return None
-                
+
+            logger.info(f"Built {len(tables)} inline table(s) of {cells} cells, {size} bytes")
+            return tables
+
         except Exception as e:
-            logger.error(f"Error in process_excel_and_screenshot: {e}")
+            logger.error(f"Error in inline_tables: {e}")
             return None
+
+    def process_excel_and_screenshot(self, filepath):
+        """
+        Main method to process Excel file and take screenshot
+        Returns path to screenshot file or None if error
+        """
+        screenshot_paths = self.process_excel_and_screenshots(filepath, tiled=False)
+        return screenshot_paths[0] if screenshot_paths else None
@@ -0,0 +1,810 @@
+import re
+import html
+import logging
+import colorsys
+import datetime
+from decimal import Decimal, ROUND_HALF_UP
+from fractions import Fraction
+from xml.etree.ElementTree import iterparse, fromstring
+from openpyxl.styles.colors import COLOR_INDEX
+from openpyxl.styles.numbers import is_date_format
+from openpyxl.utils.cell import range_boundaries
+from metrics import track
+from sheet_scanner import CHANGED_CELL_COLOR
+from memory_files import open_output
+
+logger = logging.getLogger(__name__)
+
+SHEET_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+DRAWING_NS = '{http://schemas.openxmlformats.org/drawingml/2006/main}'
+
+# Default Office theme in theme index order: lt1, dk1, lt2, dk2, accent1-6, hlink, folHlink
+DEFAULT_THEME = ['FFFFFF', '000000', 'E7E6E6', '44546A', '4472C4', 'ED7D31',
+                 'A5A5A5', 'FFC000', '5B9BD5', '70AD47', '0563C1', '954F72']
+
+# Excel column width units (characters of the default font, padding included) to pixels
+CHAR_WIDTH_PX = 7
+DEFAULT_COL_WIDTH_PX = 64
+
+BORDER_STYLES = {
+    'hair': '1px dotted', 'dotted': '1px dotted', 'thin': '1px solid',
+    'dashed': '1px dashed', 'dashDot': '1px dashed', 'dashDotDot': '1px dashed',
+    'medium': '2px solid', 'mediumDashed': '2px dashed', 'mediumDashDot': '2px dashed',
+    'mediumDashDotDot': '2px dashed', 'slantDashDot': '2px dashed',
+    'thick': '3px solid', 'double': '3px double',
+}
+HORIZONTAL = {'left': 'left', 'center': 'center', 'centerContinuous': 'center', 'right': 'right',
+              'justify': 'justify', 'distributed': 'justify', 'fill': 'left'}
+VERTICAL = {'top': 'top', 'center': 'middle', 'justify': 'middle', 'distributed': 'middle'}
+
+STYLED_HEAD = """<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <style>
+        body {{ margin: 20px; background-color: white; }}
+        table {{ border-collapse: collapse; table-layout: fixed; background-color: white; }}
+        td {{ border: 1px solid #e1e1e1; padding: 0 3px; height: 20px; white-space: nowrap;
+             overflow: hidden; vertical-align: bottom; {base} }}
+        tfoot td {{ font-style: italic; color: #666; border: none; padding-top: 6px; }}
+{classes}
+    </style>
+</head>
+<body>
+"""
+
+HTML_TAIL = """
+</body>
+</html>
+"""
+
+# The td and tfoot rules of STYLED_HEAD, for emails where CSS has to be inline
+INLINE_CELL_CSS = ('border: 1px solid #e1e1e1; padding: 0 3px; height: 20px; white-space: nowrap; '
+                   'overflow: hidden; vertical-align: bottom')
+INLINE_FOOTER_CSS = 'font-style: italic; color: #666; padding-top: 6px'
+
+
+def theme_colors(workbook):
+    """RGB hex colors of the workbook theme, in theme index order"""
+    try:
+        root = fromstring(workbook.loaded_theme)
+        scheme = root.find(f'.//{DRAWING_NS}clrScheme')
+        colors = []
+        for element in scheme:
+            color = element[0]
+            colors.append(color.get('lastClr') or color.get('val'))
+        # Excel swaps the first two pairs: theme 0 is lt1 (background), 1 is dk1 (text)
+        colors[0:4] = [colors[1], colors[0], colors[3], colors[2]]
+        if len(colors) >= 10 and all(colors):
+            return colors
+    except Exception:
+        pass
+    return DEFAULT_THEME
+
+
+def _apply_tint(rgb, tint):
+    r, g, b = (int(rgb[i:i + 2], 16) / 255 for i in (0, 2, 4))
+    h, l, s = colorsys.rgb_to_hls(r, g, b)
+    l = l * (1 + tint) if tint < 0 else l * (1 - tint) + tint
+    return ''.join(f'{round(c * 255):02X}' for c in colorsys.hls_to_rgb(h, l, s))
+
+
+def color_css(color, theme):
+    """CSS hex color for an openpyxl Color, None for automatic colors"""
+    if color is None:
+        return None
+    rgb = None
+    if color.type == 'rgb' and isinstance(color.rgb, str):
+        rgb = color.rgb[-6:]
+    elif color.type == 'indexed' and isinstance(color.indexed, int) and color.indexed < len(COLOR_INDEX):
+        # 64 and above are the system foreground/background
+        rgb = COLOR_INDEX[color.indexed][-6:] if color.indexed < 64 else None
+    elif color.type == 'theme' and isinstance(color.theme, int) and color.theme < len(theme):
+        rgb = theme[color.theme]
+    if not rgb:
+        return None
+    if color.tint:
+        rgb = _apply_tint(rgb, color.tint)
+    return f'#{rgb.lower()}'
+
+
+def font_css(font, theme, default=None):
+    """CSS declarations for an openpyxl Font, leaving out what matches default"""
+    if font is None:
+        return []
+    declarations = []
+    if font.name and (default is None or font.name != default.name):
+        declarations.append(f"font-family: '{font.name}', Arial, sans-serif")
+    if font.sz and (default is None or font.sz != default.sz):
+        declarations.append(f'font-size: {font.sz:g}pt')
+    if font.b:
+        declarations.append('font-weight: bold')
+    if font.i:
+        declarations.append('font-style: italic')
+    decorations = [name for name, on in (('underline', font.u), ('line-through', font.strike)) if on]
+    if decorations:
+        declarations.append(f"text-decoration: {' '.join(decorations)}")
+    color = color_css(font.color, theme)
+    if color and (default is None or color != color_css(default.color, theme)):
+        declarations.append(f'color: {color}')
+    return declarations
+
+
+def cell_css(cell, kind, theme, default_font=None, format_color=None):
+    """
+    CSS declarations for a read-only cell's font, fill, borders and alignment.
+    kind is 'number', 'bool' or 'text': Excel's General alignment depends on it.
+    format_color is the color from the number format, it wins over the font's.
+    """
+    declarations = font_css(cell.font, theme, default_font)
+    if format_color:
+        declarations = [d for d in declarations if not d.startswith('color:')] + [f'color: {format_color}']
+
+    fill = cell.fill
+    if getattr(fill, 'patternType', None) == 'solid':
+        background = color_css(fill.fgColor, theme)
+        if background:
+            declarations.append(f'background-color: {background}')
+
+    border = cell.border
+    if border is not None:
+        for side_name in ('left', 'right', 'top', 'bottom'):
+            side = getattr(border, side_name)
+            if side is not None and side.style in BORDER_STYLES:
+                color = color_css(side.color, theme) or '#000'
+                declarations.append(f'border-{side_name}: {BORDER_STYLES[side.style]} {color}')
+
+    alignment = cell.alignment
+    horizontal = HORIZONTAL.get(getattr(alignment, 'horizontal', None))
+    if horizontal is None and kind != 'text':
+        horizontal = 'right' if kind == 'number' else 'center'
+    if horizontal and horizontal != 'left':
+        declarations.append(f'text-align: {horizontal}')
+    if alignment is not None:
+        vertical = VERTICAL.get(alignment.vertical)
+        if vertical:
+            declarations.append(f'vertical-align: {vertical}')
+        if alignment.wrap_text:
+            declarations.append('white-space: pre-wrap')
+        if alignment.indent:
+            declarations.append(f'padding-left: {3 + int(alignment.indent) * 9}px')
+    return declarations
+
+
+# Number formats
+
+_COLOR_CODE = re.compile(r'\[(black|white|red|green|blue|yellow|magenta|cyan|color\s*\d+)\]', re.I)
+FORMAT_COLORS = {'black': '#000000', 'white': '#ffffff', 'red': '#ff0000', 'green': '#00ff00',
+                 'blue': '#0000ff', 'yellow': '#ffff00', 'magenta': '#ff00ff', 'cyan': '#00ffff'}
+_CONDITION = re.compile(r'\[[<>=][^\]]*\]')
+_LOCALE = re.compile(r'\[\$([^\]-]*)(?:-[^\]]*)?\]')
+_DATE_TOKEN = re.compile(r'"[^"]*"|\\.|_.|\*.|yyyy|yy|mmmmm|mmmm|mmm|mm|m|dddd|ddd|dd|d|'
+                         r'\[?hh?\]?|\[?mm?\]|\[?ss?\]|ss?|am/pm|a/p|\.0+|.', re.I)
+
+
+def _split_sections(number_format):
+    """Split a number format on the ';' separators outside quotes"""
+    sections = []
+    current = ''
+    quoted = False
+    escaped = False
+    for char in number_format:
+        if escaped:
+            current += char
+            escaped = False
+        elif char == '\\':
+            current += char
+            escaped = True
+        elif char == '"':
+            current += char
+            quoted = not quoted
+        elif char == ';' and not quoted:
+            sections.append(current)
+            current = ''
+        else:
+            current += char
+    sections.append(current)
+    return sections
+
+
+def _section_index(value, sections):
+    if value < 0 and len(sections) > 1:
+        return 1
+    if value == 0 and len(sections) > 2:
+        return 2
+    return 0
+
+
+def format_color(value, number_format):
+    """CSS color a number format's [Red]-style code gives a numeric value, if any"""
+    if not number_format or '[' not in number_format or not isinstance(value, (int, float)) \
+            or isinstance(value, bool):
+        return None
+    sections = _split_sections(number_format)
+    match = _COLOR_CODE.search(sections[_section_index(value, sections)])
+    if not match:
+        return None
+    name = match.group(1).lower()
+    if name.startswith('color'):
+        index = int(name[5:]) + 7  # [Color1] is the first entry of the 56 color palette
+        return f'#{COLOR_INDEX[index][-6:].lower()}' if 8 <= index < 64 else None
+    return FORMAT_COLORS[name]
+
+
+def _clean_section(section):
+    section = _COLOR_CODE.sub('', section)
+    section = _CONDITION.sub('', section)
+    return _LOCALE.sub(lambda match: match.group(1), section)
+
+
+def _literal(text):
+    """Display text of the literal parts of a format: quotes, escapes and padding"""
+    out = []
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if char == '"':
+            end = text.find('"', i + 1)
+            end = len(text) if end == -1 else end
+            out.append(text[i + 1:end])
+            i = end + 1
+            continue
+        if char == '\\' and i + 1 < len(text):
+            out.append(text[i + 1])
+        elif char == '_' and i + 1 < len(text):
+            out.append(' ')
+        elif char == '*' and i + 1 < len(text):
+            pass
+        else:
+            out.append(char)
+            i += 1
+            continue
+        i += 2
+    return ''.join(out)
+
+
+def _code_positions(section):
+    """Indexes of the characters of a format section outside quotes and escapes"""
+    positions = []
+    quoted = False
+    skip = False
+    for i, char in enumerate(section):
+        if skip:
+            skip = False
+        elif char == '"':
+            quoted = not quoted
+        elif quoted:
+            continue
+        elif char in '\\_*':
+            skip = True
+        else:
+            positions.append(i)
+    return positions
+
+
+def format_general(value):
+    """Excel's General format: up to 10 significant decimals, no float noise"""
+    if isinstance(value, float):
+        if value.is_integer() and abs(value) < 1e11:
+            return str(int(value))
+        if value != 0 and (abs(value) >= 1e11 or abs(value) < 1e-9):
+            return f'{value:.5E}'
+        return f'{value:.10g}' if abs(value) < 1 else f'{round(value, 9):f}'.rstrip('0').rstrip('.')
+    return str(value)
+
+
+def _group(digits):
+    """Thousands separators for a string of digits"""
+    head = len(digits) % 3 or 3
+    return ','.join([digits[:head]] + [digits[i:i + 3] for i in range(head, len(digits), 3)])
+
+
+def _fill_integer(digits, code):
+    """
+    Place the digits of a number's integer part into the '0#?' placeholders
+    of the format's integer part, right to left, keeping literals between
+    them: '00000' shows 12 as 00012 and '000-00-0000' shows 7 as
+    000-00-0007. The first placeholder takes any digits left over.
+    """
+    positions = _code_positions(code)
+    placeholders = [i for i in positions if code[i] in '0#?']
+    if not placeholders:
+        return digits
+    if any(code[i] == ',' for i in positions):
+        zeros = sum(1 for i in placeholders if code[i] == '0')
+        return _group(digits.zfill(zeros)) if digits or zeros else ''
+
+    out = []
+    for index in reversed(range(len(placeholders))):
+        position = placeholders[index]
+        following = placeholders[index + 1] if index + 1 < len(placeholders) else len(code)
+        out.append(_literal(code[position + 1:following]))
+        if index == 0:
+            digit, digits = digits, ''
+        else:
+            digit, digits = digits[-1:], digits[:-1]
+        out.append(digit or {'0': '0', '?': ' ', '#': ''}[code[position]])
+    return ''.join(reversed(out))
+
+
+def _format_fraction(value, section, start, slash):
+    """
+    Text of a fraction format such as '# ?/?', '?/??' or '# ?/8' from its
+    first placeholder at start, with the index the denominator ends at.
+    The denominator is the closest one with as many digits as its
+    placeholders, or the fixed one given.
+    """
+    end = slash + 1
+    while end < len(section) and section[end] in '0123456789#?':
+        end += 1
+    denominator_code = section[slash + 1:end]
+    numerator_start = slash
+    while numerator_start > start and section[numerator_start - 1] in '0#?':
+        numerator_start -= 1
+    whole_end = numerator_start
+    while whole_end > start and section[whole_end - 1] not in '0#?':
+        whole_end -= 1
+    mixed = whole_end > start
+
+    whole = int(value) if mixed else 0
+    remainder = value - whole
+    if denominator_code.isdigit() and denominator_code[0] != '0':
+        denominator = int(denominator_code)
+        numerator = int((Decimal(str(remainder)) * denominator).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+    else:
+        fraction = Fraction(remainder).limit_denominator(10 ** max(len(denominator_code), 1) - 1)
+        numerator, denominator = fraction.numerator, fraction.denominator
+    if mixed and numerator == denominator:
+        whole, numerator = whole + 1, 0
+
+    if not numerator:
+        return str(whole), end
+    if mixed and whole:
+        return f'{whole}{_literal(section[whole_end:numerator_start])}{numerator}/{denominator}', end
+    return f'{numerator}/{denominator}', end
+
+
+def _format_number(value, number_format):
+    sections = _split_sections(number_format)
+    index = _section_index(value, sections)
+    section = sections[index]
+    sign = ''
+    if value < 0:
+        # Only the first section shows its own minus sign
+        sign, value = ('-' if index == 0 else ''), -value
+    section = _clean_section(section)
+
+    positions = _code_positions(section)
+    exponent_at = next((i for i in positions if section[i] in 'Ee' and section[i + 1:i + 2] in ('+', '-')), None)
+    code = [i for i in positions if section[i] in '0#?' and (exponent_at is None or i < exponent_at)]
+    if not code:
+        return _literal(section) if section.strip() not in ('', 'General', '@') else sign + format_general(value)
+    start, end = code[0], code[-1] + 1
+
+    if exponent_at is not None:
+        decimals = sum(1 for char in section[start:exponent_at].partition('.')[2] if char in '0#?')
+        digits = sum(1 for char in section[exponent_at + 2:] if char in '0#?')
+        mantissa, _, power = f'{value:.{decimals}E}'.partition('E')
+        power_sign = '-' if power.startswith('-') else '+'
+        return f"{sign}{_literal(section[:start])}{mantissa}E{power_sign}{power.lstrip('+-').lstrip('0').zfill(digits or 2)}"
+
+    slash = next((i for i in positions if section[i] == '/' and i > start), None)
+    if slash is not None:
+        text, end = _format_fraction(value, section, start, slash)
+        return f'{sign}{_literal(section[:start])}{text}{_literal(section[end:])}'
+
+    # Separators directly around the placeholders belong to the number
+    while end < len(section) and section[end] in ',.':
+        end += 1
+    while start > 0 and section[start - 1] in ',.':
+        start -= 1
+    prefix, number, suffix = section[:start], section[start:end], section[end:]
+
+    # Decimal rounds half away from zero like Excel, without float noise
+    value = Decimal(str(value)) * 100 ** (_literal(prefix) + _literal(suffix)).count('%')
+
+    integer_part, _, fraction_part = number.partition('.')
+    scaling = len(integer_part) - len(integer_part.rstrip(','))
+    value /= 1000 ** scaling
+    decimals = sum(1 for char in fraction_part if char in '0#?')
+    required = fraction_part.count('0')
+
+    rounded = value.quantize(Decimal(1).scaleb(-decimals), rounding=ROUND_HALF_UP)
+    whole, _, fraction = f'{rounded:f}'.partition('.')
+    if decimals > required:
+        # Optional digits: '0.0#' shows 1.5 as 1.5 and 1.25 as 1.25, Excel keeps a bare point
+        fraction = fraction.rstrip('0').ljust(required, '0')
+    # '#' placeholders do not show a lone zero: '#.##' shows 0.5 as .5
+    text = _fill_integer('' if whole == '0' else whole, integer_part[:len(integer_part) - scaling])
+    if '.' in number:
+        text += f'.{fraction}'
+    return f'{sign}{_literal(prefix)}{text}{_literal(suffix)}'
+
+
+def _format_date(value, number_format):
+    section = _clean_section(_split_sections(number_format)[0])
+    tokens = _DATE_TOKEN.findall(section)
+    lowered = [token.lower() for token in tokens]
+    twelve_hour = any(token in ('am/pm', 'a/p') for token in lowered)
+
+    out = []
+    for index, (token, lower) in enumerate(zip(tokens, lowered)):
+        if lower in ('m', 'mm'):
+            previous = next((t for t in reversed(lowered[:index]) if t.isalpha() or t.startswith('[')), '')
+            following = next((t for t in lowered[index + 1:] if t.isalpha() or t.startswith('[')), '')
+            if previous.strip('[]') in ('h', 'hh') or following.strip('[]') in ('s', 'ss'):
+                lower = 'mi' + lower
+        year = getattr(value, 'year', 1900)
+        month = getattr(value, 'month', 1)
+        day = getattr(value, 'day', 1)
+        hour = getattr(value, 'hour', 0)
+        if lower in ('yyyy', 'yyy'):
+            out.append(f'{year:04d}')
+        elif lower == 'yy':
+            out.append(f'{year % 100:02d}')
+        elif lower == 'mmmmm':
+            out.append(datetime.date(2000, month, 1).strftime('%B')[0])
+        elif lower == 'mmmm':
+            out.append(datetime.date(2000, month, 1).strftime('%B'))
+        elif lower == 'mmm':
+            out.append(datetime.date(2000, month, 1).strftime('%b'))
+        elif lower in ('mm', 'm'):
+            out.append(f'{month:02d}' if lower == 'mm' else str(month))
+        elif lower in ('dddd', 'ddd'):
+            weekday = datetime.date(year, month, day).strftime('%A')
+            out.append(weekday if lower == 'dddd' else weekday[:3])
+        elif lower in ('dd', 'd'):
+            out.append(f'{day:02d}' if lower == 'dd' else str(day))
+        elif lower.strip('[]') in ('hh', 'h'):
+            shown = (hour % 12 or 12) if twelve_hour else hour
+            out.append(f'{shown:02d}' if lower.strip('[]') == 'hh' else str(shown))
+        elif lower.strip('[]') in ('mimm', 'mim', 'mm', 'm'):
+            minute = getattr(value, 'minute', 0)
+            out.append(f'{minute:02d}' if lower.strip('[]') in ('mimm', 'mm') else str(minute))
+        elif lower.strip('[]') in ('ss', 's'):
+            second = getattr(value, 'second', 0)
+            out.append(f'{second:02d}' if lower.strip('[]') == 'ss' else str(second))
+        elif lower.startswith('.0'):
+            fraction = getattr(value, 'microsecond', 0) / 1e6
+            out.append(f'{fraction:.{len(token) - 1}f}'[1:])
+        elif lower == 'am/pm':
+            out.append('AM' if hour < 12 else 'PM')
+        elif lower == 'a/p':
+            out.append('A' if hour < 12 else 'P')
+        else:
+            out.append(_literal(token))
+    return ''.join(out)
+
+
+def format_cell(value, number_format=None):
+    """Display text of a cell value under its Excel number format"""
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    try:
+        if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+            if number_format and is_date_format(number_format):
+                return _format_date(value, number_format)
+            return value.isoformat(sep=' ') if isinstance(value, datetime.datetime) else value.isoformat()
+        if isinstance(value, (int, float)):
+            if number_format and number_format != 'General':
+                return _format_number(value, number_format)
+            return format_general(value)
+    except (ValueError, IndexError, ArithmeticError):
+        logger.debug(f"Unsupported number format {number_format!r}, showing the raw value")
+        return format_general(value)
+    return str(value)
+
+
+def _value_kind(value):
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, (int, float, datetime.datetime, datetime.date, datetime.time)):
+        return 'number'
+    return 'text'
+
+
+# Sheet layout
+
+def read_layout(worksheet, first_row, last_row, first_col, last_col):
+    """
+    Column widths (px), custom row heights (pt) and merged ranges of a
+    read-only worksheet within the given 1-based bounds, streamed from the
+    sheet XML without building the cells. Widths and merges are keyed or
+    given relative to the bounds.
+    Returns (col_widths, row_heights, merges), merges as (row, col, rows, cols)
+    """
+    col_defs = []
+    row_heights = {}
+    merges = []
+    default_width = None
+
+    # Read-only worksheets only expose cells, the layout elements are read from the part itself
+    with worksheet._get_source() as source:
+        sheet_data = None
+        for event, element in iterparse(source, events=('start', 'end')):
+            tag = element.tag
+            if event == 'start':
+                if tag == f'{SHEET_NS}sheetData':
+                    sheet_data = element
+                continue
+            if tag == f'{SHEET_NS}row':
+                row = int(element.get('r', 0))
+                if first_row <= row <= last_row:
+                    if element.get('hidden') in ('1', 'true'):
+                        row_heights[row - first_row] = 0
+                    elif element.get('customHeight') in ('1', 'true') and element.get('ht'):
+                        row_heights[row - first_row] = float(element.get('ht'))
+                if sheet_data is not None:
+                    sheet_data.clear()
+            elif tag == f'{SHEET_NS}col':
+                col_defs.append((int(element.get('min')), int(element.get('max')),
+                                 float(element.get('width', 0)), element.get('hidden') in ('1', 'true')))
+            elif tag == f'{SHEET_NS}sheetFormatPr' and element.get('defaultColWidth'):
+                default_width = round(float(element.get('defaultColWidth')) * CHAR_WIDTH_PX)
+            elif tag == f'{SHEET_NS}mergeCell' and element.get('ref'):
+                min_col, min_row, max_col, max_row = range_boundaries(element.get('ref'))
+                top, bottom = max(min_row, first_row), min(max_row, last_row)
+                left, right = max(min_col, first_col), min(max_col, last_col)
+                if top <= bottom and left <= right and (top, left) != (bottom, right):
+                    merges.append((top - first_row, left - first_col, bottom - top + 1, right - left + 1))
+
+    col_widths = [default_width or DEFAULT_COL_WIDTH_PX] * (last_col - first_col + 1)
+    for min_col, max_col, width, hidden in col_defs:
+        for col in range(max(min_col, first_col), min(max_col, last_col) + 1):
+            col_widths[col - first_col] = 0 if hidden else round(width * CHAR_WIDTH_PX)
+    return col_widths, row_heights, merges
+
+
+EMPTY_CELL = ('', 0)
+
+
+class SheetStyles:
+    """
+    Excel formatting of a scan: display text and a style class per cell,
+    the deduplicated CSS of each class (class 0 is unstyled), column widths
+    in px, custom row heights in pt and merged ranges, all in scan
+    coordinates (row 0 is the header row).
+    """
+
+    def __init__(self, cells, classes, base_css, col_widths, row_heights, merges):
+        self.cells = cells  # list of rows of (text, class) pairs
+        self.classes = classes
+        self.base_css = base_css
+        self.col_widths = col_widths
+        self.row_heights = row_heights
+        self.merges = merges
+
+
+class StyleReader:
+    """
+    Wraps a read-only worksheet's cell rows: values() feeds plain value rows
+    to the scanner while each kept cell is formatted and given a style class.
+    Style classes are computed once per workbook style and deduplicated by
+    their CSS, so a styled sheet costs one class per distinct look rather
+    than inline CSS per cell.
+    """
+
+    def __init__(self, worksheet, cell_rows, max_rows=None):
+        self.worksheet = worksheet
+        self.cell_rows = cell_rows
+        self.max_rows = max_rows
+        workbook = worksheet.parent
+        self.theme = theme_colors(workbook)
+        fonts = getattr(workbook, '_fonts', None)
+        self.default_font = fonts[0] if fonts else None
+
+        self.classes = ['']
+        self._class_ids = {'': 0}
+        self._class_by_style = {}
+        self._number_formats = {}
+        self.rows = []
+        self._past_cap = None  # last non-blank row read past the row cap
+
+    def _class_for(self, cell, style_id, kind, color):
+        key = (style_id, kind, color)
+        class_id = self._class_by_style.get(key)
+        if class_id is None:
+            styled = style_id or kind != 'text'
+            css = '; '.join(cell_css(cell, kind, self.theme, self.default_font, color)) if styled else ''
+            class_id = self._class_ids.get(css)
+            if class_id is None:
+                class_id = self._class_ids[css] = len(self.classes)
+                self.classes.append(css)
+            self._class_by_style[key] = class_id
+        return class_id
+
+    def _style_row(self, cells):
+        row = []
+        for cell in cells:
+            value = cell.value
+            # Read-only cells carry their workbook style index; padding cells have none
+            style_id = getattr(cell, '_style_id', 0)
+            if value is None and not style_id:
+                row.append(EMPTY_CELL)
+                continue
+            number_format = self._number_formats.get(style_id)
+            if number_format is None:
+                number_format = self._number_formats[style_id] = cell.number_format if style_id else 'General'
+            kind = _value_kind(value)
+            row.append((format_cell(value, number_format),
+                        self._class_for(cell, style_id, kind, format_color(value, number_format))))
+        while row and row[-1] is EMPTY_CELL:
+            row.pop()
+        return row
+
+    def values(self):
+        """Value tuples of each row, as iter_rows(values_only=True) would yield"""
+        for row_num, cells in enumerate(self.cell_rows, start=1):
+            values = tuple(cell.value for cell in cells)
+            if self.max_rows is None or row_num <= self.max_rows + 1:
+                self.rows.append(self._style_row(cells))
+            elif any(value is not None for value in values):
+                self._past_cap = cells
+            yield values
+
+    def build(self, scan, first_row=1, first_col=1):
+        """SheetStyles for the scan built from this reader's rows"""
+        cells = self.rows[:scan.last_row]
+        if scan.totals_row and self._past_cap is not None:
+            cells.append(self._style_row(self._past_cap))
+        cells = [row[:scan.last_col] for row in cells]
+
+        # The totals row sits further down the sheet, it gets no layout of its own
+        last_row = first_row + max(scan.last_row, 1) - 1
+        col_widths, row_heights, merges = read_layout(
+            self.worksheet, first_row, last_row, first_col, first_col + max(scan.last_col, 1) - 1
+        )
+        base_css = '; '.join(font_css(self.default_font, self.theme))
+        return SheetStyles(cells, self.classes, base_css, col_widths, row_heights, merges)
+
+
+def _tile_positions(scan, tile):
+    """Scan row and column indexes shown by a tile, header row first"""
+    num_rows = len(scan.rows)
+    num_cols = max(scan.last_col, 1)
+    if tile is None:
+        return list(range(num_rows)) or [0], list(range(num_cols)), True
+    row_start, row_end, col_start, col_end = tile
+    rows = [0] + list(range(row_start + 1, min(row_end, num_rows - 1) + 1))
+    is_last_tile = row_end >= num_rows - 1 and col_end >= num_cols
+    return rows, list(range(col_start, col_end)), is_last_tile
+
+
+def _styled_cells(styles, rows, cols):
+    """
+    Cells of the given scan rows and columns as {row: [(col, text, class_id,
+    rowspan, colspan), ...]}, leaving out the cells covered by a merge
+    """
+    row_position = {row: position for position, row in enumerate(rows)}
+    col_position = {col: position for position, col in enumerate(cols)}
+
+    # Anchor and covered cells of the merges visible in these rows and columns
+    spans = {}
+    covered = set()
+    for top, left, height, width in styles.merges:
+        merged_rows = [row for row in rows if top <= row < top + height]
+        merged_cols = [col for col in cols if left <= col < left + width]
+        if not merged_rows or not merged_cols:
+            continue
+        anchor = (merged_rows[0], merged_cols[0])
+        spans[anchor] = (len(merged_rows), len(merged_cols), (top, left))
+        covered.update((row, col) for row in merged_rows for col in merged_cols)
+        covered.discard(anchor)
+
+    cells = {}
+    for row in rows:
+        row_cells = cells[row] = []
+        for col in cols:
+            if (row, col) in covered:
+                continue
+            row_span, col_span, source = 1, 1, (row, col)
+            if (row, col) in spans:
+                row_span, col_span, source = spans[(row, col)]
+                if source[0] not in row_position or source[1] not in col_position:
+                    source = (row, col)
+            source_cells = styles.cells[source[0]] if source[0] < len(styles.cells) else []
+            text, class_id = source_cells[source[1]] if source[1] < len(source_cells) else ('', 0)
+            row_cells.append((col, text, class_id, row_span, col_span))
+    return cells
+
+
+def write_styled_html(scan, output_path, tile=None, footer_note=None):
+    """
+    Write a scan with SheetStyles (or one tile of it) as an Excel-looking
+    HTML table: one CSS class per distinct cell style, a fixed layout with
+    the sheet's column widths, row heights and merged cells. The header row
+    is repeated on every tile.
+    """
+    styles = scan.styles
+    rows, cols, is_last_tile = _tile_positions(scan, tile)
+    # Hidden rows are left out before the merges are laid out, so no rowspan counts them
+    rows = [row for row in rows if styles.row_heights.get(row) != 0]
+    cells = _styled_cells(styles, rows, cols)
+    highlights = scan.highlights or ()
+
+    used = sorted({class_id for row in rows if row < len(styles.cells)
+                   for _, class_id in styles.cells[row]} - {0})
+    class_css = '\n'.join(f'        .c{class_id} {{ {styles.classes[class_id]} }}' for class_id in used)
+    widths = [styles.col_widths[col] if col < len(styles.col_widths) else DEFAULT_COL_WIDTH_PX for col in cols]
+
+    with track('html'), open_output(output_path, text=True) as out:
+        out.write(STYLED_HEAD.format(base=styles.base_css + ';' if styles.base_css else '', classes=class_css))
+        out.write(f'<table id="excel-table" style="width: {sum(widths)}px">\n<colgroup>')
+        for width in widths:
+            out.write(f'<col style="width: {width}px">' if width else '<col style="visibility: collapse">')
+        out.write('</colgroup>\n<tbody>\n')
+
+        for row in rows:
+            height = styles.row_heights.get(row)
+            out.write(f'<tr style="height: {height:g}pt">' if height else '<tr>')
+            for col, text, class_id, row_span, col_span in cells[row]:
+                attributes = ''
+                if row_span > 1:
+                    attributes += f' rowspan="{row_span}"'
+                if col_span > 1:
+                    attributes += f' colspan="{col_span}"'
+                if class_id:
+                    attributes += f' class="c{class_id}"'
+                if (row, col) in highlights:
+                    attributes += f' style="background-color: {CHANGED_CELL_COLOR}"'
+                out.write(f'<td{attributes}>{html.escape(text)}</td>')
+            out.write('</tr>\n')
+
+        out.write('</tbody>\n')
+        if footer_note and is_last_tile:
+            out.write(f'<tfoot><tr><td colspan="{len(cols)}">{footer_note}</td></tr></tfoot>\n')
+        out.write('</table>\n')
+        out.write(HTML_TAIL)
+
+    logger.info(f"Wrote {len(rows)} styled rows x {len(cols)} columns to {output_path}")
+
+
+def inline_styled_html(scan, footer_note=None):
+    """
+    A scan with SheetStyles as an HTML table for an email body. Mail
+    clients drop <style> blocks, so each cell carries its class CSS inline;
+    hidden rows and columns are left out rather than collapsed.
+    """
+    styles = scan.styles
+    rows, cols, _ = _tile_positions(scan, None)
+    rows = [row for row in rows if styles.row_heights.get(row) != 0]
+    widths = {col: styles.col_widths[col] if col < len(styles.col_widths) else DEFAULT_COL_WIDTH_PX
+              for col in cols}
+    cols = [col for col in cols if widths[col]]
+    cells = _styled_cells(styles, rows, cols)
+
+    cell_css = f"{INLINE_CELL_CSS}; {styles.base_css}" if styles.base_css else INLINE_CELL_CSS
+    parts = [f'<table cellspacing="0" cellpadding="0" style="border-collapse: collapse; table-layout: fixed; '
+             f'width: {sum(widths[col] for col in cols)}px; background-color: white">\n']
+    for position, row in enumerate(rows):
+        height = styles.row_heights.get(row)
+        parts.append(f'<tr style="height: {height:g}pt">' if height else '<tr>')
+        for col, text, class_id, row_span, col_span in cells[row]:
+            css = f"{cell_css}; {styles.classes[class_id]}" if class_id else cell_css
+            if position == 0 and col_span == 1:
+                # The first row fixes the column widths
+                css += f"; width: {widths[col]}px"
+            attributes = ''
+            if row_span > 1:
+                attributes += f' rowspan="{row_span}"'
+            if col_span > 1:
+                attributes += f' colspan="{col_span}"'
+            parts.append(f'<td{attributes} style="{html.escape(css)}">{html.escape(text)}</td>')
+        parts.append('</tr>\n')
+
+    if footer_note:
+        parts.append(f'<tr><td colspan="{len(cols)}" style="{INLINE_FOOTER_CSS}">{footer_note}</td></tr>\n')
+    parts.append('</table>\n')
+    return ''.join(parts)
+
+
+def styled_text_rows(scan):
+    """Display text of every cell of a styled scan, header row first"""
+    num_cols = max(scan.last_col, 1)
+    rows = []
+    for row in scan.styles.cells or [[]]:
+        texts = [text for text, _ in row[:num_cols]]
+        rows.append(texts + [''] * (num_cols - len(texts)))
+    return rows
@@ -0,0 +1,32 @@
+"""
+Gunicorn settings, picked up automatically from the working directory:
+
+    gunicorn 'app:create_app()'
+
+The app is imported once in the master (GUNICORN_PRELOAD, on by default)
+with the parsing and rendering modules preloaded, so workers fork with
+them already in memory and boot without importing anything. Job worker
+threads cannot survive a fork, so each worker starts its own after forking.
+"""
+import os
+import gc
+
+bind = os.getenv('GUNICORN_BIND', f"0.0.0.0:{os.getenv('PORT', '5000')}")
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+preload_app = os.getenv('GUNICORN_PRELOAD', 'true').lower() not in ('0', 'false', 'no')
+
+# Read by app.py at import: no job threads in the master, heavy modules only when preloading
+os.environ.setdefault('JOB_RUNNER', 'post_fork')
+os.environ.setdefault('PRELOAD_MODULES', 'true' if preload_app else 'false')
+
+
+def when_ready(server):
+    if preload_app:
+        # Keep the preloaded objects out of the collector, whose bookkeeping
+        # writes would otherwise copy their pages into every worker
+        gc.freeze()
+
+
+def post_worker_init(worker):
+    from app import start_job_workers
+    start_job_workers()
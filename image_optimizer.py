@@ -0,0 +1,126 @@
+import os
+import logging
+import importlib.util
+from metrics import track, observe_screenshots
+from memory_files import file_size, file_source, with_extension, remove_file, open_output
+
+logger = logging.getLogger(__name__)
+
+EXTENSIONS = {'png': '.png', 'webp': '.webp', 'jpeg': '.jpg'}
+
+
+class ImageBudgetError(Exception):
+    """Raised when screenshots cannot be made to fit the email byte budget"""
+
+
+class ImageOptimizer:
+    """
+    Post-processing for screenshots before they are embedded in an email.
+
+    Caps image dimensions, quantizes to a palette (table screenshots use few
+    colours) and re-encodes as optimized PNG, WebP or JPEG. If the encoded
+    images still exceed the email byte budget they are downscaled step by
+    step, and rejected if they cannot be made to fit.
+    """
+
+    def __init__(self, image_format=None, max_width=None, max_height=None,
+                 quantize=None, budget_bytes=None, min_scale=None):
+        self.image_format = (image_format or os.getenv('IMAGE_FORMAT', 'png')).lower()
+        if self.image_format == 'jpg':
+            self.image_format = 'jpeg'
+        if self.image_format not in EXTENSIONS:
+            raise ValueError(f"Unsupported IMAGE_FORMAT: {self.image_format}")
+
+        self.max_width = max_width or int(os.getenv('IMAGE_MAX_WIDTH', '2400'))
+        self.max_height = max_height or int(os.getenv('IMAGE_MAX_HEIGHT', '10000'))
+        if quantize is None:
+            quantize = os.getenv('IMAGE_QUANTIZE', 'true').lower() not in ('0', 'false', 'no')
+        self.quantize = quantize
+        # Same budget EmailSender applies, measured after base64 encoding
+        self.budget_bytes = budget_bytes or int(float(os.getenv('EMAIL_MAX_MB', '20')) * 1024 * 1024)
+        self.min_scale = min_scale or float(os.getenv('IMAGE_MIN_SCALE', '0.25'))
+
+    @property
+    def available(self):
+        # Without Pillow screenshots are sent as rendered; imported on first use
+        return importlib.util.find_spec('PIL') is not None
+
+    def _encode(self, image, output_path):
+        from PIL import Image
+
+        with open_output(output_path) as f:
+            if self.image_format == 'jpeg':
+                image.convert('RGB').save(f, 'JPEG', quality=85, optimize=True, progressive=True)
+            elif self.image_format == 'webp':
+                image.convert('RGB').save(f, 'WEBP', lossless=self.quantize, quality=85, method=4)
+            else:
+                if self.quantize and image.mode != 'P':
+                    image = image.convert('RGB').quantize(colors=256, method=Image.Quantize.FASTOCTREE)
+                image.save(f, 'PNG', optimize=True)
+        return file_size(output_path)
+
+    def _fit(self, image, scale):
+        """Apply the dimension caps and an extra scale factor"""
+        from PIL import Image
+
+        width, height = image.size
+        factor = min(1.0, self.max_width / width, self.max_height / height) * scale
+        if factor < 1.0:
+            size = (max(1, int(width * factor)), max(1, int(height * factor)))
+            image = image.resize(size, Image.LANCZOS)
+        return image
+
+    def optimize(self, screenshot_paths):
+        """
+        Optimize screenshots in place (the extension changes with the format).
+        Returns the list of new paths, raises ImageBudgetError when the images
+        cannot be brought under the byte budget.
+        """
+        if not self.available:
+            return screenshot_paths
+        from PIL import Image
+
+        before = sum(file_size(path) for path in screenshot_paths)
+        # base64 grows each image by a third once embedded
+        per_image_budget = self.budget_bytes * 3 // 4 // max(len(screenshot_paths), 1)
+
+        output_paths = []
+        try:
+            with track('optimize'):
+                for path in screenshot_paths:
+                    output_path = with_extension(path, EXTENSIONS[self.image_format])
+                    output_paths.append(output_path)
+                    with Image.open(file_source(path)) as original:
+                        original.load()
+
+                    scale = 1.0
+                    while True:
+                        size = self._encode(self._fit(original, scale), output_path)
+                        if size <= per_image_budget:
+                            break
+                        if scale * 0.75 < self.min_scale:
+                            raise ImageBudgetError(
+                                f"Screenshot is {size} bytes at {scale:.2f}x scale, "
+                                f"over the {per_image_budget} byte budget"
+                            )
+                        scale *= 0.75
+                        logger.info(f"Downscaling {path} to {scale:.2f}x to fit the email budget")
+
+        except Exception:
+            # Leave the original screenshots for the caller to clean up
+            for output_path in output_paths:
+                if output_path not in screenshot_paths:
+                    remove_file(output_path)
+            raise
+
+        for path in screenshot_paths:
+            if path not in output_paths:
+                remove_file(path)
+
+        observe_screenshots(output_paths, 'optimized')
+        after = sum(file_size(path) for path in output_paths)
+        logger.info(
+            f"Optimized {len(output_paths)} screenshot(s) as {self.image_format}: "
+            f"{before} -> {after} bytes"
+        )
+        return output_paths
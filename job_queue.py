@@ -0,0 +1,441 @@
+import os
+import json
+import asyncio
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+from metrics import track
+
+logger = logging.getLogger(__name__)
+
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+
+class QueueFullError(Exception):
+    """Raised when a job is submitted while the queue is at capacity"""
+
+
+class JobQueue:
+    """
+    Bounded background job queue persisted to a local SQLite database.
+
+    Jobs are claimed atomically from the database so several gunicorn workers
+    can share one queue file, and jobs left queued (or running in a process
+    that has since died) are picked up again after a restart.
+
+    Each process marks the jobs it runs with its worker_token, and renews a
+    lease on them every lease/3 seconds while its workers run. Running jobs
+    whose lease has not been renewed for lease seconds are requeued, by
+    any process sharing the database.
+
+    Workers are threads by default (start()). Under an ASGI server they can
+    run as tasks on the server loop instead (start_async()), where handlers
+    registered with register_async() are awaited directly.
+    """
+
+    def __init__(self, db_path=None, workers=None, max_pending=None, retention=None, lease=None):
+        self.db_path = db_path or os.getenv('JOB_QUEUE_DB', 'jobs.db')
+        self.workers = workers or int(os.getenv('JOB_WORKERS', '2'))
+        self.max_pending = max_pending or int(os.getenv('JOB_QUEUE_MAX_PENDING', '100'))
+        self.retention = retention or int(os.getenv('JOB_RETENTION_SECONDS', '86400'))
+        self.lease = lease or float(os.getenv('JOB_LEASE_SECONDS', '60'))
+
+        self._handlers = {}
+        self._async_handlers = {}
+        self._wakeup = threading.Condition()
+        self._threads = []
+        self._stopping = False
+        self._heartbeat_thread = None
+        self._heartbeat_stop = threading.Event()
+        self._token = None
+        self._token_pid = None
+
+        # Set while workers run as tasks on an event loop
+        self._loop = None
+        self._async_wakeup = None
+        self._tasks = []
+
+        self._init_db()
+
+    @contextmanager
+    def _connect(self):
+        # Autocommit mode, multi-statement updates use explicit BEGIN IMMEDIATE
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def _init_db(self):
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    worker_pid INTEGER,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    worker_token TEXT,
+                    heartbeat_at REAL
+                )
+            """)
+            # Databases created before worker tokens and leases
+            columns = {row['name'] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, column_type in (('worker_token', 'TEXT'), ('heartbeat_at', 'REAL')):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at)")
+
+    @property
+    def worker_token(self):
+        """
+        Identifies this process in the jobs table. Unlike a pid it is never
+        reused, and a forked worker gets its own.
+        """
+        if self._token_pid != os.getpid():
+            self._token_pid = os.getpid()
+            self._token = f"{self._token_pid}:{uuid.uuid4().hex}"
+        return self._token
+
+    def register(self, kind, handler):
+        """Register the callable that processes jobs of the given kind"""
+        self._handlers[kind] = handler
+
+    def register_async(self, kind, handler):
+        """
+        Register a coroutine function for jobs of the given kind, used by
+        workers started with start_async() instead of the plain handler
+        """
+        self._async_handlers[kind] = handler
+
+    def start(self):
+        """Recover interrupted jobs and start the worker threads"""
+        if self._threads:
+            return
+
+        self._stopping = False
+        self._recover_interrupted()
+        self._prune()
+
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker_loop, name=f'job-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        self._start_heartbeat()
+
+        logger.info(f"Job queue started with {self.workers} worker(s) on {self.db_path}")
+
+    async def start_async(self, workers=None):
+        """
+        Recover interrupted jobs and start worker tasks on the running loop.
+        Tasks are cheap, so workers can be set well above the thread count.
+        """
+        if self._tasks:
+            return
+
+        self._stopping = False
+        await asyncio.to_thread(self._recover_interrupted)
+        await asyncio.to_thread(self._prune)
+
+        self._loop = asyncio.get_running_loop()
+        self._async_wakeup = asyncio.Event()
+        workers = workers or self.workers
+        self._tasks = [
+            asyncio.create_task(self._async_worker_loop(), name=f'job-worker-{i}')
+            for i in range(workers)
+        ]
+        # Leases are renewed from a thread, so a busy loop does not lose them
+        self._start_heartbeat()
+
+        logger.info(f"Job queue started with {workers} async worker(s) on {self.db_path}")
+
+    async def stop_async(self, timeout=None):
+        """Stop the worker tasks once their current jobs have finished"""
+        self._stopping = True
+        if self._async_wakeup is not None:
+            self._async_wakeup.set()
+        if self._tasks:
+            await asyncio.wait(self._tasks, timeout=timeout)
+        self._tasks = []
+        self._loop = None
+        await asyncio.to_thread(self._stop_heartbeat)
+
+    def stop(self, timeout=None):
+        """Stop the worker threads once their current jobs have finished"""
+        with self._wakeup:
+            self._stopping = True
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        self._stop_heartbeat()
+
+    def _start_heartbeat(self):
+        if self._heartbeat_thread is None:
+            self._heartbeat_stop.clear()
+            self._heartbeat_thread = threading.Thread(target=self._heartbeat_loop, name='job-heartbeat',
+                                                      daemon=True)
+            self._heartbeat_thread.start()
+
+    def _stop_heartbeat(self):
+        if self._heartbeat_thread is not None:
+            self._heartbeat_stop.set()
+            self._heartbeat_thread.join()
+            self._heartbeat_thread = None
+
+    def _heartbeat_loop(self):
+        """Renew the lease on this process' jobs and requeue jobs whose lease expired"""
+        while not self._heartbeat_stop.wait(self.lease / 3):
+            try:
+                with self._connect() as conn:
+                    conn.execute(
+                        "UPDATE jobs SET heartbeat_at = ? WHERE worker_token = ? AND status IN (?, ?)",
+                        (time.time(), self.worker_token, STATUS_QUEUED, STATUS_RUNNING)
+                    )
+                self._recover_interrupted()
+            except sqlite3.Error as e:
+                logger.error(f"Error renewing job leases: {e}")
+
+    def submit(self, kind, payload, pinned=False):
+        """
+        Persist a new job and wake a worker
+        pinned jobs are only claimed by this process, e.g. when the payload
+        refers to an upload held in its memory.
+        Returns the job id, raises QueueFullError when the queue is full
+        """
+        if kind not in self._handlers and kind not in self._async_handlers:
+            raise ValueError(f"No handler registered for job kind: {kind}")
+
+        job_id = uuid.uuid4().hex
+        now = time.time()
+
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            pending = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = ?", (STATUS_QUEUED,)
+            ).fetchone()[0]
+            if pending >= self.max_pending:
+                conn.execute("ROLLBACK")
+                raise QueueFullError(f"Job queue is full ({pending} pending jobs)")
+
+            conn.execute(
+                "INSERT INTO jobs (id, kind, payload, status, worker_pid, worker_token, heartbeat_at, "
+                "created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, kind, json.dumps(payload), STATUS_QUEUED, os.getpid() if pinned else None,
+                 self.worker_token if pinned else None, now if pinned else None, now, now)
+            )
+            conn.execute("COMMIT")
+
+        with self._wakeup:
+            self._wakeup.notify()
+        if self._loop is not None:
+            # submit() is called from request threads, not from the loop
+            self._loop.call_soon_threadsafe(self._async_wakeup.set)
+
+        logger.info(f"Job {job_id} queued ({kind})")
+        return job_id
+
+    def get(self, job_id):
+        """Return the public status of a job or None if it does not exist"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+        if row is None:
+            return None
+
+        job = {
+            'job_id': row['id'],
+            'kind': row['kind'],
+            'status': row['status'],
+            'created_at': row['created_at'],
+            'updated_at': row['updated_at'],
+        }
+        if row['result'] is not None:
+            job['result'] = json.loads(row['result'])
+        if row['error'] is not None:
+            job['error'] = row['error']
+        return job
+
+    def stats(self):
+        """Return job counts by status"""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+    def _claim_next(self):
+        """Atomically mark the oldest queued job as running and return it"""
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            # Queued jobs with a worker_token are pinned to that process
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status = ? AND (worker_token IS NULL OR worker_token = ?) "
+                "ORDER BY created_at LIMIT 1",
+                (STATUS_QUEUED, self.worker_token)
+            ).fetchone()
+            if row is None:
+                conn.execute("ROLLBACK")
+                return None
+
+            now = time.time()
+            conn.execute(
+                "UPDATE jobs SET status = ?, worker_pid = ?, worker_token = ?, heartbeat_at = ?, updated_at = ? "
+                "WHERE id = ?",
+                (STATUS_RUNNING, os.getpid(), self.worker_token, now, now, row['id'])
+            )
+            conn.execute("COMMIT")
+            return row
+
+    def _finish(self, job_id, status, result=None, error=None):
+        with self._connect() as conn:
+            # A job whose lease expired may have been requeued and claimed by another worker
+            updated = conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, updated_at = ? "
+                "WHERE id = ? AND status = ? AND worker_token = ?",
+                (status, json.dumps(result) if result is not None else None, error,
+                 time.time(), job_id, STATUS_RUNNING, self.worker_token)
+            ).rowcount
+        if not updated:
+            logger.warning(f"Job {job_id} lost its lease before it finished, result not recorded")
+
+    def _worker_loop(self):
+        while not self._stopping:
+            try:
+                row = self._claim_next()
+            except sqlite3.Error as e:
+                logger.error(f"Error claiming job: {e}")
+                row = None
+
+            if row is None:
+                # Poll as well as wait, other processes may enqueue into the same database
+                with self._wakeup:
+                    if not self._stopping:
+                        self._wakeup.wait(timeout=1.0)
+                continue
+
+            self._run_job(row)
+
+    def _run_job(self, row):
+        job_id = row['id']
+        handler = self._handlers.get(row['kind'])
+        logger.info(f"Job {job_id} started ({row['kind']})")
+
+        try:
+            if handler is None:
+                raise ValueError(f"No handler registered for job kind: {row['kind']}")
+            with track(f"job_{row['kind']}"):
+                result = handler(json.loads(row['payload']))
+            self._finish(job_id, STATUS_DONE, result=result)
+            logger.info(f"Job {job_id} finished")
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {e}")
+            self._finish(job_id, STATUS_FAILED, error=str(e))
+
+    async def _async_worker_loop(self):
+        while not self._stopping:
+            # Cleared before claiming so a submit() during the claim is not missed
+            self._async_wakeup.clear()
+            try:
+                row = await asyncio.to_thread(self._claim_next)
+            except sqlite3.Error as e:
+                logger.error(f"Error claiming job: {e}")
+                row = None
+
+            if row is None:
+                # Poll as well as wait, other processes may enqueue into the same database
+                try:
+                    await asyncio.wait_for(self._async_wakeup.wait(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._run_job_async(row)
+
+    async def _run_job_async(self, row):
+        job_id = row['id']
+        handler = self._async_handlers.get(row['kind'])
+        logger.info(f"Job {job_id} started ({row['kind']})")
+
+        try:
+            payload = json.loads(row['payload'])
+            with track(f"job_{row['kind']}"):
+                if handler is not None:
+                    result = await handler(payload)
+                elif row['kind'] in self._handlers:
+                    # Plain handlers block, keep them off the loop
+                    result = await asyncio.to_thread(self._handlers[row['kind']], payload)
+                else:
+                    raise ValueError(f"No handler registered for job kind: {row['kind']}")
+            await asyncio.to_thread(self._finish, job_id, STATUS_DONE, result)
+            logger.info(f"Job {job_id} finished")
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {e}")
+            await asyncio.to_thread(self._finish, job_id, STATUS_FAILED, None, str(e))
+
+    def _recover_interrupted(self):
+        """
+        Requeue running jobs whose worker process has died, and fail queued
+        jobs pinned to such a process. A worker whose pid is gone is dead
+        at once; a live pid may belong to another process by now, so
+        otherwise the worker is dead once its lease has expired.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, status, worker_pid, worker_token, COALESCE(heartbeat_at, updated_at) AS heartbeat_at "
+                "FROM jobs WHERE status = ? OR (status = ? AND worker_token IS NOT NULL)",
+                (STATUS_RUNNING, STATUS_QUEUED)
+            ).fetchall()
+            for row in rows:
+                if row['worker_token'] == self.worker_token:
+                    continue
+                if row['heartbeat_at'] > now - self.lease and _pid_alive(row['worker_pid']):
+                    continue
+
+                if row['status'] == STATUS_QUEUED:
+                    conn.execute(
+                        "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ? AND status = ? "
+                        "AND worker_token = ?",
+                        (STATUS_FAILED, f"Job was pinned to process {row['worker_pid']}, which has exited",
+                         now, row['id'], STATUS_QUEUED, row['worker_token'])
+                    )
+                    logger.warning(f"Failed job {row['id']} pinned to exited process {row['worker_pid']}")
+                else:
+                    conn.execute(
+                        "UPDATE jobs SET status = ?, worker_pid = NULL, worker_token = NULL, heartbeat_at = NULL, "
+                        "updated_at = ? WHERE id = ? AND status = ? AND worker_token IS ?",
+                        (STATUS_QUEUED, now, row['id'], STATUS_RUNNING, row['worker_token'])
+                    )
+                    logger.info(f"Requeued interrupted job {row['id']}")
+
+    def _prune(self):
+        """Delete finished jobs older than the retention period"""
+        cutoff = time.time() - self.retention
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?",
+                (STATUS_DONE, STATUS_FAILED, cutoff)
+            )
+
+
+def _pid_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
@@ -0,0 +1,138 @@
+import io
+import os
+import uuid
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+MEMORY_PREFIX = 'memory:'
+
+
+class MemoryFile:
+    """
+    File contents kept in memory where the pipeline would otherwise use a
+    path on disk: a small upload, its screenshots and the HTML they are
+    rendered from. name carries the file name and extension.
+    """
+
+    def __init__(self, name, data=b''):
+        self.name = name
+        self.data = data
+
+    def open(self):
+        return io.BytesIO(self.data)
+
+    def sha256(self):
+        return hashlib.sha256(self.data).hexdigest()
+
+    def __str__(self):
+        return f"{MEMORY_PREFIX}{self.name}"
+
+    def __repr__(self):
+        return f"<MemoryFile {self.name} ({len(self.data)} bytes)>"
+
+
+# Path helpers that also accept MemoryFiles
+
+def file_name(path):
+    return path.name if isinstance(path, MemoryFile) else os.path.basename(path)
+
+
+def file_size(path):
+    return len(path.data) if isinstance(path, MemoryFile) else os.path.getsize(path)
+
+
+def file_exists(path):
+    return bool(path.data) if isinstance(path, MemoryFile) else os.path.exists(path)
+
+
+def read_file(path):
+    if isinstance(path, MemoryFile):
+        return path.data
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def file_source(path):
+    """Something openpyxl, pandas and Pillow can read: the path, or a buffer over the data"""
+    return path.open() if isinstance(path, MemoryFile) else path
+
+
+def with_extension(path, extension):
+    """The path with another extension; a MemoryFile is renamed in a new object"""
+    if isinstance(path, MemoryFile):
+        name = os.path.splitext(path.name)[0] + extension
+        return path if name == path.name else MemoryFile(name)
+    return os.path.splitext(path)[0] + extension
+
+
+def remove_file(path):
+    """Delete a file on disk; a MemoryFile just drops its data"""
+    if isinstance(path, MemoryFile):
+        path.data = b''
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+@contextmanager
+def open_output(path, text=False):
+    """
+    Open a path for writing, or collect what is written into a MemoryFile.
+    The MemoryFile only receives the data if the block completes.
+    """
+    if not isinstance(path, MemoryFile):
+        with open(path, 'w', encoding='utf-8') if text else open(path, 'wb') as f:
+            yield f
+        return
+
+    buffer = io.StringIO() if text else io.BytesIO()
+    yield buffer
+    value = buffer.getvalue()
+    path.data = value.encode('utf-8') if text else value
+
+
+class MemoryUploads:
+    """
+    Uploads held in memory until their job is done with them. Job payloads
+    refer to them by a 'memory:<id>_<name>' key, which only resolves in the
+    process that received the upload (see JobQueue.submit(pinned=True)).
+    Uploads that would take the store over max_bytes are refused, and the
+    caller keeps them on disk instead.
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes or int(float(os.getenv('MEMORY_UPLOADS_MAX_MB', '256')) * 1024 * 1024)
+        self._files = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def put(self, memory_file):
+        """Keep an upload, returns its key, or None if the store is full"""
+        with self._lock:
+            if self._bytes + len(memory_file.data) > self.max_bytes:
+                return None
+            key = f"{MEMORY_PREFIX}{uuid.uuid4()}_{memory_file.name}"
+            self._files[key] = memory_file
+            self._bytes += len(memory_file.data)
+        return key
+
+    def get(self, key):
+        with self._lock:
+            return self._files.get(key)
+
+    def remove(self, key):
+        with self._lock:
+            memory_file = self._files.pop(key, None)
+            if memory_file is not None:
+                self._bytes -= len(memory_file.data)
+
+    def stats(self):
+        with self._lock:
+            return {'uploads': len(self._files), 'bytes': self._bytes, 'max_bytes': self.max_bytes}
+
+
+def is_memory_key(filepath):
+    return isinstance(filepath, str) and filepath.startswith(MEMORY_PREFIX)
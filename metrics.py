@@ -0,0 +1,206 @@
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+try:
+    from opentelemetry import trace
+except ImportError:  # Spans are only recorded when OpenTelemetry is installed
+    trace = None
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'excel_mail_'
+
+# Seconds, from a cache hit up to a slow multi-tile render
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Bytes, from a small table up to the email budget
+SIZE_BUCKETS = (10_000, 50_000, 100_000, 250_000, 500_000, 1_000_000, 2_500_000, 5_000_000, 10_000_000, 20_000_000)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (extra or [])
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    """Base for a labelled metric family, values are kept per label tuple"""
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_sample(key, value))
+        return lines
+
+    def _render_sample(self, key, value):
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}']
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def _render_sample(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+        lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+STAGE_SECONDS = Histogram('stage_seconds', 'Time spent in each pipeline stage', ['stage'])
+STAGE_IN_FLIGHT = Gauge('stage_in_flight', 'Pipeline stages currently running', ['stage'])
+STAGE_ERRORS = Counter('stage_errors_total', 'Pipeline stages that raised an exception', ['stage'])
+SCREENSHOT_BYTES = Histogram('screenshot_bytes', 'Size of each screenshot image', ['phase'],
+                             buckets=SIZE_BUCKETS)
+HTTP_SECONDS = Histogram('http_request_seconds', 'Time spent handling HTTP requests', ['endpoint', 'status'])
+HTTP_IN_FLIGHT = Gauge('http_requests_in_flight', 'HTTP requests currently being handled')
+
+_metrics = [STAGE_SECONDS, STAGE_IN_FLIGHT, STAGE_ERRORS, SCREENSHOT_BYTES, HTTP_SECONDS, HTTP_IN_FLIGHT]
+_collectors = []
+
+_tracer = None
+if trace is not None and os.getenv('OTEL_TRACING', 'true').lower() not in ('0', 'false', 'no'):
+    # A no-op tracer unless an OpenTelemetry SDK is configured by the deployment
+    _tracer = trace.get_tracer('excel_mail')
+
+
+@contextmanager
+def track(stage, **attributes):
+    """
+    Time a pipeline stage: records its latency and in-flight count, counts
+    exceptions raised through it, and wraps it in a trace span when
+    OpenTelemetry is available. Works around awaits in coroutines too.
+    """
+    span = _tracer.start_as_current_span(stage, attributes=attributes) if _tracer else None
+    if span is not None:
+        span.__enter__()
+    STAGE_IN_FLIGHT.inc(stage=stage)
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = e
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage)
+        STAGE_IN_FLIGHT.dec(stage=stage)
+        if span is not None:
+            span.__exit__(type(error) if error else None, error, error.__traceback__ if error else None)
+
+
+def observe_screenshots(paths, phase):
+    """Record the size of each screenshot"""
+    from memory_files import file_size
+    for path in paths:
+        try:
+            SCREENSHOT_BYTES.observe(file_size(path), phase=phase)
+        except OSError:
+            pass
+
+
+def register_collector(collect):
+    """
+    Register a callable polled at scrape time. It returns a list of
+    (name, type, documentation, [(labels_dict, value), ...]) tuples, used for
+    pool and cache stats that their owners already keep.
+    """
+    _collectors.append(collect)
+
+
+def render():
+    """Render every metric in the Prometheus text exposition format"""
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+
+    for collect in _collectors:
+        try:
+            families = collect()
+        except Exception as e:
+            logger.warning(f"Metrics collector failed: {e}")
+            continue
+        for name, metric_type, documentation, samples in families:
+            name = PREFIX + name
+            lines.append(f'# HELP {name} {documentation}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for labels, value in samples:
+                label_text = _format_labels(list(labels), list(labels.values()))
+                lines.append(f'{name}{label_text} {_format_value(value)}')
+
+    return '\n'.join(lines) + '\n'
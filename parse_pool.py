@@ -0,0 +1,187 @@
+import os
+import sys
+import signal
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import resource
+except ImportError:  # Not available on Windows, memory caps are skipped there
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+
+class ParseTimeoutError(Exception):
+    """Raised when a workbook takes longer than the parse timeout"""
+
+
+class ParseWorkerError(Exception):
+    """Raised when a parse worker process dies, e.g. by hitting its memory cap"""
+
+
+def _init_worker(memory_bytes):
+    # One BLAS thread is plenty for parsing and keeps the address space small
+    os.environ.setdefault('OPENBLAS_NUM_THREADS', '1')
+    os.environ.setdefault('OMP_NUM_THREADS', '1')
+    if memory_bytes and resource is not None:
+        _, hard = resource.getrlimit(resource.RLIMIT_AS)
+        resource.setrlimit(resource.RLIMIT_AS, (memory_bytes, hard))
+
+
+def _on_alarm(signum, frame):
+    raise ParseTimeoutError('Workbook parsing timed out')
+
+
+def _run_limited(timeout, func, *args):
+    """Run func in the worker, interrupting it after timeout seconds"""
+    if timeout:
+        signal.signal(signal.SIGALRM, _on_alarm)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return func(*args)
+    finally:
+        if timeout:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+def _scan_sheet_task(filepath, max_rows, max_cols, cell_range, totals, styled):
+    from sheet_scanner import scan_sheet
+    return scan_sheet(filepath, max_rows, max_cols, cell_range, totals, styled)
+
+
+def _scan_selection_task(filepath, sheets, ranges, max_rows, max_cols, styled):
+    from sheet_scanner import scan_selection
+    return scan_selection(filepath, sheets, ranges, max_rows, max_cols, styled)
+
+
+def _write_html_task(jobs):
+    from excel_processor import write_table_html
+    from memory_files import MemoryFile
+    for scan, tile, output_path, footer_note in jobs:
+        write_table_html(scan, output_path, tile, footer_note)
+    # MemoryFiles were filled in this process, send their contents back
+    return [path.data if isinstance(path, MemoryFile) else None for _, _, path, _ in jobs]
+
+
+class ParsePool:
+    """
+    Pool of worker processes for GIL-bound workbook parsing and HTML
+    generation, so a large workbook does not stall the web worker's threads.
+
+    Results come back as SheetScans, which only hold the values within the
+    render caps rather than the whole workbook. Each task is interrupted
+    after timeout seconds, and each worker's address space is capped at
+    memory_mb, so a pathological workbook fails its own job instead of
+    hanging or exhausting the web worker. A worker that dies or stops
+    responding takes the pool down with it and a fresh pool is started.
+    The pool is started lazily so it is safe to create before gunicorn forks.
+    """
+
+    def __init__(self, workers=None, timeout=None, memory_mb=None, max_tasks_per_worker=None):
+        self.workers = workers or int(os.getenv('PARSE_WORKERS', '2'))
+        self.timeout = timeout or float(os.getenv('PARSE_TIMEOUT', '60'))
+        self.memory_mb = memory_mb or int(os.getenv('PARSE_MEMORY_MB', '2048'))
+        self.max_tasks_per_worker = max_tasks_per_worker or int(os.getenv('PARSE_MAX_TASKS_PER_WORKER', '100'))
+
+        self._executor = None
+        self._lock = threading.Lock()
+        self.tasks = 0
+        self.timeouts = 0
+        self.crashes = 0
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # Forking a process that runs browser and job threads is unsafe
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+                options = {}
+                if sys.version_info >= (3, 11):
+                    # Recycle workers now and then, parsers can leak memory
+                    options['max_tasks_per_child'] = self.max_tasks_per_worker
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=context,
+                    initializer=_init_worker,
+                    initargs=(self.memory_mb * 1024 * 1024,),
+                    **options
+                )
+                logger.info(f"Parse pool started with {self.workers} worker(s)")
+            return self._executor
+
+    def _restart(self, executor):
+        """Kill every worker of a stuck or broken pool, the next task starts a new one"""
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+
+        for process in list((executor._processes or {}).values()):
+            process.kill()
+        executor.shutdown(wait=False, cancel_futures=True)
+        logger.warning("Parse pool restarted")
+
+    def run(self, func, *args):
+        """Run a task in a worker process with the pool's timeout and memory cap"""
+        executor = self._get_executor()
+        with self._lock:
+            self.tasks += 1
+
+        try:
+            future = executor.submit(_run_limited, self.timeout, func, *args)
+            # The worker interrupts itself at the timeout; the grace period covers
+            # work that cannot be interrupted, such as a long call into C code
+            return future.result(timeout=self.timeout + 10)
+        except FutureTimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            self._restart(executor)
+            raise ParseTimeoutError(f"Workbook parsing did not finish within {self.timeout:g}s")
+        except ParseTimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            raise
+        except BrokenProcessPool:
+            with self._lock:
+                self.crashes += 1
+            self._restart(executor)
+            raise ParseWorkerError('Parse worker died, the workbook may exceed the memory limit')
+        except MemoryError:
+            raise ParseWorkerError(f"Workbook exceeds the {self.memory_mb}MB parse memory limit")
+
+    def scan_sheet(self, filepath, max_rows=None, max_cols=None, cell_range=None, totals=False, styled=False):
+        """scan_sheet() in a worker process"""
+        return self.run(_scan_sheet_task, filepath, max_rows, max_cols, cell_range, totals, styled)
+
+    def scan_selection(self, filepath, sheets=None, ranges=None, max_rows=None, max_cols=None, styled=False):
+        """scan_selection() in a worker process"""
+        return self.run(_scan_selection_task, filepath, sheets, ranges, max_rows, max_cols, styled)
+
+    def write_html(self, jobs):
+        """
+        Write (scan, tile, output_path, footer_note) HTML tables in a worker
+        process. Returns the HTML of each MemoryFile output_path, None for paths.
+        """
+        return self.run(_write_html_task, jobs)
+
+    def stats(self):
+        """Return task counters"""
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'started': self._executor is not None,
+                'tasks': self.tasks,
+                'timeouts': self.timeouts,
+                'crashes': self.crashes,
+            }
+
+    def close(self):
+        """Shut down the worker processes"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,206 @@
+import os
+import asyncio
+import logging
+import importlib.util
+from sheet_scanner import format_value, CHANGED_CELL_COLOR
+from metrics import track
+from memory_files import open_output
+
+logger = logging.getLogger(__name__)
+
+
+class TableRenderer:
+    """
+    Interface for backends that turn a SheetScan into PNG images.
+    """
+
+    name = None
+
+    def can_render(self, scan):
+        """Return True if this backend can render the scan faithfully"""
+        raise NotImplementedError
+
+    def render(self, scan, tiles, output_paths, footer_note=None):
+        """
+        Render each tile of the scan to the matching output path.
+        footer_note is drawn under the last tile when given.
+        Returns True if every image was written
+        """
+        raise NotImplementedError
+
+    async def render_async(self, scan, tiles, output_paths, footer_note=None):
+        """
+        render() for callers on an event loop. CPU-bound backends run in a
+        worker thread; backends with native async I/O override this.
+        """
+        return await asyncio.to_thread(self.render, scan, tiles, output_paths, footer_note)
+
+    def render_many(self, jobs):
+        """
+        Render several (scan, tiles, output_paths, footer_note) jobs, e.g. one
+        per sheet. Returns True if every image was written
+        """
+        return all([self.render(*job) for job in jobs])
+
+    async def render_many_async(self, jobs):
+        """render_many() for callers on an event loop"""
+        return await asyncio.to_thread(self.render_many, jobs)
+
+
+class PillowTableRenderer(TableRenderer):
+    """
+    Draws the table straight to PNG with Pillow, no browser involved.
+
+    Mirrors the CSS used for the Playwright renderer: Arial-like 16px text,
+    8px cell padding, 1px #ddd borders, a bold #f2f2f2 header row, zebra
+    striped body rows and a table at least as wide as the viewport content
+    area. Only used for simple sheets (single-line text, bounded size).
+    """
+
+    name = 'pillow'
+
+    FONT_SIZE = 16
+    PADDING = 8
+    BORDER_COLOR = (221, 221, 221)
+    HEADER_FILL = (242, 242, 242)
+    STRIPE_FILL = (249, 249, 249)
+    TEXT_COLOR = (0, 0, 0)
+    CHANGED_FILL = tuple(int(CHANGED_CELL_COLOR[i:i + 2], 16) for i in (1, 3, 5))
+
+    REGULAR_FONTS = ('arial.ttf', 'Arial.ttf', 'LiberationSans-Regular.ttf', 'DejaVuSans.ttf')
+    BOLD_FONTS = ('arialbd.ttf', 'Arial Bold.ttf', 'LiberationSans-Bold.ttf', 'DejaVuSans-Bold.ttf')
+
+    def __init__(self, min_width=1160, max_cells=None, max_text_length=None):
+        # Viewport width minus the 20px body margin on each side
+        self.min_width = min_width
+        self.max_cells = max_cells or int(os.getenv('PILLOW_MAX_CELLS', '20000'))
+        self.max_text_length = max_text_length or int(os.getenv('PILLOW_MAX_TEXT_LENGTH', '200'))
+        self._fonts = None
+
+    @property
+    def available(self):
+        # Pillow is optional, the Playwright renderer is the fallback; imported on first render
+        return importlib.util.find_spec('PIL') is not None
+
+    def _load_font(self, env_name, candidates):
+        from PIL import ImageFont
+
+        names = [os.getenv(env_name)] if os.getenv(env_name) else []
+        for name in names + list(candidates):
+            try:
+                return ImageFont.truetype(name, self.FONT_SIZE)
+            except OSError:
+                continue
+        logger.warning(f"No TrueType font found for {env_name}, using Pillow default font")
+        return ImageFont.load_default(size=self.FONT_SIZE)
+
+    def fonts(self):
+        if self._fonts is None:
+            self._fonts = (
+                self._load_font('PILLOW_FONT', self.REGULAR_FONTS),
+                self._load_font('PILLOW_FONT_BOLD', self.BOLD_FONTS),
+            )
+        return self._fonts
+
+    def can_render(self, scan):
+        if not self.available or scan.styles is not None:
+            # Excel formatting needs the browser
+            return False
+
+        if len(scan.rows) * max(scan.last_col, 1) > self.max_cells:
+            return False
+
+        for row in scan.rows:
+            for value in row:
+                if isinstance(value, str) and ('\n' in value or len(value) > self.max_text_length):
+                    return False
+        return True
+
+    def render(self, scan, tiles, output_paths, footer_note=None):
+        try:
+            with track('render_pillow'):
+                for tile, output_path in zip(tiles, output_paths):
+                    header, rows, is_last_tile = scan.tile_view(tile)
+                    self._render_table(header, rows, output_path, footer_note if is_last_tile else None,
+                                       scan.tile_highlights(tile))
+            return True
+
+        except Exception as e:
+            logger.error(f"Error rendering table with Pillow: {e}")
+            return False
+
+    def _render_table(self, header, rows, output_path, footer_note, highlights=()):
+        from PIL import Image, ImageDraw
+
+        regular, bold = self.fonts()
+        header = [format_value(value) for value in header]
+        rows = [[format_value(value) for value in row] for row in rows]
+
+        # Natural column widths from the widest text in each column
+        widths = [bold.getlength(text) for text in header]
+        for row in rows:
+            for col, text in enumerate(row):
+                widths[col] = max(widths[col], regular.getlength(text))
+        widths = [int(width + 0.999) + 2 * self.PADDING for width in widths]
+
+        # width: 100% distributes the spare width in proportion to content
+        natural = sum(widths) + len(widths) + 1
+        if natural < self.min_width and sum(widths):
+            spare = self.min_width - natural
+            total = sum(widths)
+            widths = [width + spare * width // total for width in widths]
+            widths[-1] += self.min_width - (sum(widths) + len(widths) + 1)
+
+        ascent, descent = regular.getmetrics()
+        row_height = ascent + descent + 2 * self.PADDING
+        num_rows = 1 + len(rows) + (1 if footer_note else 0)
+
+        image_width = sum(widths) + len(widths) + 1
+        image_height = num_rows * (row_height + 1) + 1
+
+        image = Image.new('RGB', (image_width, image_height), 'white')
+        draw = ImageDraw.Draw(image)
+
+        # Row backgrounds: header, then every second body row (tr:nth-child(even))
+        draw.rectangle([0, 0, image_width - 1, row_height + 1], fill=self.HEADER_FILL)
+        for index in range(1, len(rows), 2):
+            top = (index + 1) * (row_height + 1)
+            draw.rectangle([0, top, image_width - 1, top + row_height + 1], fill=self.STRIPE_FILL)
+
+        # Changed cells, (row, col) with row 0 the header
+        for row_index, col in highlights:
+            top = row_index * (row_height + 1)
+            left = sum(widths[:col]) + col
+            draw.rectangle([left, top, left + widths[col] + 1, top + row_height + 1], fill=self.CHANGED_FILL)
+
+        # Cell text
+        for row_index, (cells, font) in enumerate([(header, bold)] + [(row, regular) for row in rows]):
+            top = row_index * (row_height + 1) + 1
+            left = 1
+            for col, text in enumerate(cells):
+                if text:
+                    draw.text((left + self.PADDING, top + self.PADDING), text,
+                              font=font, fill=self.TEXT_COLOR)
+                left += widths[col] + 1
+
+        if footer_note:
+            top = (num_rows - 1) * (row_height + 1) + 1
+            draw.text((1 + self.PADDING, top + self.PADDING), footer_note,
+                      font=regular, fill=self.TEXT_COLOR)
+
+        # Grid lines, border-collapse gives a single 1px line between cells
+        for row_index in range(num_rows + 1):
+            y = row_index * (row_height + 1)
+            draw.line([(0, y), (image_width - 1, y)], fill=self.BORDER_COLOR)
+        x = 0
+        grid_bottom = (num_rows - (1 if footer_note else 0)) * (row_height + 1)
+        for width in [0] + widths:
+            x += width + (1 if width else 0)
+            draw.line([(x, 0), (x, grid_bottom)], fill=self.BORDER_COLOR)
+        draw.line([(0, 0), (0, image_height - 1)], fill=self.BORDER_COLOR)
+        draw.line([(image_width - 1, 0), (image_width - 1, image_height - 1)], fill=self.BORDER_COLOR)
+
+        # Favour encoding speed over file size
+        with open_output(output_path) as f:
+            image.save(f, 'PNG', compress_level=1)
+        logger.info(f"Rendered {len(rows)} rows x {len(header)} columns with Pillow to {output_path}")
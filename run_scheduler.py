@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Scheduled report runner: watches REPORTS_DIR and emails workbooks as
+configured in SCHEDULE_FILE (see scheduler.py for the format)
+"""
+import os
+import sys
+import signal
+import argparse
+from config import Config
+
+def check_environment(schedule_path):
+    """Check that the scheduler can run"""
+    print("Checking scheduler setup...")
+    
+    # Check email configuration
+    if not Config.validate_email_config():
+        print("❌ Error: Email configuration incomplete")
+        return False
+    
+    if not os.path.exists(schedule_path):
+        print(f"❌ Error: Schedule file not found: {schedule_path}")
+        print("Create it with one line per report, e.g.: 0 7 * * 1-5  sales.xlsx  team@example.com")
+        return False
+    
+    print("✅ Scheduler setup looks good!")
+    return True
+
+def run_scheduler():
+    """Run the report scheduler"""
+    parser = argparse.ArgumentParser(description='Email workbooks from a watched directory on a schedule')
+    parser.add_argument('--schedule', default=os.getenv('SCHEDULE_FILE', 'schedule.txt'),
+                        help='schedule file (default: SCHEDULE_FILE or schedule.txt)')
+    parser.add_argument('--watch', default=os.getenv('REPORTS_DIR', 'reports'),
+                        help='directory with the workbooks (default: REPORTS_DIR or reports)')
+    parser.add_argument('--once', action='store_true',
+                        help='send every changed workbook now, wait for the emails and exit')
+    args = parser.parse_args()
+
+    if not check_environment(args.schedule):
+        print("Please fix the setup issues before running the scheduler")
+        sys.exit(1)
+
+    try:
+        from app import (job_queue, parse_sheet_selection, parse_view_options,
+                         EMAIL_PATTERN, BATCH_MAX_RECIPIENTS, UPLOAD_FOLDER)
+        from scheduler import ReportScheduler
+    except ImportError as e:
+        print(f"❌ Error importing app: {e}")
+        print("Make sure all dependencies are installed: pip install -r requirements.txt")
+        sys.exit(1)
+
+    scheduler = ReportScheduler(
+        job_queue, UPLOAD_FOLDER, parse_sheet_selection, parse_view_options,
+        EMAIL_PATTERN, BATCH_MAX_RECIPIENTS,
+        schedule_path=args.schedule, watch_dir=args.watch
+    )
+
+    if args.once:
+        pending = scheduler.run_once()
+        job_queue.stop()
+        if pending:
+            print(f"⚠️  {pending} report(s) were still being sent")
+            sys.exit(1)
+        return
+
+    print(f"Watching {args.watch} with schedule {args.schedule}")
+    print("Press Ctrl+C to stop the scheduler")
+    signal.signal(signal.SIGTERM, lambda signum, frame: scheduler.stop())
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        job_queue.stop()
+
+if __name__ == "__main__":
+    run_scheduler()
@@ -0,0 +1,418 @@
+"""
+Scheduled and on-change reports from a watched directory.
+
+The schedule file has one report per line:
+
+    # schedule        workbook          recipients                options
+    0 7 * * 1-5       sales.xlsx        ops@example.com,cfo@example.com   sheets=all
+    @daily            finance/*.xlsx    finance@example.com       style=excel top=20
+    @change           inventory.xlsx    warehouse@example.com
+
+The schedule is a five field cron expression (minute hour day month
+weekday), an @hourly/@daily/@weekly/@monthly/@yearly macro, or @change to
+send whenever the file changes. Workbook paths are relative to the watched
+directory and may be glob patterns. Options are the upload form fields
+(sheets, ranges, cell_range, max_rows, max_cols, top, style, format,
+highlight_changes); values with spaces can be quoted.
+
+A workbook is only sent when its content hash differs from the last one
+sent to that line's recipients, so re-saved but unchanged files cost no
+rendering or SMTP time. Sends go through the job queue as batch jobs.
+"""
+import os
+import json
+import time
+import shlex
+import uuid
+import fnmatch
+import hashlib
+import logging
+import threading
+import datetime
+from werkzeug.utils import secure_filename
+from job_queue import QueueFullError, STATUS_DONE, STATUS_FAILED
+
+logger = logging.getLogger(__name__)
+
+CHANGE_TRIGGER = '@change'
+
+
+class CronSchedule:
+    """A five field cron expression, matched against local time a minute at a time"""
+
+    MACROS = {
+        '@hourly': '0 * * * *',
+        '@daily': '0 0 * * *',
+        '@midnight': '0 0 * * *',
+        '@weekly': '0 0 * * 0',
+        '@monthly': '0 0 1 * *',
+        '@yearly': '0 0 1 1 *',
+        '@annually': '0 0 1 1 *',
+    }
+    # minute, hour, day of month, month, day of week (0 and 7 are Sunday)
+    BOUNDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression):
+        self.expression = expression
+        fields = self.MACROS.get(expression, expression).split()
+        if len(fields) != 5:
+            raise ValueError(f"Invalid schedule: {expression}")
+
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            self._parse_field(field, low, high) for field, (low, high) in zip(fields, self.BOUNDS)
+        )
+        if 7 in self.weekdays:
+            self.weekdays = (self.weekdays - {7}) | {0}
+        # Like cron, a restricted day of month and day of week match either one
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    def _parse_field(self, field, low, high):
+        values = set()
+        for part in field.split(','):
+            base, _, step = part.partition('/')
+            try:
+                step = int(step) if step else 1
+                if base == '*':
+                    start, end = low, high
+                elif '-' in base:
+                    start, end = (int(value) for value in base.split('-', 1))
+                else:
+                    start = int(base)
+                    end = high if step > 1 else start
+            except ValueError:
+                raise ValueError(f"Invalid schedule: {self.expression}")
+            if step < 1 or not low <= start <= end <= high:
+                raise ValueError(f"Invalid schedule: {self.expression}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def matches(self, moment):
+        """True if the schedule fires in the minute of moment"""
+        if moment.minute not in self.minutes or moment.hour not in self.hours \
+                or moment.month not in self.months:
+            return False
+        day = moment.day in self.days
+        weekday = moment.isoweekday() % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+
+class ScheduledReport:
+    """One line of the schedule file"""
+
+    def __init__(self, schedule, pattern, recipients, selection=None, view=None, line_number=None):
+        self.schedule = schedule  # CronSchedule, or None to send on change
+        self.pattern = pattern
+        self.recipients = recipients
+        self.selection = selection
+        self.view = view
+        self.line_number = line_number
+
+    def state_key(self, relative_path):
+        """Identity of this report for one file, for remembering what was last sent"""
+        identity = json.dumps([relative_path, sorted(r.lower() for r in self.recipients),
+                               self.selection, self.view], sort_keys=True)
+        return hashlib.sha256(identity.encode()).hexdigest()[:16]
+
+
+def parse_schedule(text, parse_sheet_selection, parse_view_options, email_pattern, max_recipients):
+    """
+    Parse schedule file text into ScheduledReports. Options are validated
+    with the upload form parsers. Raises ValueError naming the bad line.
+    """
+    reports = []
+    for line_number, line in enumerate(text.splitlines(), start=1):
+        try:
+            tokens = shlex.split(line, comments=True)
+            if not tokens:
+                continue
+            if tokens[0].startswith('@'):
+                expression, rest = tokens[0], tokens[1:]
+            else:
+                expression, rest = ' '.join(tokens[:5]), tokens[5:]
+            if len(rest) < 2:
+                raise ValueError('expected a schedule, a workbook and recipients')
+
+            schedule = None if expression == CHANGE_TRIGGER else CronSchedule(expression)
+            pattern, recipients = rest[0], [r.strip() for r in rest[1].split(',') if r.strip()]
+            if os.path.isabs(pattern) or '..' in pattern.split('/'):
+                raise ValueError('workbook paths must be inside the watched directory')
+            invalid = [r for r in recipients if not email_pattern.match(r)]
+            if invalid:
+                raise ValueError(f"invalid email addresses: {', '.join(invalid)}")
+            if not recipients or len(recipients) > max_recipients:
+                raise ValueError(f'between 1 and {max_recipients} recipients are required')
+
+            options = {}
+            for token in rest[2:]:
+                name, separator, value = token.partition('=')
+                if not separator:
+                    raise ValueError(f'expected name=value, got {token}')
+                options[name] = value
+            selection = parse_sheet_selection(options)
+            view = parse_view_options(options, selection)
+
+        except ValueError as e:
+            raise ValueError(f"Schedule line {line_number}: {e}")
+
+        reports.append(ScheduledReport(schedule, pattern, recipients, selection, view, line_number))
+    return reports
+
+
+def file_digest(path):
+    """SHA-256 of a file's content"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def copy_with_digest(source, destination):
+    """Copy a file, returning the SHA-256 of exactly the bytes copied"""
+    digest = hashlib.sha256()
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        for chunk in iter(lambda: src.read(1024 * 1024), b''):
+            digest.update(chunk)
+            dst.write(chunk)
+    return digest.hexdigest()
+
+
+class ReportScheduler:
+    """
+    Polls the schedule file and the watched directory, queueing a batch job
+    for every due report whose workbook changed since it was last sent.
+
+    Directory changes are found by polling file stats, which works on every
+    platform and filesystem (including network mounts where inotify does not
+    fire). A file only counts as changed once its stat has been stable for
+    one poll, so half-copied workbooks are not sent. Content hashes are only
+    computed when the stat differs from the one recorded at the last send.
+    What was sent is kept in a small JSON state file across restarts.
+    """
+
+    def __init__(self, job_queue, upload_folder, parse_sheet_selection, parse_view_options,
+                 email_pattern, max_recipients, schedule_path=None, watch_dir=None,
+                 state_path=None, poll_interval=None):
+        self.schedule_path = schedule_path or os.getenv('SCHEDULE_FILE', 'schedule.txt')
+        self.watch_dir = watch_dir or os.getenv('REPORTS_DIR', 'reports')
+        self.state_path = state_path or os.getenv('SCHEDULER_STATE', 'scheduler_state.json')
+        self.poll_interval = poll_interval or float(os.getenv('SCHEDULER_POLL_SECONDS', '30'))
+
+        self.job_queue = job_queue
+        self.upload_folder = upload_folder
+        self._parse = (parse_sheet_selection, parse_view_options, email_pattern, max_recipients)
+
+        self.reports = []
+        self._schedule_mtime = None
+        self._polled_stats = {}   # relative path -> stat at the previous poll
+        self._settled_stats = {}  # relative path -> stat when last considered for @change
+        self._last_minute = None
+        self._stop_event = threading.Event()
+        self.state = self._load_state()
+
+    def _load_state(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not read scheduler state {self.state_path}, starting fresh: {e}")
+            return {}
+
+    def _save_state(self):
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.state_path)
+
+    def reload_schedule(self):
+        """Re-read the schedule file when it changed, keeping the old schedule if it is invalid"""
+        try:
+            mtime = os.stat(self.schedule_path).st_mtime_ns
+        except FileNotFoundError:
+            if self.reports:
+                logger.warning(f"Schedule file {self.schedule_path} was removed")
+            self.reports, self._schedule_mtime = [], None
+            return
+        if mtime == self._schedule_mtime:
+            return
+
+        self._schedule_mtime = mtime
+        try:
+            with open(self.schedule_path) as f:
+                self.reports = parse_schedule(f.read(), *self._parse)
+            logger.info(f"Loaded {len(self.reports)} scheduled report(s) from {self.schedule_path}")
+        except (OSError, ValueError) as e:
+            logger.error(f"Invalid schedule file, keeping the previous schedule: {e}")
+
+    def _poll_files(self):
+        """Stat every workbook in the watched directory, returns {relative path: (mtime_ns, size)}"""
+        stats = {}
+        for root, _, files in os.walk(self.watch_dir):
+            for name in files:
+                if not name.lower().endswith(('.xlsx', '.xls')) or name.startswith('~$'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                stats[os.path.relpath(path, self.watch_dir).replace(os.sep, '/')] = [st.st_mtime_ns, st.st_size]
+        return stats
+
+    def _changed_files(self, stats):
+        """Files whose stat is stable since the previous poll and differs from the last settled one"""
+        changed = set()
+        for path, stat in stats.items():
+            if self._polled_stats.get(path) == stat and self._settled_stats.get(path) != stat:
+                self._settled_stats[path] = stat
+                changed.add(path)
+        self._polled_stats = stats
+        return changed
+
+    def _due_minutes(self, now):
+        minute = now.replace(second=0, microsecond=0)
+        if self._last_minute is None or minute <= self._last_minute:
+            minutes = [] if self._last_minute == minute else [minute]
+        else:
+            # Catch up on minutes skipped by a slow poll, but not a whole suspended day
+            start = max(self._last_minute, minute - datetime.timedelta(hours=1))
+            count = int((minute - start).total_seconds() // 60)
+            minutes = [start + datetime.timedelta(minutes=i) for i in range(1, count + 1)]
+        self._last_minute = minute
+        return minutes
+
+    def _resolve_pending(self):
+        """Record the outcome of queued sends"""
+        for key, entry in self.state.items():
+            pending = entry.get('pending')
+            if not pending:
+                continue
+            job = self.job_queue.get(pending['job_id'])
+            if job is None or job['status'] in (STATUS_DONE, STATUS_FAILED):
+                entry.pop('pending')
+            if job is None:
+                continue
+            # A batch that reached no recipient is retried like a failed job; a
+            # partial one is not, so recipients who got it are not mailed twice
+            if job['status'] == STATUS_DONE and job.get('result', {}).get('sent') == 0:
+                job['status'], job['error'] = STATUS_FAILED, 'no recipient could be reached'
+            if job['status'] == STATUS_DONE:
+                entry.update(sent_hash=pending['hash'], sent_stat=pending['stat'],
+                             sent_at=job['updated_at'], failed_hash=None)
+                logger.info(f"Scheduled report {entry['path']} sent (job {pending['job_id']})")
+            elif job['status'] == STATUS_FAILED:
+                entry['failed_hash'] = pending['hash']
+                logger.error(f"Scheduled report {entry['path']} failed (job {pending['job_id']}): "
+                             f"{job.get('error')}")
+
+    def _send(self, report, relative_path, stat, on_change):
+        """Queue a report for one file unless its content was already sent"""
+        key = report.state_key(relative_path)
+        entry = self.state.setdefault(key, {'path': relative_path})
+        if entry.get('pending'):
+            logger.info(f"Scheduled report {relative_path} is still being sent, skipping")
+            return
+
+        path = os.path.join(self.watch_dir, relative_path)
+        # An unchanged stat means unchanged content; otherwise compare hashes before copying
+        if entry.get('sent_stat') == stat:
+            logger.info(f"Scheduled report {relative_path} unchanged since last sent, skipping")
+            return
+        digest = file_digest(path)
+        if entry.get('sent_hash') == digest:
+            # Saved again without changes, the new stat saves hashing it next time
+            entry['sent_stat'] = stat
+            logger.info(f"Scheduled report {relative_path} content unchanged, skipping")
+            return
+        if on_change and entry.get('failed_hash') == digest:
+            logger.info(f"Scheduled report {relative_path} failed before, waiting for it to change")
+            return
+
+        # Snapshot the workbook: the job removes its file, and the original may change meanwhile
+        filename = os.path.basename(relative_path)
+        snapshot = os.path.join(self.upload_folder, f"{uuid.uuid4()}_{secure_filename(filename)}")
+        digest = copy_with_digest(path, snapshot)
+        try:
+            job_id = self.job_queue.submit('batch', {
+                'filepath': snapshot,
+                'filename': filename,
+                'recipients': report.recipients,
+                'selection': report.selection,
+                'view': report.view,
+            })
+        except QueueFullError:
+            os.remove(snapshot)
+            logger.error(f"Job queue full, scheduled report {relative_path} was not sent")
+            return
+
+        entry['pending'] = {'job_id': job_id, 'hash': digest, 'stat': stat}
+        logger.info(f"Queued scheduled report {relative_path} for {len(report.recipients)} "
+                    f"recipient(s) (job {job_id})")
+
+    def tick(self, now=None, all_due=False):
+        """
+        One poll: reload the schedule, record finished sends and queue due
+        reports. all_due treats every report as due, whatever its schedule.
+        """
+        self.reload_schedule()
+        self._resolve_pending()
+
+        minutes = self._due_minutes(now or datetime.datetime.now())
+        stats = self._poll_files()
+        changed = self._changed_files(stats)
+
+        for report in self.reports:
+            matched = sorted(p for p in stats if fnmatch.fnmatchcase(p, report.pattern))
+            if all_due:
+                due = matched
+            elif report.schedule is None:
+                due = [p for p in matched if p in changed]
+            else:
+                due = matched if any(report.schedule.matches(m) for m in minutes) else []
+            for relative_path in due:
+                try:
+                    self._send(report, relative_path, stats[relative_path], report.schedule is None)
+                except OSError as e:
+                    logger.error(f"Failed to read scheduled report {relative_path}: {e}")
+
+        self._save_state()
+
+    def pending(self):
+        """Number of queued sends whose outcome is not recorded yet"""
+        return sum(1 for entry in self.state.values() if entry.get('pending'))
+
+    def run_once(self, timeout=None):
+        """
+        Queue every report whose workbook changed since it was last sent and
+        wait up to timeout seconds for the sends, e.g. when run from cron.
+        Returns the number of sends still pending.
+        """
+        self._polled_stats = self._poll_files()
+        self.tick(all_due=True)
+        deadline = time.monotonic() + (timeout or 600)
+        while self.pending() and time.monotonic() < deadline:
+            time.sleep(1)
+            self._resolve_pending()
+        self._save_state()
+        return self.pending()
+
+    def run(self):
+        """Poll until stop() is called"""
+        os.makedirs(self.watch_dir, exist_ok=True)
+        logger.info(f"Watching {self.watch_dir} every {self.poll_interval:g}s, schedule {self.schedule_path}")
+        # Record the current stats first so files already present count as stable next poll
+        self._polled_stats = self._poll_files()
+        while not self._stop_event.is_set():
+            try:
+                self.tick()
+            except Exception as e:
+                logger.error(f"Scheduler poll failed: {e}")
+            self._stop_event.wait(self.poll_interval)
+
+    def stop(self):
+        self._stop_event.set()
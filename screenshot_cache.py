@@ -0,0 +1,222 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from memory_files import MemoryFile, file_size
+
+logger = logging.getLogger(__name__)
+
+# Bump when rendering changes so stale images are not served
+CACHE_VERSION = '2'
+
+
+class ScreenshotCache:
+    """
+    Content-addressed on-disk cache of rendered screenshots.
+
+    Each entry is a directory of one or more PNGs (several when tiled) keyed
+    by a hash of the workbook bytes plus the render options. Entries are
+    evicted least-recently-used once max_bytes or max_entries is exceeded,
+    and expire after ttl seconds.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=None, max_entries=None, ttl=None):
+        self.cache_dir = cache_dir or os.getenv('SCREENSHOT_CACHE_DIR', 'screenshot_cache')
+        self.max_bytes = max_bytes or int(float(os.getenv('SCREENSHOT_CACHE_MAX_MB', '256')) * 1024 * 1024)
+        self.max_entries = max_entries or int(os.getenv('SCREENSHOT_CACHE_MAX_ENTRIES', '1000'))
+        self.ttl = ttl or int(os.getenv('SCREENSHOT_CACHE_TTL', '86400'))
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (size, created_at, image count), oldest first
+        self._total_bytes = 0
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._load_index()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    @staticmethod
+    def _images(entry_dir):
+        """Image files of an entry directory in tile order"""
+        names = [name for name in os.listdir(entry_dir) if name.endswith('.png')]
+        names.sort(key=lambda name: int(name[:-4]))
+        return [os.path.join(entry_dir, name) for name in names]
+
+    def _stat_entry(self, key):
+        """Return (size, created_at, count) of an entry directory on disk"""
+        entry_dir = self._path(key)
+        images = self._images(entry_dir)
+        size = sum(os.path.getsize(path) for path in images)
+        return size, os.path.getmtime(entry_dir), len(images)
+
+    def _load_index(self):
+        """Rebuild the LRU index from entries left by a previous run"""
+        found = []
+        for key in os.listdir(self.cache_dir):
+            if not os.path.isdir(self._path(key)) or key.endswith('.tmp'):
+                continue
+            try:
+                size, created_at, count = self._stat_entry(key)
+            except (OSError, ValueError):
+                continue
+            found.append((created_at, key, size, count))
+
+        # Access order is not persisted, restore in write order
+        for created_at, key, size, count in sorted(found):
+            self._entries[key] = (size, created_at, count)
+            self._total_bytes += size
+
+        with self._lock:
+            self._evict()
+        logger.info(f"Screenshot cache loaded {len(self._entries)} entries from {self.cache_dir}")
+
+    @staticmethod
+    def key_for(filepath, options=None):
+        """Hash the workbook bytes together with the render options"""
+        digest = hashlib.sha256()
+        digest.update(CACHE_VERSION.encode())
+        digest.update(json.dumps(options or {}, sort_keys=True).encode())
+        if isinstance(filepath, MemoryFile):
+            digest.update(filepath.data)
+        else:
+            with open(filepath, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(chunk)
+        return digest.hexdigest()
+
+    def get(self, key, output_path_for, count=True):
+        """
+        Copy the cached images of an entry out of the cache.
+        output_path_for(index) gives the destination of each image.
+        Lookups made with count=False (e.g. per-tile ones) leave the hit and
+        miss counters alone.
+        Returns the list of copied paths on a hit, None on a miss
+        """
+        entry_dir = self._path(key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and os.path.isdir(entry_dir):
+                # Written by another worker process sharing the cache directory
+                try:
+                    entry = self._stat_entry(key)
+                    self._entries[key] = entry
+                    self._total_bytes += entry[0]
+                except (OSError, ValueError):
+                    entry = None
+
+            if entry is not None and time.time() - entry[1] > self.ttl:
+                self._remove(key)
+                entry = None
+
+            if entry is None:
+                if count:
+                    self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            if count:
+                self.hits += 1
+
+        try:
+            output_paths = []
+            for index, path in enumerate(self._images(entry_dir)):
+                output_path = output_path_for(index)
+                if isinstance(output_path, MemoryFile):
+                    with open(path, 'rb') as f:
+                        output_path.data = f.read()
+                else:
+                    shutil.copyfile(path, output_path)
+                output_paths.append(output_path)
+            return output_paths
+        except OSError as e:
+            logger.warning(f"Failed to read cached screenshot {key}: {e}")
+            with self._lock:
+                if count:
+                    self.hits -= 1
+                    self.misses += 1
+                self._remove(key)
+            return None
+
+    def labels(self, key):
+        """Labels stored with an entry by put(), or None"""
+        try:
+            with open(os.path.join(self._path(key), 'labels.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, screenshot_paths, labels=None):
+        """
+        Store one or more rendered images (e.g. tiles) under the given key,
+        with optional per-image labels (e.g. sheet names)
+        """
+        entry_dir = self._path(key)
+        tmp_dir = f"{entry_dir}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(tmp_dir)
+            for index, path in enumerate(screenshot_paths):
+                if isinstance(path, MemoryFile):
+                    with open(os.path.join(tmp_dir, f"{index}.png"), 'wb') as f:
+                        f.write(path.data)
+                else:
+                    shutil.copyfile(path, os.path.join(tmp_dir, f"{index}.png"))
+            if labels is not None:
+                with open(os.path.join(tmp_dir, 'labels.json'), 'w') as f:
+                    json.dump(labels, f)
+            if os.path.isdir(entry_dir):
+                shutil.rmtree(entry_dir, ignore_errors=True)
+            os.replace(tmp_dir, entry_dir)
+        except OSError as e:
+            logger.warning(f"Failed to cache screenshot {key}: {e}")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+
+        size = sum(file_size(path) for path in screenshot_paths)
+        with self._lock:
+            if key in self._entries:
+                self._total_bytes -= self._entries[key][0]
+            self._entries[key] = (size, time.time(), len(screenshot_paths))
+            self._entries.move_to_end(key)
+            self._total_bytes += size
+            self._evict()
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._total_bytes -= entry[0]
+        shutil.rmtree(self._path(key), ignore_errors=True)
+
+    def _evict(self):
+        """Drop expired entries, then least-recently-used ones over the limits"""
+        now = time.time()
+        for key in [k for k, entry in self._entries.items() if now - entry[1] > self.ttl]:
+            self._remove(key)
+            self.evictions += 1
+
+        while self._entries and (self._total_bytes > self.max_bytes
+                                 or len(self._entries) > self.max_entries):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def stats(self):
+        """Return hit/miss counters and current size"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._total_bytes,
+                'max_bytes': self.max_bytes,
+            }
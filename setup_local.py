@@ -51,6 +51,10 @@ playwright==1.39.0
 xlrd==2.0.1
 Werkzeug==2.3.7
 python-dotenv==1.0.0
+Pillow==10.1.0
+asgiref==3.7.2
+uvicorn==0.24.0
+aiosmtplib==3.0.1
 """
     
     with open('requirements.txt', 'w') as f:
@@ -94,6 +98,12 @@ uploads/*
 !uploads/.gitkeep
 screenshots/*
 !screenshots/.gitkeep
+jobs.db*
+screenshot_cache/
+benchmark_data/
+benchmark_results.json
+scheduler_state.json*
+dead_letters/
 
 # IDE
 .vscode/
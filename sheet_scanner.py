@@ -0,0 +1,391 @@
+import os
+import logging
+import datetime
+import threading
+from collections import OrderedDict
+from memory_files import MemoryFile, file_name, file_source
+
+logger = logging.getLogger(__name__)
+
+# Background of cells highlighted as changed since the last version
+CHANGED_CELL_COLOR = '#fff2cc'
+
+
+class SheetScan:
+    """
+    Everything the pipeline needs from one worksheet, gathered in one pass:
+    content bounds, cell values (up to the row/column caps) and column types.
+    """
+
+    def __init__(self, sheet_name, rows, last_row, last_col, column_types, truncated, totals_row=False,
+                 max_cols=None):
+        self.sheet_name = sheet_name
+        self.rows = rows  # list of tuples, header first, trimmed to last_col
+        self.last_row = last_row
+        self.last_col = last_col
+        self.column_types = column_types
+        self.truncated = truncated
+        self.totals_row = totals_row  # the last row is the sheet's last row, kept past the cap
+        self.max_cols = max_cols  # column cap the sheet was read with, None when uncapped
+        self.styles = None  # SheetStyles when scanned with Excel formatting
+        self.highlights = None  # set of (row, col) to highlight, row 0 is the header
+
+    def tile_highlights(self, tile=None):
+        """Highlighted cells of a tile as (row, col) within the tile, row 0 being the header"""
+        if not self.highlights:
+            return set()
+        if tile is None:
+            return set(self.highlights)
+        row_start, row_end, col_start, col_end = tile
+        return {(row - row_start if row else 0, col - col_start) for row, col in self.highlights
+                if col_start <= col < col_end and (row == 0 or row_start < row <= row_end)}
+
+    def tile_view(self, tile=None):
+        """
+        Header and data rows for a tile (row_start, row_end, col_start, col_end)
+        of the data rows, or the whole table when tile is None.
+        Returns (header, rows, is_last_tile) with every row padded to the tile width.
+        """
+        num_cols = max(self.last_col, 1)
+        header = pad_row(self.rows[0] if self.rows else (), num_cols)
+        body = self.rows[1:]
+
+        if tile is None:
+            return header, [pad_row(row, num_cols) for row in body], True
+
+        row_start, row_end, col_start, col_end = tile
+        is_last_tile = row_end >= len(body) and col_end >= num_cols
+        rows = [pad_row(row, num_cols)[col_start:col_end] for row in body[row_start:row_end]]
+        return header[col_start:col_end], rows, is_last_tile
+
+    def metadata(self):
+        """Compact summary without the cell values"""
+        return {
+            'sheet_name': self.sheet_name,
+            'last_row': self.last_row,
+            'last_col': self.last_col,
+            'column_types': self.column_types,
+            'truncated': self.truncated,
+            'totals_row': self.totals_row,
+        }
+
+
+def format_value(value):
+    """Format a raw cell value as display text"""
+    if value is None:
+        return ''
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(sep=' ')
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def pad_row(row, width):
+    """Pad or trim a row of values to exactly width cells"""
+    row = tuple(row[:width])
+    return row + (None,) * (width - len(row))
+
+
+def _value_type(value):
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, (int, float)):
+        return 'number'
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return 'date'
+    return 'text'
+
+
+def _summarize_types(seen):
+    if not seen:
+        return 'empty'
+    if len(seen) == 1:
+        return next(iter(seen))
+    return 'mixed'
+
+
+def parse_cell_range(cell_range):
+    """
+    Split an A1-style range such as 'B2:F40', 'A:D' or 'Summary!A1:H20' into
+    (sheet title or None, (min_col, min_row, max_col, max_row)); open ends
+    are None. Raises ValueError for anything else.
+    """
+    title = None
+    coordinates = cell_range.strip()
+    if '!' in coordinates:
+        title, coordinates = coordinates.rsplit('!', 1)
+        title = title.strip()
+        if title.startswith("'") and title.endswith("'"):
+            title = title[1:-1].replace("''", "'")
+    from openpyxl.utils.cell import range_boundaries
+    try:
+        bounds = range_boundaries(coordinates.replace('$', '').upper())
+    except (ValueError, TypeError):
+        raise ValueError(f"Invalid cell range: {cell_range}")
+    return title, bounds
+
+
+def _bounded_rows(worksheet, bounds, max_rows, max_cols, read_to_end=False, values_only=True):
+    """
+    Row iterator over (min_col, min_row, max_col, max_row) of a worksheet,
+    narrowed to max_cols columns. Open-ended ranges stop one row past the
+    max_rows cap, unless read_to_end is set (to find the totals row).
+    """
+    min_col, min_row, max_col, max_row = bounds
+    min_col = min_col or 1
+    min_row = min_row or 1
+    if max_cols:
+        max_col = min(max_col or min_col + max_cols - 1, min_col + max_cols - 1)
+    if max_rows is not None and max_row is None and not read_to_end:
+        # Header plus one row past the cap is enough to detect truncation
+        max_row = min_row + max_rows + 1
+
+    return worksheet.iter_rows(min_row=min_row, max_row=max_row,
+                               min_col=min_col, max_col=max_col, values_only=values_only)
+
+
+def _scan_worksheet(worksheet, bounds=None, max_rows=None, max_cols=None, totals=False,
+                    styled=False, name=None):
+    """
+    Scan bounds (min_col, min_row, max_col, max_row, or None for the whole
+    sheet) of a read-only worksheet, labelled name (default: the sheet title).
+    styled also reads each kept cell's formatting into scan.styles.
+    """
+    if bounds is None:
+        bounds = (None, None, None, None)
+        rows = worksheet.iter_rows(max_col=max_cols, values_only=not styled)
+    else:
+        rows = _bounded_rows(worksheet, bounds, max_rows, max_cols, read_to_end=totals, values_only=not styled)
+
+    if not styled:
+        return _scan_rows(name or worksheet.title, rows, max_rows, totals, max_cols)
+
+    from excel_styles import StyleReader
+    reader = StyleReader(worksheet, rows, max_rows)
+    scan = _scan_rows(name or worksheet.title, reader.values(), max_rows, totals, max_cols)
+    scan.styles = reader.build(scan, bounds[1] or 1, bounds[0] or 1)
+    return scan
+
+
+def _scan_xlsx(filepath, max_rows, max_cols, cell_range, totals, styled):
+    import openpyxl
+    workbook = openpyxl.load_workbook(file_source(filepath), read_only=True, data_only=True)
+    try:
+        if not cell_range:
+            return _scan_worksheet(workbook.active, None, max_rows, max_cols, totals, styled)
+
+        title, bounds = parse_cell_range(cell_range)
+        if title is not None and title not in workbook.sheetnames:
+            raise ValueError(f"Sheet not found: {title}")
+        worksheet = workbook[title] if title is not None else workbook.active
+        return _scan_worksheet(worksheet, bounds, max_rows, max_cols, totals, styled)
+
+    finally:
+        workbook.close()
+
+
+def _iter_xls_rows(filepath, max_rows, max_col, cell_range=None, totals=False):
+    # openpyxl cannot read legacy .xls files, pandas reads them through xlrd
+    import pandas as pd
+
+    sheet_name = 0
+    min_col, min_row, range_max_col, range_max_row = None, None, None, None
+    if cell_range:
+        title, (min_col, min_row, range_max_col, range_max_row) = parse_cell_range(cell_range)
+        if title is not None:
+            sheet_name = title
+    min_col = min_col or 1
+    min_row = min_row or 1
+
+    nrows = range_max_row - min_row + 1 if range_max_row else None
+    if max_rows and not totals:
+        nrows = min(nrows or max_rows + 2, max_rows + 2)
+    df = pd.read_excel(file_source(filepath), sheet_name=sheet_name, header=None, skiprows=min_row - 1, nrows=nrows)
+    end_col = range_max_col
+    if max_col:
+        end_col = min(end_col or min_col + max_col - 1, min_col + max_col - 1)
+    df = df.iloc[:, min_col - 1:end_col]
+    df = df.astype(object).where(df.notna(), None)
+    return None, (tuple(row) for row in df.itertuples(index=False, name=None))
+
+
+def _scan_rows(sheet_name, rows, max_rows=None, totals=False, max_cols=None):
+    """
+    Build a SheetScan from an iterator of row tuples, first row as the header.
+    Values are kept for the header plus up to max_rows data rows; reading
+    stops at the first data row past the cap and the scan is marked truncated.
+    With totals, the rest of the rows are read instead and the last non-blank
+    one is kept after the capped rows, for "top N plus totals" tables.
+    max_cols is the column cap the rows were read with, kept on the scan.
+    """
+    kept = []
+    last_row = 0
+    last_col = 0
+    column_types = {}
+    truncated = False
+    totals_rows = []
+
+    for row_num, row in enumerate(rows, start=1):
+        row_last_col = 0
+        for col_num, value in enumerate(row, start=1):
+            if value is not None:
+                row_last_col = col_num
+
+        if not row_last_col:
+            # Blank rows are kept positionally, trailing ones are trimmed below
+            if max_rows is None or row_num <= max_rows + 1:
+                kept.append(())
+            continue
+
+        if max_rows is not None and row_num > max_rows + 1:
+            if not totals:
+                truncated = True
+                break
+            # Only the row itself is kept, no type tracking for skipped rows
+            truncated = bool(totals_rows)
+            totals_rows[:] = [tuple(row[:row_last_col])]
+            continue
+
+        if row_num > 1:
+            for col_num, value in enumerate(row[:row_last_col], start=1):
+                if value is not None:
+                    column_types.setdefault(col_num, set()).add(_value_type(value))
+
+        kept.append(tuple(row[:row_last_col]))
+        last_row = row_num
+        last_col = max(last_col, row_last_col)
+
+    del kept[last_row:]
+    if totals_rows:
+        kept.extend(totals_rows)
+        last_col = max(last_col, len(totals_rows[0]))
+    rows = [row + (None,) * (last_col - len(row)) for row in kept]
+    types = [_summarize_types(column_types.get(col, ())) for col in range(1, last_col + 1)]
+
+    return SheetScan(sheet_name, rows, last_row, last_col, types, truncated, totals_row=bool(totals_rows),
+                     max_cols=max_cols)
+
+
+def scan_sheet(filepath, max_rows=None, max_cols=None, cell_range=None, totals=False, styled=False):
+    """
+    Scan the first worksheet once, or only the A1-style cell_range (which may
+    name another sheet, e.g. 'Summary!A1:H20'); the range's first row is the
+    header and reading stops at its last row.
+    Values are kept for the header plus up to max_rows data rows; reading
+    stops at the first data row past the cap and the scan is marked truncated.
+    totals keeps the last row after the capped rows (see _scan_rows).
+    styled reads cell formatting too (.xlsx only, .xls scans are plain).
+    """
+    if not file_name(filepath).lower().endswith('.xls'):
+        return _scan_xlsx(filepath, max_rows, max_cols, cell_range, totals, styled)
+
+    sheet_name, rows = _iter_xls_rows(filepath, max_rows, max_cols, cell_range, totals)
+    return _scan_rows(sheet_name, rows, max_rows, totals, max_cols)
+
+
+def _range_bounds(workbook, name):
+    """Sheet title and (min_col, min_row, max_col, max_row) of a named range"""
+    defined = workbook.defined_names.get(name)
+    if defined is None:
+        # Names can also be scoped to a single sheet
+        for worksheet in workbook.worksheets:
+            defined = worksheet.defined_names.get(name)
+            if defined is not None:
+                break
+    if defined is None:
+        raise ValueError(f"Named range not found: {name}")
+
+    destinations = list(defined.destinations)
+    if len(destinations) != 1:
+        raise ValueError(f"Named range {name} must refer to a single cell range")
+
+    from openpyxl.utils.cell import range_boundaries
+    title, coordinates = destinations[0]
+    return title, range_boundaries(coordinates.replace('$', ''))
+
+
+def scan_selection(filepath, sheets=None, ranges=None, max_rows=None, max_cols=None, styled=False):
+    """
+    Scan several sheets and/or named ranges of a workbook from one load.
+    sheets is 'all' or a list of sheet names, ranges a list of defined names.
+    Returns one SheetScan per sheet then per range, labelled with its name.
+    styled reads cell formatting too (.xlsx only).
+    """
+    if file_name(filepath).lower().endswith('.xls'):
+        if ranges:
+            raise ValueError('Named ranges are only supported for .xlsx workbooks')
+
+        import pandas as pd
+
+        nrows = max_rows + 2 if max_rows else None
+        frames = pd.read_excel(file_source(filepath), sheet_name=None if sheets == 'all' else list(sheets or []),
+                               header=None, nrows=nrows)
+        scans = []
+        for name, df in frames.items():
+            if max_cols:
+                df = df.iloc[:, :max_cols]
+            df = df.astype(object).where(df.notna(), None)
+            scans.append(_scan_rows(name, df.itertuples(index=False, name=None), max_rows, max_cols=max_cols))
+        return scans
+
+    import openpyxl
+    workbook = openpyxl.load_workbook(file_source(filepath), read_only=True, data_only=True)
+    try:
+        # Chartsheets have no cells, so 'all' means every worksheet
+        titles = [worksheet.title for worksheet in workbook.worksheets]
+        names = titles if sheets == 'all' else list(sheets or [])
+        missing = [name for name in names if name not in titles]
+        if missing:
+            raise ValueError(f"Sheet not found: {', '.join(missing)}")
+
+        scans = [_scan_worksheet(workbook[name], None, max_rows, max_cols, styled=styled) for name in names]
+
+        for name in ranges or []:
+            title, bounds = _range_bounds(workbook, name)
+            scans.append(_scan_worksheet(workbook[title], bounds, max_rows, max_cols, styled=styled, name=name))
+
+        logger.info(f"Scanned {len(scans)} sheet(s)/range(s) of {filepath} in one load")
+        return scans
+
+    finally:
+        workbook.close()
+
+
+class ScanCache:
+    """
+    Small LRU of sheet scans keyed by file identity and caps, so one upload
+    is only parsed once even when several stages need it.
+    """
+
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries or int(os.getenv('SCAN_CACHE_ENTRIES', '4'))
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_scan(self, filepath, max_rows=None, max_cols=None, scanner=None,
+                    cell_range=None, totals=False, styled=False):
+        """
+        Return the cached scan of a file or scan it, with scanner (same
+        signature as scan_sheet, e.g. a ParsePool's) when given
+        """
+        if isinstance(filepath, MemoryFile):
+            identity = ('memory', filepath.sha256())
+        else:
+            st = os.stat(filepath)
+            identity = (os.path.realpath(filepath), st.st_mtime_ns, st.st_size)
+        key = identity + (max_rows, max_cols, cell_range, totals, styled)
+
+        with self._lock:
+            scan = self._entries.get(key)
+            if scan is not None:
+                self._entries.move_to_end(key)
+                return scan
+
+        scan = (scanner or scan_sheet)(filepath, max_rows, max_cols, cell_range, totals, styled)
+
+        with self._lock:
+            self._entries[key] = scan
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return scan
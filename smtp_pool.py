@@ -0,0 +1,519 @@
+import os
+import re
+import time
+import asyncio
+import atexit
+import smtplib
+import logging
+import threading
+import email.policy
+from email.message import Message
+from email.generator import BytesGenerator
+from contextlib import contextmanager
+from metrics import track
+
+try:
+    import aiosmtplib
+except ImportError:  # Only needed when serving under an ASGI server
+    aiosmtplib = None
+
+logger = logging.getLogger(__name__)
+
+
+class SMTPPoolTimeout(Exception):
+    """Raised when no SMTP connection becomes available in time"""
+
+
+def message_bytes(msg):
+    """
+    The serialized form of a message given as a str, bytes, a list of
+    bytes chunks or an email Message
+    """
+    if isinstance(msg, Message):
+        return msg.as_bytes(policy=email.policy.SMTP)
+    if isinstance(msg, list):
+        return b''.join(msg)
+    return msg
+
+
+_EOL = re.compile(rb'\r\n|\n|\r(?!\n)')
+
+
+class _DataWriter:
+    """
+    File-like object for the DATA section of an SMTP transaction. Writes go
+    to the socket in blocks of block_size bytes with line endings turned
+    into CRLF and leading dots doubled, so a message never has to exist as
+    one serialized string.
+    """
+
+    def __init__(self, sock, block_size=64 * 1024):
+        self.sock = sock
+        self.block_size = block_size
+        self.bytes_sent = 0
+        self._buffer = bytearray()
+        self._at_line_start = True
+        # A CR at the end of a chunk may be the first half of a CRLF
+        self._pending_cr = False
+
+    def write(self, data):
+        if self._pending_cr:
+            data = b'\r' + data
+            self._pending_cr = False
+        if data.endswith(b'\r'):
+            data = data[:-1]
+            self._pending_cr = True
+        if not data:
+            return 0
+
+        data = _EOL.sub(b'\r\n', data)
+        if self._at_line_start and data.startswith(b'.'):
+            data = b'.' + data
+        data = data.replace(b'\n.', b'\n..')
+        self._at_line_start = data.endswith(b'\n')
+
+        self._buffer += data
+        if len(self._buffer) >= self.block_size:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self._buffer:
+            self.sock.sendall(self._buffer)
+            self.bytes_sent += len(self._buffer)
+            self._buffer.clear()
+
+    def close(self):
+        """Terminate the message with <CRLF>.<CRLF> and send what is left"""
+        if self._pending_cr:
+            self._pending_cr = False
+            self._buffer += b'\r\n'
+            self._at_line_start = True
+        if not self._at_line_start:
+            self._buffer += b'\r\n'
+        self._buffer += b'.\r\n'
+        self.flush()
+
+
+def _stream_message(server, from_addr, to_addrs, msg):
+    """
+    smtplib's sendmail, except that the message is generated straight onto
+    the socket: an email Message through BytesGenerator, bytes or a list of
+    bytes chunks as they are. Raises the same exceptions and returns the
+    same dict of refused recipients.
+    """
+    if isinstance(to_addrs, str):
+        to_addrs = [to_addrs]
+    server.ehlo_or_helo_if_needed()
+
+    code, resp = server.mail(from_addr)
+    if code != 250:
+        if code == 421:
+            server.close()
+        else:
+            server.rset()
+        raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+
+    refused = {}
+    for addr in to_addrs:
+        code, resp = server.rcpt(addr)
+        if code not in (250, 251):
+            refused[addr] = (code, resp)
+        if code == 421:
+            server.close()
+            raise smtplib.SMTPRecipientsRefused(refused)
+    if len(refused) == len(to_addrs):
+        server.rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+
+    code, resp = server.docmd('data')
+    if code != 354:
+        server.rset()
+        raise smtplib.SMTPDataError(code, resp)
+
+    writer = _DataWriter(server.sock)
+    if isinstance(msg, Message):
+        BytesGenerator(writer, policy=email.policy.SMTP).flatten(msg)
+    else:
+        for chunk in ([msg] if isinstance(msg, bytes) else msg):
+            writer.write(chunk)
+    writer.close()
+
+    code, resp = server.getreply()
+    if code != 250:
+        if code == 421:
+            server.close()
+        else:
+            server.rset()
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
+
+
+def _closes_session(error):
+    """Whether a rejection came with a 421 reply, after which the server has closed the session"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return any(code == 421 for code, _ in error.recipients.values())
+    if aiosmtplib is not None and isinstance(error, aiosmtplib.SMTPRecipientsRefused):
+        return any(refusal.code == 421 for refusal in error.recipients)
+    return getattr(error, 'smtp_code', getattr(error, 'code', None)) == 421
+
+
+class _PooledConnection:
+    """An authenticated SMTP session plus its bookkeeping"""
+
+    def __init__(self, server):
+        self.server = server
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.messages = 0
+
+    def close(self):
+        try:
+            self.server.quit()
+        except Exception:
+            try:
+                self.server.close()
+            except Exception:
+                pass
+
+
+class SMTPConnectionPool:
+    """
+    Thread-safe pool of persistent, authenticated SMTP connections.
+
+    Connections are reused across messages so the TCP, STARTTLS and AUTH
+    handshake is paid once per connection instead of once per email. Idle
+    connections are checked with NOOP before reuse and closed after
+    idle_timeout seconds, and a connection is retired after max_messages.
+    Set SMTP_USE_TLS=false and leave the credentials empty to run against a
+    local debugging server such as aiosmtpd.
+    """
+
+    def __init__(self, host, port, username=None, password=None, max_size=None,
+                 idle_timeout=None, keepalive_interval=None, max_messages=None,
+                 use_tls=None, timeout=None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.max_size = max_size or int(os.getenv('SMTP_POOL_SIZE', '4'))
+        self.idle_timeout = idle_timeout or float(os.getenv('SMTP_IDLE_TIMEOUT', '60'))
+        self.keepalive_interval = keepalive_interval or float(os.getenv('SMTP_KEEPALIVE_INTERVAL', '15'))
+        self.max_messages = max_messages or int(os.getenv('SMTP_MAX_MESSAGES_PER_CONNECTION', '100'))
+        if use_tls is None:
+            use_tls = os.getenv('SMTP_USE_TLS', 'true').lower() not in ('0', 'false', 'no')
+        self.use_tls = use_tls
+        self.timeout = timeout or float(os.getenv('SMTP_TIMEOUT', '30'))
+
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_size)
+        self._opened = 0
+        self._in_use = 0
+
+        atexit.register(self.close_all)
+
+    def _open(self):
+        """Open, secure and authenticate a new SMTP connection"""
+        with track('smtp_connect'):
+            server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            try:
+                if self.use_tls:
+                    server.starttls()
+                if self.username and self.password:
+                    server.login(self.username, self.password)
+            except Exception:
+                server.close()
+                raise
+
+        with self._lock:
+            self._opened += 1
+        logger.debug(f"Opened SMTP connection to {self.host}:{self.port}")
+        return _PooledConnection(server)
+
+    def _is_alive(self, conn):
+        try:
+            code, _ = conn.server.noop()
+            return code == 250
+        except smtplib.SMTPException:
+            return False
+        except OSError:
+            return False
+
+    def _reap_idle(self):
+        """Close idle connections that have exceeded the idle timeout"""
+        now = time.monotonic()
+        with self._lock:
+            expired = [c for c in self._idle if now - c.last_used > self.idle_timeout]
+            self._idle = [c for c in self._idle if c not in expired]
+        for conn in expired:
+            conn.close()
+
+    def acquire(self, wait=None):
+        """Borrow a live connection, opening a new one if none are idle"""
+        wait = self.timeout if wait is None else wait
+        if not self._slots.acquire(timeout=wait):
+            raise SMTPPoolTimeout(f"No SMTP connection available after {wait}s")
+
+        with self._lock:
+            self._in_use += 1
+        try:
+            self._reap_idle()
+            while True:
+                with self._lock:
+                    conn = self._idle.pop() if self._idle else None
+                if conn is None:
+                    return self._open()
+
+                if time.monotonic() - conn.last_used < self.keepalive_interval or self._is_alive(conn):
+                    return conn
+
+                logger.debug("Discarding stale SMTP connection")
+                conn.close()
+        except Exception:
+            self._return_slot()
+            raise
+
+    def _return_slot(self):
+        with self._lock:
+            self._in_use -= 1
+        self._slots.release()
+
+    def release(self, conn, discard=False):
+        """Return a connection to the pool, or close it if it is spent or broken"""
+        try:
+            conn.last_used = time.monotonic()
+            if discard or conn.messages >= self.max_messages:
+                conn.close()
+            else:
+                with self._lock:
+                    self._idle.append(conn)
+        finally:
+            self._return_slot()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for the duration of a with-block"""
+        conn = self.acquire()
+        try:
+            yield conn.server
+        except (smtplib.SMTPServerDisconnected, OSError):
+            self.release(conn, discard=True)
+            raise
+        except BaseException:
+            self.release(conn)
+            raise
+        else:
+            self.release(conn)
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        """
+        Send a message over a pooled connection. A str goes through
+        smtplib's sendmail; an email Message, bytes or a list of bytes
+        chunks is streamed to the socket without serializing it first.
+        Reconnects once transparently if the server dropped the connection.
+        """
+        for attempt in (1, 2):
+            conn = self.acquire()
+            try:
+                with track('smtp_send'):
+                    if isinstance(msg, str):
+                        refused = conn.server.sendmail(from_addr, to_addrs, msg)
+                    else:
+                        refused = _stream_message(conn.server, from_addr, to_addrs, msg)
+            except smtplib.SMTPServerDisconnected:
+                self.release(conn, discard=True)
+                if attempt == 2:
+                    raise
+                logger.info("SMTP server disconnected, reconnecting")
+                continue
+            except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused) as e:
+                # The server rejected this message; the session is still usable unless it was closed
+                self.release(conn, discard=conn.server.sock is None or _closes_session(e))
+                raise
+            except BaseException:
+                self.release(conn, discard=True)
+                raise
+
+            conn.messages += 1
+            self.release(conn)
+            return refused
+
+    def stats(self):
+        """Return a snapshot of pool usage"""
+        with self._lock:
+            return {
+                'max_size': self.max_size,
+                'idle': len(self._idle),
+                'in_use': self._in_use,
+                'opened_total': self._opened,
+            }
+
+    def close_all(self):
+        """Close all idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+class AsyncSMTPConnectionPool:
+    """
+    asyncio counterpart of SMTPConnectionPool built on aiosmtplib, for use
+    from coroutines on a single long-lived event loop (see asgi.py).
+
+    Takes the same settings and environment variables and applies the same
+    reuse rules: NOOP before reusing a connection idle for longer than
+    keepalive_interval, close after idle_timeout, retire after max_messages
+    and reconnect once if the server dropped the connection.
+    """
+
+    def __init__(self, host, port, username=None, password=None, max_size=None,
+                 idle_timeout=None, keepalive_interval=None, max_messages=None,
+                 use_tls=None, timeout=None):
+        if aiosmtplib is None:
+            raise RuntimeError("aiosmtplib is required for the async SMTP pool")
+
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.max_size = max_size or int(os.getenv('SMTP_POOL_SIZE', '4'))
+        self.idle_timeout = idle_timeout or float(os.getenv('SMTP_IDLE_TIMEOUT', '60'))
+        self.keepalive_interval = keepalive_interval or float(os.getenv('SMTP_KEEPALIVE_INTERVAL', '15'))
+        self.max_messages = max_messages or int(os.getenv('SMTP_MAX_MESSAGES_PER_CONNECTION', '100'))
+        if use_tls is None:
+            use_tls = os.getenv('SMTP_USE_TLS', 'true').lower() not in ('0', 'false', 'no')
+        self.use_tls = use_tls
+        self.timeout = timeout or float(os.getenv('SMTP_TIMEOUT', '30'))
+
+        self._idle = []
+        self._slots = asyncio.Semaphore(self.max_size)
+        self._opened = 0
+        self._in_use = 0
+
+    async def _open(self):
+        """Open, secure and authenticate a new SMTP connection"""
+        with track('smtp_connect'):
+            server = aiosmtplib.SMTP(hostname=self.host, port=self.port, timeout=self.timeout,
+                                     start_tls=self.use_tls)
+            await server.connect()
+            try:
+                if self.username and self.password:
+                    await server.login(self.username, self.password)
+            except Exception:
+                server.close()
+                raise
+
+        self._opened += 1
+        logger.debug(f"Opened async SMTP connection to {self.host}:{self.port}")
+        return _PooledConnection(server)
+
+    async def _is_alive(self, conn):
+        try:
+            response = await conn.server.noop()
+            return response.code == 250
+        except aiosmtplib.SMTPException:
+            return False
+        except OSError:
+            return False
+
+    async def _close(self, conn):
+        try:
+            await conn.server.quit()
+        except Exception:
+            conn.server.close()
+
+    async def _reap_idle(self):
+        """Close idle connections that have exceeded the idle timeout"""
+        now = time.monotonic()
+        expired = [c for c in self._idle if now - c.last_used > self.idle_timeout]
+        self._idle = [c for c in self._idle if c not in expired]
+        for conn in expired:
+            await self._close(conn)
+
+    async def acquire(self, wait=None):
+        """Borrow a live connection, opening a new one if none are idle"""
+        wait = self.timeout if wait is None else wait
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=wait)
+        except asyncio.TimeoutError:
+            raise SMTPPoolTimeout(f"No SMTP connection available after {wait}s")
+
+        self._in_use += 1
+        try:
+            await self._reap_idle()
+            while True:
+                conn = self._idle.pop() if self._idle else None
+                if conn is None:
+                    return await self._open()
+
+                if time.monotonic() - conn.last_used < self.keepalive_interval or await self._is_alive(conn):
+                    return conn
+
+                logger.debug("Discarding stale async SMTP connection")
+                await self._close(conn)
+        except BaseException:
+            self._return_slot()
+            raise
+
+    def _return_slot(self):
+        self._in_use -= 1
+        self._slots.release()
+
+    async def release(self, conn, discard=False):
+        """Return a connection to the pool, or close it if it is spent or broken"""
+        try:
+            conn.last_used = time.monotonic()
+            if discard or conn.messages >= self.max_messages:
+                await self._close(conn)
+            else:
+                self._idle.append(conn)
+        finally:
+            self._return_slot()
+
+    async def sendmail(self, from_addr, to_addrs, msg):
+        """
+        Send a message over a pooled connection. Takes the same message
+        types as SMTPConnectionPool.sendmail, though aiosmtplib needs them
+        serialized. Reconnects once transparently if the server dropped
+        the connection.
+        """
+        msg = message_bytes(msg)
+        for attempt in (1, 2):
+            conn = await self.acquire()
+            try:
+                with track('smtp_send'):
+                    refused = await conn.server.sendmail(from_addr, to_addrs, msg)
+            except aiosmtplib.SMTPServerDisconnected:
+                await self.release(conn, discard=True)
+                if attempt == 2:
+                    raise
+                logger.info("SMTP server disconnected, reconnecting")
+                continue
+            except (aiosmtplib.SMTPResponseException, aiosmtplib.SMTPRecipientsRefused) as e:
+                # The server rejected this message; the session is still usable unless it was closed
+                await self.release(conn, discard=not conn.server.is_connected or _closes_session(e))
+                raise
+            except BaseException:
+                await self.release(conn, discard=True)
+                raise
+
+            conn.messages += 1
+            await self.release(conn)
+            return refused
+
+    def stats(self):
+        """Return a snapshot of pool usage"""
+        return {
+            'max_size': self.max_size,
+            'idle': len(self._idle),
+            'in_use': self._in_use,
+            'opened_total': self._opened,
+        }
+
+    async def close_all(self):
+        """Close all idle connections"""
+        idle, self._idle = self._idle, []
+        for conn in idle:
+            await self._close(conn)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Startup timing, and preloading of the modules the app imports on first use
+
+The app imports pandas, openpyxl, Playwright, Pillow and the styled renderer
+lazily, so a worker that only answers health checks never loads them.
+create_app() can preload them instead: under gunicorn --preload that happens
+once in the master, and the forked workers share the loaded modules
+copy-on-write.
+
+Run as a script to report import and startup times of app.py in a fresh
+interpreter, with and without preloading, for comparison across commits:
+
+    python startup.py --output before.json
+    python startup.py --output after.json --compare before.json --budget 0.5
+"""
+import os
+import sys
+import time
+import logging
+import importlib
+
+_STARTED = time.perf_counter()
+
+logger = logging.getLogger(__name__)
+
+# Imported on first use by sheet_scanner, excel_processor, browser_pool, renderers and image_optimizer
+HEAVY_MODULES = ('openpyxl', 'pandas', 'playwright.async_api', 'excel_styles', 'PIL.Image', 'PIL.ImageDraw',
+                 'PIL.ImageFont')
+
+_phases = {}
+_preloaded = {}
+
+
+def mark(phase):
+    """Record the seconds from the start of the app import to this phase"""
+    _phases[phase] = round(time.perf_counter() - _STARTED, 4)
+
+
+def preload_modules(modules=HEAVY_MODULES):
+    """Import modules that are otherwise imported on first use, returns {module: seconds}"""
+    for name in modules:
+        if name in _preloaded:
+            continue
+        start = time.perf_counter()
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            logger.warning(f"Could not preload {name}: {e}")
+            continue
+        _preloaded[name] = round(time.perf_counter() - start, 4)
+    return dict(_preloaded)
+
+
+def report():
+    """Startup phases and preloaded modules of this process"""
+    return {
+        'pid': os.getpid(),
+        'phases': dict(_phases),
+        'preloaded': dict(_preloaded),
+        'heavy_modules_loaded': [name for name in HEAVY_MODULES if name in sys.modules],
+    }
+
+
+# Timed in a fresh interpreter by measure(); runs in a scratch directory
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.create_app(preload=PRELOAD)
+ready = time.perf_counter()
+status = app.app.test_client().get('/api/health').status_code
+served = time.perf_counter()
+print(json.dumps({
+    'import_s': imported - start,
+    'create_app_s': ready - imported,
+    'first_health_s': served - ready,
+    'health_status': status,
+    'modules': len(sys.modules),
+}))
+"""
+
+
+def parse_importtime(stderr):
+    """{module: cumulative seconds} from python -X importtime output"""
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+def measure(preload, app_dir):
+    """Import app.py in a fresh interpreter, returns timings and per-module import times"""
+    import json
+    import tempfile
+    import subprocess
+
+    env = dict(os.environ,
+               PYTHONPATH=os.pathsep.join(filter(None, [app_dir, os.getenv('PYTHONPATH')])),
+               # Job threads would outlive the probe, and nothing needs a real SMTP server
+               JOB_RUNNER='asyncio',
+               PARSE_WORKERS='0')
+    with tempfile.TemporaryDirectory() as workdir:
+        start = time.perf_counter()
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                               _PROBE.replace('PRELOAD', str(preload))],
+                              cwd=workdir, env=env, capture_output=True, text=True)
+        wall = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError(f"app import failed: {proc.stderr.strip().splitlines()[-1:]}")
+
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result['process_s'] = wall
+    return result, parse_importtime(proc.stderr)
+
+
+def main():
+    import json
+    import argparse
+    import statistics
+    from benchmark import git_commit
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=3, help='fresh interpreters per mode, the median is kept')
+    parser.add_argument('--top', type=int, default=15, help='slowest imports to list')
+    parser.add_argument('--output', default=None, help='write the report as JSON')
+    parser.add_argument('--compare', default=None, help='earlier report JSON to compare against')
+    parser.add_argument('--budget', type=float, default=None,
+                        help='exit with status 1 if importing app.py takes longer, in seconds')
+    args = parser.parse_args()
+
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    modes = {}
+    for mode, preload in (('lazy', False), ('preload', True)):
+        runs = [measure(preload, app_dir) for _ in range(args.runs)]
+        timings = {key: round(statistics.median(r[0][key] for r in runs), 4)
+                   for key in ('import_s', 'create_app_s', 'first_health_s', 'process_s')}
+        timings['modules'] = runs[-1][0]['modules']
+        imports = runs[-1][1]
+        modes[mode] = dict(timings, slowest_imports={
+            name: round(seconds, 4)
+            for name, seconds in sorted(imports.items(), key=lambda item: -item[1])[:args.top]
+        })
+
+        print(f"\n{mode}: import {timings['import_s'] * 1000:.0f}ms, create_app "
+              f"{timings['create_app_s'] * 1000:.0f}ms, first /api/health {timings['first_health_s'] * 1000:.0f}ms, "
+              f"process {timings['process_s'] * 1000:.0f}ms, {timings['modules']} modules")
+        for name, seconds in modes[mode]['slowest_imports'].items():
+            print(f"  {seconds * 1000:>8.1f}ms  {name}")
+
+    report_data = {
+        'meta': {'commit': git_commit(), 'python': sys.version.split()[0], 'runs': args.runs},
+        'modes': modes,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report_data, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['modes']
+        print(f"\nChange against {args.compare}:")
+        for mode, timings in modes.items():
+            for key in ('import_s', 'create_app_s', 'process_s'):
+                old, new = baseline.get(mode, {}).get(key), timings[key]
+                if old:
+                    print(f"  {mode:<8} {key:<13} {old * 1000:>8.0f} -> {new * 1000:>8.0f} ms "
+                          f"({(new - old) / old * 100:+.1f}%)")
+
+    if args.budget is not None and modes['lazy']['import_s'] > args.budget:
+        print(f"\nImporting app.py took {modes['lazy']['import_s']:.3f}s, over the {args.budget:g}s budget")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+import asyncio
+
+from browser_pool import BrowserPool
+
+
+def test_concurrent_run_async_waits_for_slots():
+    pool = BrowserPool(size=1)
+    starts = []
+
+    async def slow_start():
+        starts.append(True)
+        await asyncio.sleep(0.05)
+        pool._slots = asyncio.Queue()
+
+    pool._start_async = slow_start
+
+    async def borrow():
+        return pool._slots is not None
+
+    async def scenario():
+        return await asyncio.gather(*(pool.run_async(borrow()) for _ in range(3)))
+
+    assert asyncio.run(scenario()) == [True, True, True]
+    assert starts == [True]
+
+
+def test_failed_start_can_be_retried():
+    pool = BrowserPool(size=1)
+    attempts = []
+
+    async def flaky_start():
+        attempts.append(True)
+        await asyncio.sleep(0.01)
+        if len(attempts) == 1:
+            raise RuntimeError('no browser')
+        pool._slots = asyncio.Queue()
+
+    pool._start_async = flaky_start
+
+    async def scenario():
+        results = await asyncio.gather(pool.start_async(), pool.start_async(), return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+        assert pool.stats() == {'started': False, 'size': 1}
+        await pool.start_async()
+        return pool.stats()['started']
+
+    assert asyncio.run(scenario()) is True
+    assert len(attempts) == 2
@@ -0,0 +1,130 @@
+import json
+import os
+
+import pytest
+
+from change_history import BLOCK_ROWS, ChangeHistory
+from sheet_scanner import SheetScan
+
+
+def make_scan(rows):
+    last_col = max((len(row) for row in rows), default=0)
+    rows = [tuple(row) + (None,) * (last_col - len(row)) for row in rows]
+    return SheetScan('Sheet', rows, len(rows), last_col, ['text'] * last_col, False)
+
+
+def table(num_rows, num_cols=3):
+    return [[f'h{col}' for col in range(num_cols)]] + [[f'r{row}c{col}' for col in range(num_cols)]
+                                                       for row in range(1, num_rows + 1)]
+
+
+@pytest.fixture
+def history(tmp_path):
+    return ChangeHistory(directory=str(tmp_path / 'history'))
+
+
+def test_first_version_has_no_changes(history):
+    assert history.changed_cells('sales.xlsx', make_scan(table(5))) == set()
+
+
+def test_edited_cells_are_found(history):
+    rows = table(5)
+    history.changed_cells('sales.xlsx', make_scan(rows))
+
+    rows[2][1] = 'edited'
+    rows[2][2] = 42
+
+    assert history.changed_cells('sales.xlsx', make_scan(rows)) == {(2, 1), (2, 2)}
+
+
+def test_edits_in_different_blocks_do_not_cross(history):
+    rows = table(3 * BLOCK_ROWS)
+    history.changed_cells('sales.xlsx', make_scan(rows))
+
+    rows[1][0] = 'edited'
+    rows[BLOCK_ROWS + 5][2] = 'edited'
+    rows[2 * BLOCK_ROWS + 1][1] = 'edited'
+
+    assert history.changed_cells('sales.xlsx', make_scan(rows)) == {
+        (1, 0), (BLOCK_ROWS + 5, 2), (2 * BLOCK_ROWS + 1, 1)}
+
+
+def test_edits_in_one_block_also_mark_where_they_cross(history):
+    rows = table(10)
+    history.changed_cells('sales.xlsx', make_scan(rows))
+
+    rows[1][0] = 'edited'
+    rows[3][2] = 'edited'
+
+    assert history.changed_cells('sales.xlsx', make_scan(rows)) == {(1, 0), (1, 2), (3, 0), (3, 2)}
+
+
+def test_appended_rows_are_new_in_every_column(history):
+    rows = table(BLOCK_ROWS - 2)
+    history.changed_cells('sales.xlsx', make_scan(rows))
+
+    # Fills up the old partial last block and starts a new one
+    rows = table(BLOCK_ROWS + 3)
+    changed = history.changed_cells('sales.xlsx', make_scan(rows))
+
+    assert changed == {(row, col) for row in range(BLOCK_ROWS - 1, BLOCK_ROWS + 4) for col in range(3)}
+
+
+def test_edit_next_to_appended_rows_in_a_partial_block(history):
+    rows = table(5)
+    history.changed_cells('sales.xlsx', make_scan(rows))
+
+    rows = table(7)
+    rows[3][1] = 'edited'
+    changed = history.changed_cells('sales.xlsx', make_scan(rows))
+
+    assert changed == {(3, 1)} | {(row, col) for row in (6, 7) for col in range(3)}
+
+
+def test_added_column_is_marked_in_every_row(history):
+    rows = table(4)
+    history.changed_cells('sales.xlsx', make_scan(rows))
+
+    changed = history.changed_cells('sales.xlsx', make_scan([row + ['new'] for row in rows]))
+
+    assert changed == {(row, 3) for row in range(5)}
+
+
+def test_same_version_again_highlights_the_same_cells(history):
+    rows = table(5)
+    history.changed_cells('sales.xlsx', make_scan(rows))
+    rows[2][0] = 'edited'
+
+    first = history.changed_cells('sales.xlsx', make_scan(rows))
+    again = history.changed_cells('sales.xlsx', make_scan(rows))
+
+    assert first == again == {(2, 0)}
+
+
+def test_series_are_kept_apart(history):
+    history.changed_cells('sales.xlsx', make_scan(table(5)))
+
+    assert history.changed_cells('other.xlsx', make_scan(table(6))) == set()
+
+
+def test_old_format_record_counts_as_a_first_version(history):
+    path = history._path('sales.xlsx')
+    with open(path, 'w') as f:
+        json.dump({'version': 'old', 'rows': [1, 2, 3], 'columns': [1, 2, 3]}, f)
+
+    assert history.changed_cells('sales.xlsx', make_scan(table(5))) == set()
+    rows = table(5)
+    rows[1][1] = 'edited'
+    assert history.changed_cells('sales.xlsx', make_scan(rows)) == {(1, 1)}
+
+
+def test_series_not_rendered_within_the_ttl_are_dropped(tmp_path):
+    history = ChangeHistory(directory=str(tmp_path / 'history'), ttl=60)
+    history.changed_cells('stale.xlsx', make_scan(table(3)))
+    stale = history._path('stale.xlsx')
+    os.utime(stale, (0, 0))
+
+    history.changed_cells('fresh.xlsx', make_scan(table(3)))
+
+    assert not os.path.exists(stale)
+    assert os.path.exists(history._path('fresh.xlsx'))
@@ -0,0 +1,91 @@
+import smtplib
+import socket
+
+import pytest
+
+from delivery import PERMANENT, TRANSIENT, RateLimiter, RetryPolicy, classify_error, smtp_code
+from smtp_pool import SMTPPoolTimeout, aiosmtplib
+
+
+@pytest.mark.parametrize('error, expected', [
+    (smtplib.SMTPResponseException(421, b'Service not available'), TRANSIENT),
+    (smtplib.SMTPSenderRefused(451, b'Try again later', 'sender@example.com'), TRANSIENT),
+    (smtplib.SMTPDataError(452, b'Mailbox full'), TRANSIENT),
+    (smtplib.SMTPSenderRefused(550, b'Rejected', 'sender@example.com'), PERMANENT),
+    (smtplib.SMTPAuthenticationError(535, b'Bad credentials'), PERMANENT),
+    (smtplib.SMTPRecipientsRefused({'a@example.com': (450, b'Greylisted')}), TRANSIENT),
+    # One hard bounce is enough for the whole send to be permanent
+    (smtplib.SMTPRecipientsRefused({'a@example.com': (450, b'Greylisted'),
+                                    'b@example.com': (550, b'No such user')}), PERMANENT),
+    (smtplib.SMTPServerDisconnected('Connection unexpectedly closed'), TRANSIENT),
+    (ConnectionRefusedError(), TRANSIENT),
+    (socket.timeout('timed out'), TRANSIENT),
+    (SMTPPoolTimeout('No SMTP connection available'), TRANSIENT),
+    (smtplib.SMTPNotSupportedError('SMTPUTF8 not supported'), PERMANENT),
+    (ValueError('bad address'), PERMANENT),
+])
+def test_classify_error(error, expected):
+    assert classify_error(error) == expected
+
+
+@pytest.mark.skipif(aiosmtplib is None, reason='aiosmtplib is not installed')
+@pytest.mark.parametrize('error, expected', [
+    (aiosmtplib.SMTPResponseException(421, 'Service not available'), TRANSIENT),
+    (aiosmtplib.SMTPRecipientsRefused([aiosmtplib.SMTPRecipientRefused(550, 'No such user', 'a@example.com')]),
+     PERMANENT),
+    (aiosmtplib.SMTPServerDisconnected('Disconnected'), TRANSIENT),
+    (aiosmtplib.SMTPTimeoutError('Timed out'), TRANSIENT),
+])
+def test_classify_aiosmtplib_error(error, expected):
+    assert classify_error(error) == expected
+
+
+def test_smtp_code_ignores_replies_without_codes():
+    assert smtp_code(smtplib.SMTPRecipientsRefused({})) is None
+    assert smtp_code(RuntimeError('no reply')) is None
+
+
+def test_retry_delay_backs_off_exponentially_with_jitter(monkeypatch):
+    monkeypatch.setattr('delivery.random.uniform', lambda low, high: high)
+    policy = RetryPolicy(max_attempts=5, base_delay=1, max_delay=6)
+
+    assert [policy.delay(attempt) for attempt in range(1, 6)] == [1, 2, 4, 6, 6]
+
+    monkeypatch.setattr('delivery.random.uniform', lambda low, high: low)
+    assert policy.delay(2) == 1
+
+
+def test_retry_delay_stays_within_jitter_bounds():
+    policy = RetryPolicy(max_attempts=3, base_delay=2, max_delay=30)
+    delays = [policy.delay(3) for _ in range(200)]
+
+    assert all(4 <= delay <= 8 for delay in delays)
+    assert len(set(delays)) > 1
+
+
+def test_retry_policy_reads_the_environment(monkeypatch):
+    monkeypatch.setenv('SMTP_MAX_ATTEMPTS', '2')
+    monkeypatch.setenv('SMTP_RETRY_BASE_SECONDS', '0.5')
+    monkeypatch.setenv('SMTP_RETRY_MAX_SECONDS', '3')
+    policy = RetryPolicy()
+    assert (policy.max_attempts, policy.base_delay, policy.max_delay) == (2, 0.5, 3)
+
+    assert RetryPolicy(max_attempts=6).max_attempts == 6
+
+
+def test_rate_limiter_throttles_past_the_burst():
+    limiter = RateLimiter(account_rate=10, account_burst=2, domain_rate=0)
+
+    waits = [limiter.reserve('sender@example.com', f'user{i}@example.com') for i in range(4)]
+
+    assert waits[:2] == [0.0, 0.0]
+    assert waits[2] == pytest.approx(0.1, abs=0.02)
+    assert waits[3] == pytest.approx(0.2, abs=0.02)
+    assert limiter.stats()['throttled'] == 2
+
+
+def test_rate_limiter_with_zero_rates_never_waits():
+    limiter = RateLimiter(account_rate=0, domain_rate=0)
+
+    assert all(limiter.reserve('sender@example.com', 'to@example.com') == 0 for _ in range(100))
+    assert limiter.stats()['throttled'] == 0
@@ -0,0 +1,35 @@
+import openpyxl
+import pytest
+
+from excel_processor import ExcelProcessor
+
+
+@pytest.fixture
+def processor(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return ExcelProcessor()
+
+
+def workbook(path, rows, cols):
+    book = openpyxl.Workbook()
+    sheet = book.active
+    for row in range(1, rows + 1):
+        sheet.append([f'r{row}c{col}' for col in range(1, cols + 1)])
+    book.save(path)
+    return str(path)
+
+
+def test_view_column_cap_below_sheet_width_shows_note(processor, tmp_path):
+    path = workbook(tmp_path / 'wide.xlsx', 4, 8)
+
+    scan = processor.scan_workbook(path, {'max_cols': 3})
+
+    assert scan.last_col == 3
+    assert processor.footer_note(scan) == 'Showing the first 3 rows and 3 columns'
+
+
+def test_sheet_within_caps_has_no_note(processor, tmp_path):
+    path = workbook(tmp_path / 'small.xlsx', 4, 8)
+
+    assert processor.footer_note(processor.scan_workbook(path)) is None
+    assert processor.footer_note(processor.scan_workbook(path, {'max_cols': 10})) is None
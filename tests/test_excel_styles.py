@@ -0,0 +1,110 @@
+import datetime
+
+import pytest
+
+from excel_styles import SheetStyles, format_cell, format_color, write_styled_html
+from memory_files import MemoryFile
+from sheet_scanner import SheetScan
+
+
+@pytest.mark.parametrize('value, number_format, expected', [
+    # General
+    (None, '0.00', ''),
+    (True, None, 'TRUE'),
+    (12, None, '12'),
+    (12.0, 'General', '12'),
+    (0.1 + 0.2, None, '0.3'),
+    (1234567.891, None, '1234567.891'),
+    ('text', '0.00', 'text'),
+    # Decimals, rounded half away from zero
+    (2.5, '0', '3'),
+    (3.5, '0', '4'),
+    (-2.5, '0', '-3'),
+    (0.125, '0.00', '0.13'),
+    (1.005, '0.00', '1.01'),
+    (5, '00.00', '05.00'),
+    (3, '0.', '3.'),
+    (12.5, '.00', '12.50'),
+    (0.5, '#.##', '.5'),
+    (1.5, '0.0#', '1.5'),
+    (1.25, '0.0#', '1.25'),
+    (1, '0.0#', '1.0'),
+    # Zero padding and literals between placeholders
+    (12, '00000', '00012'),
+    (1234, '0000', '1234'),
+    (7, '000-00-0000', '000-00-0007'),
+    (123456789, '000-00-0000', '123-45-6789'),
+    (5551234, '###-####', '555-1234'),
+    (12, '??0', ' 12'),
+    # Thousands separators and scaling
+    (1234567.891, '#,##0.00', '1,234,567.89'),
+    (0, '#,##0', '0'),
+    (0, '#,###', ''),
+    (12345678, '#,##0,,"M"', '12M'),
+    (1234, '$#,##0.00', '$1,234.00'),
+    (42, '"Total: "0', 'Total: 42'),
+    # Sections
+    (1234.5, '#,##0_);(#,##0)', '1,235 '),
+    (-1234.5, '#,##0_);(#,##0)', '(1,235)'),
+    (-5, '0;[Red]-0', '-5'),
+    (0, '0.00;-0.00;"zero"', 'zero'),
+    # Percent and scientific
+    (0.256, '0.0%', '25.6%'),
+    (0.125, '0%', '13%'),
+    (1.5e10, '0.00E+00', '1.50E+10'),
+    # Fractions
+    (0.5, '# ?/?', '1/2'),
+    (1.75, '# ??/??', '1 3/4'),
+    (1.75, '?/?', '7/4'),
+    (0.3, '# ?/8', '2/8'),
+    (2, '# ?/?', '2'),
+    (0.9999, '# ?/?', '1'),
+    (0, '?/?', '0'),
+    # Dates and times
+    (datetime.date(2024, 3, 5), 'yyyy-mm-dd', '2024-03-05'),
+    (datetime.datetime(2024, 3, 5, 14, 7), 'd mmm yy h:mm AM/PM', '5 Mar 24 2:07 PM'),
+    (datetime.datetime(2024, 3, 5, 14, 7, 9), 'hh:mm:ss', '14:07:09'),
+    (datetime.date(2024, 3, 5), 'dddd, mmmm d', 'Tuesday, March 5'),
+    (datetime.datetime(2024, 3, 5, 14, 7), None, '2024-03-05 14:07:00'),
+])
+def test_format_cell(value, number_format, expected):
+    assert format_cell(value, number_format) == expected
+
+
+@pytest.mark.parametrize('value, number_format', [
+    (0.5, '# ?/?'),
+    (1.75, '# ??/??'),
+    (0.001, '?/?'),
+    (1e30, '0.00'),
+])
+def test_format_cell_never_blanks_a_number(value, number_format):
+    assert format_cell(value, number_format) != ''
+
+
+@pytest.mark.parametrize('value, number_format, expected', [
+    (-5, '0;[Red]-0', '#ff0000'),
+    (5, '0;[Red]-0', None),
+    (5, '[Blue]0', '#0000ff'),
+    (5, '0', None),
+    ('5', '[Red]0', None),
+])
+def test_format_color(value, number_format, expected):
+    assert format_color(value, number_format) == expected
+
+
+def test_merge_across_hidden_row_spans_visible_rows_only():
+    rows = [('A', 'B'), ('merged', 'x'), (None, 'skipped'), (None, 'y')]
+    scan = SheetScan('Sheet', rows, 4, 2, ['text', 'text'], False)
+    scan.styles = SheetStyles(
+        cells=[[(str(value or ''), 0) for value in row] for row in rows],
+        classes=[''], base_css='', col_widths=[64, 64],
+        row_heights={2: 0}, merges=[(1, 0, 3, 1)],
+    )
+    output = MemoryFile('sheet.html')
+
+    write_styled_html(scan, output)
+
+    html = output.data.decode()
+    assert 'skipped' not in html
+    assert '<td rowspan="2">merged</td>' in html
+    assert html.count('<tr') == 3
@@ -0,0 +1,136 @@
+import sqlite3
+import subprocess
+import sys
+import time
+
+import pytest
+
+from job_queue import JobQueue, STATUS_DONE, STATUS_FAILED, STATUS_QUEUED, STATUS_RUNNING
+
+
+def make_queue(db_path, lease=60):
+    queue = JobQueue(db_path=str(db_path), workers=1, lease=lease)
+    queue.register('echo', lambda payload: payload)
+    return queue
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return tmp_path / 'jobs.db'
+
+
+def set_columns(db_path, job_id, **columns):
+    assignments = ', '.join(f'{name} = ?' for name in columns)
+    with sqlite3.connect(db_path) as conn:
+        conn.execute(f'UPDATE jobs SET {assignments} WHERE id = ?', (*columns.values(), job_id))
+
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def test_claimed_job_carries_the_worker_lease(db_path):
+    queue = make_queue(db_path)
+    job_id = queue.submit('echo', {'n': 1})
+
+    row = queue._claim_next()
+
+    assert row['id'] == job_id
+    assert queue.get(job_id)['status'] == STATUS_RUNNING
+    with sqlite3.connect(db_path) as conn:
+        token, heartbeat_at = conn.execute('SELECT worker_token, heartbeat_at FROM jobs').fetchone()
+    assert token == queue.worker_token
+    assert heartbeat_at == pytest.approx(time.time(), abs=5)
+
+
+def test_job_with_a_live_lease_is_left_running(db_path):
+    owner, other = make_queue(db_path), make_queue(db_path)
+    job_id = owner.submit('echo', {})
+    owner._claim_next()
+
+    other._recover_interrupted()
+
+    assert other.get(job_id)['status'] == STATUS_RUNNING
+    assert other._claim_next() is None
+
+
+def test_expired_lease_is_requeued_and_claimed_elsewhere(db_path):
+    owner, other = make_queue(db_path), make_queue(db_path)
+    job_id = owner.submit('echo', {'n': 2})
+    owner._claim_next()
+    set_columns(db_path, job_id, heartbeat_at=time.time() - 120)
+
+    other._recover_interrupted()
+
+    assert other.get(job_id)['status'] == STATUS_QUEUED
+    assert other._claim_next()['id'] == job_id
+
+    # The original worker finishing late does not overwrite the new claim
+    owner._finish(job_id, STATUS_DONE, result={'late': True})
+    assert other.get(job_id)['status'] == STATUS_RUNNING
+    other._finish(job_id, STATUS_DONE, result={'n': 2})
+    assert other.get(job_id)['result'] == {'n': 2}
+
+
+def test_job_of_an_exited_process_is_requeued_at_once(db_path):
+    owner, other = make_queue(db_path), make_queue(db_path)
+    job_id = owner.submit('echo', {})
+    owner._claim_next()
+    set_columns(db_path, job_id, worker_pid=dead_pid())
+
+    other._recover_interrupted()
+
+    assert other.get(job_id)['status'] == STATUS_QUEUED
+
+
+def test_pinned_job_is_only_claimed_by_its_process(db_path):
+    owner, other = make_queue(db_path), make_queue(db_path)
+    job_id = owner.submit('echo', {}, pinned=True)
+
+    assert other._claim_next() is None
+    assert owner._claim_next()['id'] == job_id
+
+
+def test_pinned_job_fails_once_its_process_lease_expires(db_path):
+    owner, other = make_queue(db_path), make_queue(db_path)
+    job_id = owner.submit('echo', {}, pinned=True)
+    other._recover_interrupted()
+    assert other.get(job_id)['status'] == STATUS_QUEUED
+
+    set_columns(db_path, job_id, heartbeat_at=time.time() - 120)
+    other._recover_interrupted()
+
+    job = other.get(job_id)
+    assert job['status'] == STATUS_FAILED
+    assert 'pinned' in job['error']
+
+
+def test_heartbeat_renews_the_lease_of_running_jobs(db_path):
+    queue = JobQueue(db_path=str(db_path), workers=1, lease=0.3)
+    started, release = [], []
+    queue.register('wait', lambda payload: started.append(True) or _wait_for(release))
+    queue.start()
+    try:
+        job_id = queue.submit('wait', {})
+        _wait_for(started)
+        # Several lease periods pass while the job runs, another process must not requeue it
+        time.sleep(1)
+        make_queue(db_path, lease=0.3)._recover_interrupted()
+        assert queue.get(job_id)['status'] == STATUS_RUNNING
+        release.append(True)
+        deadline = time.time() + 5
+        while queue.get(job_id)['status'] == STATUS_RUNNING and time.time() < deadline:
+            time.sleep(0.05)
+        assert queue.get(job_id)['status'] == STATUS_DONE
+    finally:
+        release.append(True)
+        queue.stop(timeout=5)
+
+
+def _wait_for(flag, timeout=5):
+    deadline = time.time() + timeout
+    while not flag and time.time() < deadline:
+        time.sleep(0.02)
+    return {'ok': bool(flag)}
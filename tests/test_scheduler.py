@@ -0,0 +1,210 @@
+import os
+import re
+import datetime
+from pathlib import Path
+
+import pytest
+
+from job_queue import STATUS_DONE, STATUS_QUEUED
+from scheduler import CronSchedule, ReportScheduler, parse_schedule
+
+EMAIL_PATTERN = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+
+
+def parse_selection(options):
+    return {'sheets': options['sheets']} if 'sheets' in options else None
+
+
+def parse_view(options, selection):
+    return {name: value for name, value in options.items() if name != 'sheets'} or None
+
+
+@pytest.mark.parametrize('expression, moment, expected', [
+    ('0 7 * * 1-5', datetime.datetime(2024, 3, 4, 7, 0), True),    # Monday
+    ('0 7 * * 1-5', datetime.datetime(2024, 3, 9, 7, 0), False),   # Saturday
+    ('0 7 * * 1-5', datetime.datetime(2024, 3, 4, 7, 1), False),
+    ('*/15 * * * *', datetime.datetime(2024, 3, 4, 10, 45), True),
+    ('*/15 * * * *', datetime.datetime(2024, 3, 4, 10, 50), False),
+    ('5/20 * * * *', datetime.datetime(2024, 3, 4, 10, 45), True),
+    ('0 9,17 * * *', datetime.datetime(2024, 3, 4, 17, 0), True),
+    ('0 0 * * 7', datetime.datetime(2024, 3, 10, 0, 0), True),     # Sunday as 7
+    ('@daily', datetime.datetime(2024, 3, 4, 0, 0), True),
+    ('@monthly', datetime.datetime(2024, 3, 2, 0, 0), False),
+    # A restricted day of month and day of week match either one, like cron
+    ('0 0 1 * 1', datetime.datetime(2024, 3, 4, 0, 0), True),
+    ('0 0 1 * 1', datetime.datetime(2024, 3, 1, 0, 0), True),
+    ('0 0 1 * 1', datetime.datetime(2024, 3, 5, 0, 0), False),
+])
+def test_cron_schedule_matches(expression, moment, expected):
+    assert CronSchedule(expression).matches(moment) is expected
+
+
+@pytest.mark.parametrize('expression', [
+    '0 7 * *', '60 * * * *', '* 24 * * *', '0 0 0 * *', '*/0 * * * *', '5-1 * * * *', 'a * * * *', '@often',
+])
+def test_cron_schedule_rejects_invalid_expressions(expression):
+    with pytest.raises(ValueError):
+        CronSchedule(expression)
+
+
+def test_parse_schedule_lines():
+    text = '''
+        # schedule    workbook        recipients
+        0 7 * * 1-5   sales.xlsx      a@example.com,b@example.com   sheets=all
+        @change       "q 1/*.xlsx"    c@example.com   top=20 style=excel
+    '''
+    scheduled, on_change = parse_schedule(text, parse_selection, parse_view, EMAIL_PATTERN, 5)
+
+    assert scheduled.schedule.expression == '0 7 * * 1-5'
+    assert scheduled.recipients == ['a@example.com', 'b@example.com']
+    assert scheduled.selection == {'sheets': 'all'}
+    assert on_change.schedule is None
+    assert on_change.pattern == 'q 1/*.xlsx'
+    assert on_change.view == {'top': '20', 'style': 'excel'}
+    assert on_change.line_number == 4
+
+
+@pytest.mark.parametrize('line, message', [
+    ('@daily sales.xlsx', 'expected a schedule'),
+    ('@daily ../sales.xlsx a@example.com', 'inside the watched directory'),
+    ('@daily sales.xlsx not-an-email', 'invalid email'),
+    ('@daily sales.xlsx a@example.com top', 'expected name=value'),
+    ('61 * * * * sales.xlsx a@example.com', 'Invalid schedule'),
+])
+def test_parse_schedule_names_the_bad_line(line, message):
+    with pytest.raises(ValueError, match=f'Schedule line 2: .*{message}'):
+        parse_schedule('\n' + line, parse_selection, parse_view, EMAIL_PATTERN, 5)
+
+
+class FakeJobQueue:
+    def __init__(self):
+        self.jobs = {}
+
+    def submit(self, kind, payload):
+        job_id = f'job{len(self.jobs)}'
+        self.jobs[job_id] = {'job_id': job_id, 'status': STATUS_QUEUED, 'payload': payload, 'updated_at': 0}
+        return job_id
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def finish(self, status=STATUS_DONE, sent=1):
+        for job in self.jobs.values():
+            if job['status'] == STATUS_QUEUED:
+                job['status'] = status
+                job['result'] = {'sent': sent}
+
+
+@pytest.fixture
+def scheduler(tmp_path):
+    for name in ('reports', 'uploads'):
+        (tmp_path / name).mkdir()
+    queue = FakeJobQueue()
+    scheduler = ReportScheduler(queue, str(tmp_path / 'uploads'), parse_selection, parse_view, EMAIL_PATTERN, 5,
+                                schedule_path=str(tmp_path / 'schedule.txt'), watch_dir=str(tmp_path / 'reports'),
+                                state_path=str(tmp_path / 'state.json'), poll_interval=1)
+    return scheduler, queue, tmp_path
+
+
+def write(path, data, mtime):
+    path.write_bytes(data)
+    os.utime(path, ns=(mtime, mtime))
+
+
+def test_changed_workbook_is_sent_once_its_stat_is_stable(scheduler):
+    scheduler, queue, tmp_path = scheduler
+    (tmp_path / 'schedule.txt').write_text('@change *.xlsx ops@example.com\n')
+    workbook = tmp_path / 'reports' / 'sales.xlsx'
+    (tmp_path / 'reports' / '~$sales.xlsx').write_bytes(b'lock file')
+    (tmp_path / 'reports' / 'notes.txt').write_bytes(b'not a workbook')
+
+    write(workbook, b'v1', 1_000_000_000)
+    scheduler.tick()
+    assert not queue.jobs  # Seen once, it may still be being copied
+
+    scheduler.tick()
+    assert len(queue.jobs) == 1
+    payload = queue.jobs['job0']['payload']
+    assert payload['filename'] == 'sales.xlsx'
+    assert Path(payload['filepath']).read_bytes() == b'v1'
+
+    scheduler.tick()
+    assert len(queue.jobs) == 1  # Still being sent
+
+    queue.finish()
+    write(workbook, b'v2', 2_000_000_000)
+    scheduler.tick()
+    scheduler.tick()
+    assert len(queue.jobs) == 2
+    assert Path(queue.jobs['job1']['payload']['filepath']).read_bytes() == b'v2'
+
+
+def test_resaved_workbook_with_the_same_content_is_not_sent_again(scheduler):
+    scheduler, queue, tmp_path = scheduler
+    (tmp_path / 'schedule.txt').write_text('@change sales.xlsx ops@example.com\n')
+    workbook = tmp_path / 'reports' / 'sales.xlsx'
+
+    write(workbook, b'v1', 1_000_000_000)
+    scheduler.tick()
+    scheduler.tick()
+    queue.finish()
+    scheduler.tick()
+
+    write(workbook, b'v1', 2_000_000_000)
+    scheduler.tick()
+    scheduler.tick()
+
+    assert len(queue.jobs) == 1
+    assert scheduler.pending() == 0
+
+
+def test_failed_send_waits_for_the_workbook_to_change(scheduler):
+    scheduler, queue, tmp_path = scheduler
+    (tmp_path / 'schedule.txt').write_text('@change sales.xlsx ops@example.com\n')
+    workbook = tmp_path / 'reports' / 'sales.xlsx'
+
+    write(workbook, b'v1', 1_000_000_000)
+    scheduler.tick()
+    scheduler.tick()
+    queue.finish(sent=0)  # Reached no recipient, counted as failed
+    scheduler.tick()
+    write(workbook, b'v1', 2_000_000_000)
+    scheduler.tick()
+    scheduler.tick()
+    assert len(queue.jobs) == 1
+
+    write(workbook, b'v2', 3_000_000_000)
+    scheduler.tick()
+    scheduler.tick()
+    assert len(queue.jobs) == 2
+
+
+def test_cron_report_is_sent_in_its_minute_only(scheduler):
+    scheduler, queue, tmp_path = scheduler
+    (tmp_path / 'schedule.txt').write_text('30 9 * * * sales.xlsx ops@example.com\n')
+    write(tmp_path / 'reports' / 'sales.xlsx', b'v1', 1_000_000_000)
+
+    scheduler.tick(now=datetime.datetime(2024, 3, 4, 9, 28))
+    scheduler.tick(now=datetime.datetime(2024, 3, 4, 9, 29, 50))
+    assert not queue.jobs
+
+    # A slow poll that skipped 9:30 still catches up on it
+    scheduler.tick(now=datetime.datetime(2024, 3, 4, 9, 31, 5))
+    assert len(queue.jobs) == 1
+
+
+def test_sent_state_survives_a_restart(scheduler):
+    scheduler, queue, tmp_path = scheduler
+    (tmp_path / 'schedule.txt').write_text('@daily sales.xlsx ops@example.com\n')
+    write(tmp_path / 'reports' / 'sales.xlsx', b'v1', 1_000_000_000)
+    scheduler.tick(now=datetime.datetime(2024, 3, 4, 0, 0))
+    queue.finish()
+    scheduler.tick(now=datetime.datetime(2024, 3, 4, 0, 1))
+
+    restarted = ReportScheduler(queue, scheduler.upload_folder, parse_selection, parse_view, EMAIL_PATTERN, 5,
+                                schedule_path=scheduler.schedule_path, watch_dir=scheduler.watch_dir,
+                                state_path=scheduler.state_path)
+    restarted.tick(now=datetime.datetime(2024, 3, 5, 0, 0))
+
+    assert len(queue.jobs) == 1
+    assert queue.jobs['job0']['status'] == STATUS_DONE
@@ -0,0 +1,17 @@
+from screenshot_cache import ScreenshotCache
+
+
+def test_uncounted_lookups_leave_hit_rate_alone(tmp_path):
+    cache = ScreenshotCache(cache_dir=str(tmp_path / 'cache'))
+    image = tmp_path / 'tile.png'
+    image.write_bytes(b'png')
+    cache.put('tile', [str(image)])
+
+    out = tmp_path / 'out.png'
+    assert cache.get('tile', lambda _: str(out), count=False) == [str(out)]
+    assert cache.get('other', lambda _: str(out), count=False) is None
+    assert cache.stats()['hits'] == 0 and cache.stats()['misses'] == 0
+
+    assert cache.get('tile', lambda _: str(out)) == [str(out)]
+    assert cache.get('other', lambda _: str(out)) is None
+    assert cache.stats()['hit_rate'] == 0.5
@@ -0,0 +1,200 @@
+import time
+import socket
+import asyncio
+import smtplib
+
+import pytest
+
+aiosmtpd_controller = pytest.importorskip('aiosmtpd.controller')
+
+from smtp_pool import SMTPConnectionPool, AsyncSMTPConnectionPool, _DataWriter, aiosmtplib
+
+
+class RecordingHandler:
+    """aiosmtpd handler that keeps what it receives and can refuse or drop sessions"""
+
+    def __init__(self):
+        self.messages = []
+        self.noops = 0
+        self.sessions = []
+        self.refuse_mail = False
+
+    async def handle_NOOP(self, server, session, envelope, arg):
+        self.noops += 1
+        return '250 OK'
+
+    async def handle_MAIL(self, server, session, envelope, address, mail_options):
+        if server not in self.sessions:
+            self.sessions.append(server)
+        if self.refuse_mail:
+            # Hang up once the reply is out, as servers do after a 421
+            asyncio.get_running_loop().call_later(0.05, server.transport.close)
+            return '421 Service not available, closing transmission channel'
+        envelope.mail_from = address
+        envelope.mail_options.extend(mail_options)
+        return '250 OK'
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append((envelope.rcpt_tos, envelope.content))
+        return '250 Message accepted for delivery'
+
+
+@pytest.fixture
+def smtpd():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    handler = RecordingHandler()
+    controller = aiosmtpd_controller.Controller(handler, hostname='127.0.0.1', port=port)
+    controller.start()
+    yield controller, handler
+    controller.stop()
+
+
+def make_pool(controller, **options):
+    options.setdefault('keepalive_interval', 60)
+    return SMTPConnectionPool('127.0.0.1', controller.port, use_tls=False, timeout=5, **options)
+
+
+def message(subject='Report'):
+    return f'Subject: {subject}\r\n\r\nBody\r\n'.encode()
+
+
+def test_connection_is_reused_across_sends(smtpd):
+    controller, handler = smtpd
+    pool = make_pool(controller)
+
+    for index in range(3):
+        pool.sendmail('sender@example.com', ['to@example.com'], message(f'Report {index}'))
+
+    assert len(handler.messages) == 3
+    assert pool.stats()['opened_total'] == 1
+    assert pool.stats()['idle'] == 1
+    pool.close_all()
+
+
+def test_idle_connection_is_checked_with_noop(smtpd):
+    controller, handler = smtpd
+    pool = make_pool(controller, keepalive_interval=0.05)
+
+    pool.sendmail('sender@example.com', ['to@example.com'], message())
+    assert handler.noops == 0
+    time.sleep(0.1)
+    pool.sendmail('sender@example.com', ['to@example.com'], message())
+
+    assert handler.noops == 1
+    assert pool.stats()['opened_total'] == 1
+    pool.close_all()
+
+
+def test_connection_is_retired_after_max_messages(smtpd):
+    controller, handler = smtpd
+    pool = make_pool(controller, max_messages=2)
+
+    for _ in range(5):
+        pool.sendmail('sender@example.com', ['to@example.com'], message())
+
+    assert len(handler.messages) == 5
+    assert pool.stats()['opened_total'] == 3
+    pool.close_all()
+
+
+def test_reconnects_once_when_the_server_dropped_the_session(smtpd):
+    controller, handler = smtpd
+    pool = make_pool(controller)
+
+    pool.sendmail('sender@example.com', ['to@example.com'], message())
+    session = handler.sessions[0]
+    controller.loop.call_soon_threadsafe(session.transport.close)
+    time.sleep(0.1)
+    pool.sendmail('sender@example.com', ['to@example.com'], message())
+
+    assert len(handler.messages) == 2
+    assert pool.stats()['opened_total'] == 2
+    pool.close_all()
+
+
+@pytest.mark.parametrize('msg', [message(), message().decode()])
+def test_connection_closed_by_421_is_not_reused(smtpd, msg):
+    controller, handler = smtpd
+    pool = make_pool(controller)
+    pool.sendmail('sender@example.com', ['to@example.com'], msg)
+
+    handler.refuse_mail = True
+    with pytest.raises(smtplib.SMTPSenderRefused):
+        pool.sendmail('sender@example.com', ['to@example.com'], msg)
+    assert pool.stats()['idle'] == 0
+
+    handler.refuse_mail = False
+    pool.sendmail('sender@example.com', ['to@example.com'], msg)
+    assert len(handler.messages) == 2
+    assert pool.stats()['opened_total'] == 2
+    pool.close_all()
+
+
+def test_streamed_chunks_arrive_intact(smtpd):
+    controller, handler = smtpd
+    pool = make_pool(controller)
+    chunks = [b'Subject: Split\n\n', b'.leading dot\r', b'\n.', b'second\n', b'bare\rcr\r', b'\r\nend']
+
+    pool.sendmail('sender@example.com', ['to@example.com'], chunks)
+
+    assert handler.messages[0][1] == (b'Subject: Split\r\n\r\n.leading dot\r\n.second\r\n'
+                                      b'bare\r\ncr\r\n\r\nend\r\n')
+    pool.close_all()
+
+
+@pytest.mark.skipif(aiosmtplib is None, reason='aiosmtplib is not installed')
+def test_async_pool_reuses_and_drops_421_sessions(smtpd):
+    controller, handler = smtpd
+
+    async def scenario():
+        pool = AsyncSMTPConnectionPool('127.0.0.1', controller.port, use_tls=False, timeout=5,
+                                       keepalive_interval=60)
+        await pool.sendmail('sender@example.com', ['to@example.com'], message())
+        await pool.sendmail('sender@example.com', ['to@example.com'], message())
+        assert pool.stats()['opened_total'] == 1
+
+        handler.refuse_mail = True
+        with pytest.raises(aiosmtplib.SMTPSenderRefused):
+            await pool.sendmail('sender@example.com', ['to@example.com'], message())
+        assert pool.stats()['idle'] == 0
+
+        handler.refuse_mail = False
+        await pool.sendmail('sender@example.com', ['to@example.com'], message())
+        assert pool.stats()['opened_total'] == 2
+        await pool.close_all()
+
+    asyncio.run(scenario())
+    assert len(handler.messages) == 3
+
+
+class FakeSocket:
+    def __init__(self):
+        self.data = bytearray()
+
+    def sendall(self, data):
+        self.data += data
+
+
+@pytest.mark.parametrize('chunks, expected', [
+    ([b'a\nb'], b'a\r\nb\r\n.\r\n'),
+    ([b'.start'], b'..start\r\n.\r\n'),
+    ([b'line\n', b'.dot'], b'line\r\n..dot\r\n.\r\n'),
+    ([b'line\r', b'\n.dot'], b'line\r\n..dot\r\n.\r\n'),
+    ([b'line\r', b'.dot'], b'line\r\n..dot\r\n.\r\n'),
+    ([b'a\r', b'b'], b'a\r\nb\r\n.\r\n'),
+    ([b'a\r', b'', b'\nb'], b'a\r\nb\r\n.\r\n'),
+    ([b'ends with cr\r'], b'ends with cr\r\n.\r\n'),
+    ([b'done\r\n'], b'done\r\n.\r\n'),
+    ([b'x\n..\n', b'.'], b'x\r\n...\r\n..\r\n.\r\n'),
+])
+def test_data_writer_normalizes_across_chunks(chunks, expected):
+    sock = FakeSocket()
+    writer = _DataWriter(sock, block_size=4)
+    for chunk in chunks:
+        writer.write(chunk)
+    writer.close()
+
+    assert bytes(sock.data) == expected
+    assert writer.bytes_sent == len(expected)
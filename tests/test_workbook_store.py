@@ -0,0 +1,119 @@
+import os
+import time
+import hashlib
+
+import pytest
+
+from memory_files import MemoryFile
+from workbook_store import WorkbookStore, WorkbookStoreFull
+
+
+@pytest.fixture
+def store(tmp_path):
+    return WorkbookStore(directory=str(tmp_path / 'workbooks'), max_bytes=1000, max_entries=3, ttl=60)
+
+
+def upload(tmp_path, data, name='report.xlsx'):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_put_moves_the_upload_under_its_content_hash(store, tmp_path):
+    source = upload(tmp_path, b'workbook')
+
+    meta, created = store.put(source, 'Report.XLSX')
+
+    handle = hashlib.sha256(b'workbook').hexdigest()
+    assert created
+    assert meta['handle'] == handle
+    assert store.is_handle(handle)
+    assert not (tmp_path / 'report.xlsx').exists()
+    assert store.path(handle).endswith(f'{handle}.xlsx')
+    with open(store.path(handle), 'rb') as f:
+        assert f.read() == b'workbook'
+
+
+def test_memory_upload_is_written_to_the_store(store):
+    meta, created = store.put(MemoryFile('report.xlsx', b'in memory'), 'report.xlsx')
+
+    assert created
+    with open(store.path(meta['handle']), 'rb') as f:
+        assert f.read() == b'in memory'
+
+
+def test_same_content_returns_the_same_handle_and_renews_it(store, tmp_path, monkeypatch):
+    meta, _ = store.put(upload(tmp_path, b'workbook'), 'january.xlsx')
+    stored_path = store.path(meta['handle'])
+
+    monkeypatch.setattr(time, 'time', lambda now=time.time(): now + 30)
+    second = upload(tmp_path, b'workbook', 'copy.xlsx')
+    again, created = store.put(second, 'february.xlsx')
+
+    assert not created
+    assert again['handle'] == meta['handle']
+    assert again['filename'] == 'february.xlsx'
+    assert again['expires_at'] == pytest.approx(meta['expires_at'] + 30, abs=1)
+    assert store.path(meta['handle']) == stored_path
+    assert not (tmp_path / 'copy.xlsx').exists()
+    assert store.stats()['workbooks'] == 1
+
+
+def test_sends_are_counted(store):
+    meta, _ = store.put(MemoryFile('report.xlsx', b'workbook'), 'report.xlsx')
+
+    store.record_send(meta['handle'])
+    store.record_send(meta['handle'])
+
+    assert store.get(meta['handle'])['sends'] == 2
+
+
+def test_expired_workbook_is_gone(store, monkeypatch):
+    meta, _ = store.put(MemoryFile('report.xlsx', b'workbook'), 'report.xlsx')
+
+    monkeypatch.setattr(time, 'time', lambda now=time.time(): now + 61)
+
+    assert store.get(meta['handle']) is None
+    assert store.path(meta['handle']) is None
+    assert store.stats()['workbooks'] == 0
+
+
+def test_full_store_refuses_new_workbooks(store):
+    for index in range(3):
+        store.put(MemoryFile('report.xlsx', f'workbook {index}'.encode()), 'report.xlsx')
+
+    with pytest.raises(WorkbookStoreFull):
+        store.put(MemoryFile('report.xlsx', b'one too many'), 'report.xlsx')
+    with pytest.raises(WorkbookStoreFull):
+        WorkbookStore(directory=store.directory, max_bytes=20).put(
+            MemoryFile('report.xlsx', b'x' * 21), 'report.xlsx')
+
+
+def test_expired_workbooks_make_room(store, monkeypatch):
+    old = [store.put(MemoryFile('report.xlsx', f'workbook {index}'.encode()), 'report.xlsx')[0]
+           for index in range(3)]
+
+    monkeypatch.setattr(time, 'time', lambda now=time.time(): now + 61)
+    meta, created = store.put(MemoryFile('report.xlsx', b'new'), 'report.xlsx')
+
+    assert created
+    assert store.stats()['workbooks'] == 1
+    assert all(store._read_meta(expired['handle']) is None for expired in old)
+
+
+def test_remove_deletes_the_workbook(store):
+    meta, _ = store.put(MemoryFile('report.xlsx', b'workbook'), 'report.xlsx')
+    stored_path = store.path(meta['handle'])
+
+    assert store.remove(meta['handle'])
+    assert store.get(meta['handle']) is None
+    assert not store.remove(meta['handle'])
+    assert not os.path.exists(stored_path)
+
+
+@pytest.mark.parametrize('handle', ['', None, 'abc', '../' + 'a' * 61, 'A' * 64])
+def test_invalid_handles_are_not_found(store, handle):
+    assert not store.is_handle(handle)
+    assert store.get(handle) is None
+    assert store.path(handle) is None
+    assert not store.remove(handle)
@@ -0,0 +1,172 @@
+import io
+import os
+import uuid
+import hashlib
+import logging
+import zipfile
+from flask import Request
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+from werkzeug.formparser import default_stream_factory
+from werkzeug.utils import secure_filename
+from memory_files import MemoryFile
+
+logger = logging.getLogger(__name__)
+
+XLSX_MAGIC = b'PK\x03\x04'
+XLS_MAGIC = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'  # OLE2 compound document
+EXCEL_EXTENSIONS = ('.xlsx', '.xls')
+
+
+class StreamedUpload:
+    """
+    Writable file that receives an uploaded workbook straight from the
+    multipart parser into the upload folder.
+
+    Chunks are hashed as they arrive, the magic bytes are checked as soon as
+    the first ones are in, and the upload is aborted once it passes the size
+    limit, so bad uploads are rejected without reading the rest of the body.
+    The file is deleted on close unless it was claimed with claim().
+
+    With memory_uploads, uploads of up to memory_max_size bytes are kept in
+    a buffer instead and never touch the disk; one that grows past the
+    threshold is moved to the upload folder as it streams in.
+    """
+
+    def __init__(self, upload_folder, filename, max_size, memory_max_size=0, memory_uploads=None):
+        self.filename = secure_filename(filename)
+        self.path = os.path.join(upload_folder, f"{uuid.uuid4()}_{self.filename}")
+        self.max_size = max_size
+        self.memory_max_size = memory_max_size if memory_uploads is not None else 0
+        self.memory_uploads = memory_uploads
+        self.size = 0
+        self.kind = None
+        self._digest = hashlib.sha256()
+        self._head = b''
+        self._claimed = False
+        self._file = None
+        self._file = io.BytesIO() if self.memory_max_size else open(self.path, 'w+b')
+
+    @property
+    def in_memory(self):
+        return isinstance(self._file, io.BytesIO)
+
+    def _spill(self):
+        """Move the buffered upload to the upload folder"""
+        buffer = self._file
+        self._file = open(self.path, 'w+b')
+        self._file.write(buffer.getbuffer())
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.max_size and self.size > self.max_size:
+            self._discard()
+            raise RequestEntityTooLarge(f'File too large. Maximum size is {self.max_size / (1024 * 1024):g}MB.')
+
+        if self.kind is None:
+            self._sniff(chunk)
+
+        if self.in_memory and self.size > self.memory_max_size:
+            self._spill()
+
+        self._digest.update(chunk)
+        return self._file.write(chunk)
+
+    def _sniff(self, chunk):
+        self._head += chunk[:len(XLS_MAGIC)]
+        if len(self._head) < len(XLS_MAGIC):
+            return
+
+        if self._head.startswith(XLSX_MAGIC):
+            self.kind = 'xlsx'
+        elif self._head.startswith(XLS_MAGIC):
+            self.kind = 'xls'
+        else:
+            self._discard()
+            raise BadRequest('Invalid file content. The upload is not an Excel workbook.')
+
+    @property
+    def sha256(self):
+        return self._digest.hexdigest()
+
+    def validate(self):
+        """
+        Check the completed upload: magic bytes and, for .xlsx, the zip
+        central directory must list the workbook parts.
+        """
+        if self.kind is None:
+            raise BadRequest('Invalid file content. The upload is not an Excel workbook.')
+
+        if self.kind == 'xlsx':
+            self._file.flush()
+            try:
+                with zipfile.ZipFile(self._file) as archive:
+                    names = set(archive.namelist())
+            except zipfile.BadZipFile:
+                raise BadRequest('Invalid file content. The workbook archive is corrupt.')
+            if '[Content_Types].xml' not in names or 'xl/workbook.xml' not in names:
+                raise BadRequest('Invalid file content. The archive is not an Excel workbook.')
+
+    def claim(self):
+        """
+        Validate the upload and keep it, returns its path on disk, or the
+        memory_uploads key of an upload held in memory
+        """
+        self.validate()
+        if self.in_memory:
+            key = self.memory_uploads.put(MemoryFile(self.filename, self._file.getvalue()))
+            if key is not None:
+                self._claimed = True
+                return key
+            logger.info(f"Memory upload store is full, keeping {self.filename} on disk")
+            self._spill()
+        self._claimed = True
+        self._file.close()
+        return self.path
+
+    def _discard(self):
+        self._file.close()
+        if not self.in_memory and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def close(self):
+        if not self._claimed:
+            self._discard()
+        else:
+            self._file.close()
+
+    def __del__(self):
+        # The parser drops the stream without closing it if the client disconnects
+        if self._file is not None and not self._claimed and not self._file.closed:
+            self._discard()
+
+    def __getattr__(self, name):
+        # read/seek/tell etc. go to the underlying file
+        if name == '_file':
+            raise AttributeError(name)
+        return getattr(self._file, name)
+
+
+class StreamingRequest(Request):
+    """
+    Request class that streams Excel uploads straight to the upload folder
+    with per-endpoint size limits (see upload_limits) instead of spooling
+    them to a temporary file and copying them afterwards.
+    """
+
+    upload_folder = 'uploads'
+    upload_limits = {}
+    # Set to a MemoryUploads to keep uploads of up to memory_max_size bytes in memory
+    memory_uploads = None
+    memory_max_size = 0
+
+    def upload_limit(self):
+        """Size limit for the endpoint handling this request"""
+        return self.upload_limits.get(self.endpoint, self.max_content_length)
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None,
+                         content_length=None):
+        if not filename or not filename.lower().endswith(EXCEL_EXTENSIONS):
+            return default_stream_factory(total_content_length, content_type, filename, content_length)
+
+        return StreamedUpload(self.upload_folder, filename, self.upload_limit(),
+                              self.memory_max_size, self.memory_uploads)
@@ -0,0 +1,193 @@
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import logging
+import threading
+from memory_files import MemoryFile
+
+logger = logging.getLogger(__name__)
+
+_HANDLE = re.compile(r'^[0-9a-f]{64}$')
+
+
+class WorkbookStoreFull(Exception):
+    """Raised when a workbook does not fit in the store's quota"""
+
+
+class WorkbookStore:
+    """
+    Uploaded workbooks kept on disk under a handle, the sha256 of their
+    content, so they can be sent again without being uploaded again.
+    Storing the same content twice returns the same handle and renews it.
+
+    Each workbook is <handle><extension> plus <handle>.json with its file
+    name and expiry; the JSON is written last, so a workbook is only found
+    once both files are complete. Workbooks expire ttl seconds after they
+    were last stored. Expired ones are removed to make room, and a workbook
+    that still does not fit under max_bytes or max_entries is refused.
+
+    The stored file keeps its path and mtime, so the scan cache and the
+    screenshot cache serve repeated sends of a handle.
+    """
+
+    def __init__(self, directory=None, max_bytes=None, max_entries=None, ttl=None):
+        self.directory = directory or os.getenv('WORKBOOK_STORE_DIR', 'workbooks')
+        self.max_bytes = max_bytes or int(float(os.getenv('WORKBOOK_STORE_MAX_MB', '1024')) * 1024 * 1024)
+        self.max_entries = max_entries or int(os.getenv('WORKBOOK_STORE_MAX_ENTRIES', '500'))
+        self.ttl = ttl or int(os.getenv('WORKBOOK_STORE_TTL', str(7 * 86400)))
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def is_handle(handle):
+        return bool(_HANDLE.match(handle or ''))
+
+    def _meta_path(self, handle):
+        if not self.is_handle(handle):
+            raise ValueError(f"Invalid workbook handle: {handle}")
+        return os.path.join(self.directory, f"{handle}.json")
+
+    def _write_meta(self, meta):
+        path = self._meta_path(meta['handle'])
+        with open(f"{path}.{os.getpid()}.tmp", 'w') as f:
+            json.dump(meta, f)
+        os.replace(f"{path}.{os.getpid()}.tmp", path)
+
+    def _read_meta(self, handle):
+        try:
+            with open(self._meta_path(handle)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _all(self):
+        """Metadata of every stored workbook, written by any process"""
+        metas = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                meta = self._read_meta(name[:-len('.json')])
+                if meta is not None:
+                    metas.append(meta)
+        return metas
+
+    def _remove(self, meta):
+        for path in (self._meta_path(meta['handle']), os.path.join(self.directory, meta['stored_name'])):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _make_room(self, size):
+        """Remove expired workbooks, raise WorkbookStoreFull if size bytes still do not fit"""
+        now = time.time()
+        metas = []
+        for meta in self._all():
+            if meta['expires_at'] <= now:
+                self._remove(meta)
+                logger.info(f"Removed expired workbook {meta['handle']}")
+            else:
+                metas.append(meta)
+
+        used = sum(meta['size'] for meta in metas)
+        if used + size > self.max_bytes or len(metas) + 1 > self.max_entries:
+            raise WorkbookStoreFull(
+                f"Workbook store is full ({len(metas)} workbooks, {used / (1024 * 1024):.1f}MB)"
+            )
+
+    def put(self, source, filename, sha256=None):
+        """
+        Store a workbook: an upload's path, which is moved into the store,
+        or a MemoryFile. sha256 is the content hash when already known.
+        Returns (meta, created), created is False when the content was
+        already stored. Raises WorkbookStoreFull.
+        """
+        if sha256 is None:
+            if isinstance(source, MemoryFile):
+                sha256 = source.sha256()
+            else:
+                digest = hashlib.sha256()
+                with open(source, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                        digest.update(chunk)
+                sha256 = digest.hexdigest()
+
+        now = time.time()
+        with self._lock:
+            meta = self.get(sha256)
+            if meta is not None:
+                # Same content: keep the stored file (and its caches), renew the handle
+                if not isinstance(source, MemoryFile):
+                    os.remove(source)
+                meta.update(filename=filename, expires_at=now + self.ttl)
+                self._write_meta(meta)
+                return meta, False
+
+            size = len(source.data) if isinstance(source, MemoryFile) else os.path.getsize(source)
+            self._make_room(size)
+
+            stored_name = sha256 + os.path.splitext(filename)[1].lower()
+            stored_path = os.path.join(self.directory, stored_name)
+            if isinstance(source, MemoryFile):
+                with open(stored_path, 'wb') as f:
+                    f.write(source.data)
+            else:
+                shutil.move(source, stored_path)
+
+            meta = {
+                'handle': sha256,
+                'filename': filename,
+                'stored_name': stored_name,
+                'size': size,
+                'created_at': now,
+                'expires_at': now + self.ttl,
+                'sends': 0,
+            }
+            self._write_meta(meta)
+        logger.info(f"Stored workbook {filename} as {sha256}")
+        return meta, True
+
+    def get(self, handle):
+        """Metadata of a stored workbook, or None if it does not exist or has expired"""
+        meta = self._read_meta(handle)
+        if meta is None or meta['expires_at'] <= time.time():
+            return None
+        if not os.path.exists(os.path.join(self.directory, meta['stored_name'])):
+            return None
+        return meta
+
+    def path(self, handle):
+        """Path of a stored workbook, or None if it does not exist or has expired"""
+        meta = self.get(handle)
+        return os.path.join(self.directory, meta['stored_name']) if meta else None
+
+    def record_send(self, handle):
+        """Count a send of a stored workbook"""
+        with self._lock:
+            meta = self.get(handle)
+            if meta is not None:
+                meta['sends'] = meta.get('sends', 0) + 1
+                self._write_meta(meta)
+
+    def remove(self, handle):
+        """Delete a stored workbook, returns False if it did not exist"""
+        with self._lock:
+            meta = self._read_meta(handle)
+            if meta is None:
+                return False
+            self._remove(meta)
+        return True
+
+    def stats(self):
+        """Number and total size of the stored workbooks"""
+        now = time.time()
+        metas = [meta for meta in self._all() if meta['expires_at'] > now]
+        return {
+            'workbooks': len(metas),
+            'bytes': sum(meta['size'] for meta in metas),
+            'max_bytes': self.max_bytes,
+            'max_entries': self.max_entries,
+            'ttl': self.ttl,
+        }